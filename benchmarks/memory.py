@@ -0,0 +1,101 @@
+# Memory footprint of the scene representation: bytes per entity of synthetic scenes of 10k, 100k and 1M entities,
+# with the components on the entities themselves and in the NumPy component store.
+# Every scene is built in a fresh process, and measured both as Python allocations (tracemalloc) and, on Linux,
+# as growth of the resident set (which also covers memory allocated outside of Python, e.g. by Qt). The two are measured
+# in separate processes, as tracing adds its own bookkeeping to the resident set.
+# Results are written as JSON, and can be compared against a previous run - e.g. one from before a change to Entity.
+#
+# Usage: python benchmarks/memory.py [--sizes 10000,100000,1000000] [--no-store] [--output memory.json] [--baseline before.json]
+import argparse
+import gc
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Resident set size of the process in bytes, None where /proc isn't available
+def residentBytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+# Builds a scene in this process and returns its footprint in bytes per entity, None if the metric isn't available
+def measure(count, useComponentStore, metric):
+    # Imported up front so that module state isn't counted
+    from data import entity
+    from scenes import buildScene
+    if useComponentStore:
+        from data.componentstore import ComponentStore
+    gc.collect()
+    if metric == "python":
+        tracemalloc.start()
+    rss = residentBytes()
+    # count entities, the root included, with ids as in an editor's scene
+    root = buildScene(count - 1, ids=True)
+    if useComponentStore:
+        store = ComponentStore(count)
+        store.bind(root)
+    gc.collect()
+    if metric == "python":
+        return tracemalloc.get_traced_memory()[0] / count
+    if rss == None:
+        return None
+    return (residentBytes() - rss) / count
+
+def run(count, useComponentStore):
+    result = {"entities": count}
+    for metric in ("python", "rss"):
+        command = [sys.executable, os.path.abspath(__file__), "--measure", str(count), "--metric", metric]
+        if useComponentStore:
+            command.append("--store")
+        value = json.loads(subprocess.run(command, check=True, stdout=subprocess.PIPE).stdout.decode("utf-8"))
+        if value != None:
+            result[metric] = value
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes per entity of the scene representation")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma separated entity counts")
+    parser.add_argument("--no-store", action="store_true", help="don't measure with the NumPy component store")
+    parser.add_argument("--output", default="memory_results.json")
+    parser.add_argument("--baseline", help="results of a previous run to compare with")
+    parser.add_argument("--measure", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--store", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--metric", default="python", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure != None:
+        print(json.dumps(measure(args.measure, args.store, args.metric)))
+        return
+
+    modes = ["entity"]
+    if not args.no_store and importlib.util.find_spec("numpy") != None:
+        modes.append("store")
+    results = {}
+    for mode in modes:
+        for count in [int(s) for s in args.sizes.split(",")]:
+            results["%s/%d" % (mode, count)] = run(count, mode == "store")
+    with open(args.output, "w") as f:
+        json.dump({"results": results}, f, indent=2)
+
+    baseline = {}
+    if args.baseline != None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    print("%-16s %14s %14s %14s %14s" % ("bytes/entity", "python", "baseline", "rss", "baseline"))
+    for name, result in results.items():
+        reference = baseline.get(name, {})
+        columns = []
+        for metric in ("python", "rss"):
+            columns.append("%.0f" % result[metric] if metric in result else "-")
+            columns.append("%.0f" % reference[metric] if metric in reference else "-")
+        print("%-16s %14s %14s %14s %14s" % tuple([name] + columns))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Compares the binary scene format with the JSON one (as previously written to the cache) on a synthetic scene.
+# Besides loading the whole tree at once, loading is measured as the editor does it (see Database): into a ComponentStore
+# when NumPy is available, and streamed, where only the first levels are loaded before the scene shows up.
+# Usage: python benchmarks/scene_format.py [entity count]
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from data.entity import Entity
+from data import sceneformat
+from data.streaming import SceneStream
+from scenes import buildScene
+
+# The binary format is meant to save and load at least this many times faster than JSON, and to be as many times smaller
+TARGET = 10.0
+
+def timed(f):
+    start = time.perf_counter()
+    result = f()
+    return (time.perf_counter() - start, result)
+
+# Opens a scene file for streaming and loads its first levels, as Database does by default
+def openStreamed(path, store):
+    stream = SceneStream(path, store)
+    level = [stream.root()]
+    for _ in range(2):
+        level = [c for e in level for c in stream.loadChildren(e)]
+    return stream
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    # count entities, the root included
+    root = buildScene(count - 1)
+
+    jsonSave, jsonData = timed(lambda: json.dumps(root.toDict(), indent=2).encode("utf-8"))
+    binarySave, binaryData = timed(lambda: sceneformat.dumps(root))
+    jsonLoad, _ = timed(lambda: Entity.fromDict(json.loads(jsonData.decode("utf-8"))))
+    binaryLoad, _ = timed(lambda: sceneformat.loads(binaryData))
+
+    store = None
+    storeLoad = None
+    if importlib.util.find_spec("numpy") != None:
+        from data.componentstore import ComponentStore
+        store = ComponentStore()
+        storeLoad, _ = timed(lambda: sceneformat.loads(binaryData, ComponentStore()))
+
+    fd, path = tempfile.mkstemp(suffix=".bin")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(binaryData)
+        streamedOpen, stream = timed(lambda: openStreamed(path, store))
+        stream.close()
+    finally:
+        os.unlink(path)
+
+    rows = [("Save (s)", jsonSave, binarySave), ("Load (s)", jsonLoad, binaryLoad)]
+    if storeLoad != None:
+        rows.append(("Load, store (s)", jsonLoad, storeLoad))
+    rows.append(("Stream open (s)", jsonLoad, streamedOpen))
+
+    print("Entities:     ", count)
+    print("                %12s %12s %8s" % ("JSON", "binary", "ratio"))
+    for name, jsonValue, binaryValue in rows:
+        print("%-15s %12.3f %12.3f %7.1fx" % (name, jsonValue, binaryValue, jsonValue / binaryValue))
+    print("Size (bytes)    %12d %12d %7.1fx" % (len(jsonData), len(binaryData), len(jsonData) / len(binaryData)))
+    rows.append(("Size (bytes)", len(jsonData), len(binaryData)))
+    shortfalls = [name for name, jsonValue, binaryValue in rows if jsonValue / binaryValue < TARGET]
+    if len(shortfalls) > 0:
+        print("Below the %.0fx target: %s" % (TARGET, ", ".join(shortfalls)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# Synthetic scenes shared by the benchmarks
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from data.entity import Entity, CubeEntity, SphereEntity, MeshEntity
+
+TEAPOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "teapot.stl")
+
+# Tree of count entities under a root, mixing all the entity kinds, with random components.
+# By default every entity gets fanout children, level by level. With depth, each entity goes under a random one
+# of the entities already there which are less than depth levels deep instead.
+# With ids, the entities are numbered as Database would (the root being 1), as they are once part of a scene.
+def buildScene(count, depth=None, fanout=10, seed=0, ids=False):
+    random.seed(seed)
+    root = Entity()
+    root.name = "root"
+    entities = [root]
+    # Entities which may still receive children, with their depth
+    parents = [(root, 0)]
+    kinds = [CubeEntity, SphereEntity, lambda: MeshEntity(TEAPOT), Entity]
+    if ids:
+        root.id = 1
+    for i in range(count):
+        entity = kinds[i % len(kinds)]()
+        entity.name = "Entity " + str(i)
+        if ids:
+            entity.id = i + 2
+        entity.position = (random.uniform(-100, 100), random.uniform(-100, 100), random.uniform(-100, 100))
+        entity.rotation = (1.0, random.random(), random.random(), random.random())
+        entity.color = (random.randrange(256), random.randrange(256), random.randrange(256))
+        if depth == None:
+            entity.setParent(entities[i // fanout])
+            entities.append(entity)
+        else:
+            parent, parentDepth = random.choice(parents)
+            entity.setParent(parent)
+            if parentDepth + 1 < depth:
+                parents.append((entity, parentDepth + 1))
+    return root
@@ -0,0 +1,368 @@
+# Benchmarks of the editor's hot paths on synthetic scenes. Runs headless (QT_QPA_PLATFORM=offscreen, no GPU needed).
+# Every case is timed over a number of repeats and run once more under tracemalloc to record its peak memory.
+# Results are written as JSON, and can be compared against a previous run to flag regressions.
+#
+# Usage: python benchmarks/suite.py [--entities N] [--depth D] [--repeat R] [--filter TEXT]
+#                                    [--output results.json] [--baseline baseline.json] [--threshold 0.25] [--trace trace.json]
+# Exits with status 1 when a baseline is given and some case got slower or hungrier than the threshold allows.
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PySide2.QtWidgets import QApplication
+from PySide2.QtCore import QEvent
+from data.entity import Entity
+from data.childlist import ChildList
+from data.history import PropertyCommand
+from data.database import Database
+from data import sceneformat
+from data import stl
+from data import meshlod
+from data import tracing
+from scenes import buildScene, TEAPOT
+
+# Position one unit further along x
+def shifted(position):
+    return (position[0] + 1, position[1], position[2])
+
+# Shared state of a run: the synthetic scene, and a base cache file databases get loaded from
+class Context:
+    def __init__(self, entities, depth, useComponentStore):
+        self.entities = entities
+        self.useComponentStore = useComponentStore
+        self.directory = tempfile.mkdtemp(prefix="scene_editor_bench_")
+        self.scene = buildScene(entities, depth)
+        self.cachePath = os.path.join(self.directory, "base.bin")
+        sceneformat.saveScene(self.scene, self.cachePath)
+        self.databases = []
+        self._counter = 0
+
+    # Fresh database holding the whole synthetic scene, with its own cache file
+    def database(self):
+        self._counter += 1
+        path = os.path.join(self.directory, "cache" + str(self._counter) + ".bin")
+        shutil.copyfile(self.cachePath, path)
+        database = Database(cachePath=path, useComponentStore=self.useComponentStore)
+        database.finishLoading()
+        self.databases.append(database)
+        return database
+
+    # Entities of a database's scene, in a stable random order
+    def sample(self, database, count):
+        entities = []
+        stack = list(database.root.children)
+        while len(stack) > 0:
+            e = stack.pop()
+            entities.append(e)
+            stack.extend(e.children)
+        random.seed(1)
+        return random.sample(entities, min(count, len(entities)))
+
+    def close(self):
+        for database in self.databases:
+            database.flush()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+# Cases are generators: each next() prepares a repeat (outside of the timing) and yields the function to time.
+# Whatever comes after the loop (or in a finally) is the cleanup.
+CASES = []
+
+def case(name):
+    def register(f):
+        CASES.append((name, f))
+        return f
+    return register
+
+EDITS = 1000
+
+@case("entity.toDict")
+def toDictCase(ctx):
+    while True:
+        yield lambda: ctx.scene.toDict()
+
+@case("entity.fromDict")
+def fromDictCase(ctx):
+    d = ctx.scene.toDict()
+    while True:
+        yield lambda: Entity.fromDict(d)
+
+# Time until the top levels of the scene are there, the rest being streamed in afterwards
+@case("database.restore")
+def restoreCase(ctx):
+    while True:
+        path = os.path.join(ctx.directory, "restore.bin")
+        shutil.copyfile(ctx.cachePath, path)
+        databases = []
+        yield lambda: databases.append(Database(cachePath=path, useComponentStore=ctx.useComponentStore))
+        for database in databases:
+            database.flush()
+
+@case("database.restoreFull")
+def restoreFullCase(ctx):
+    while True:
+        path = os.path.join(ctx.directory, "restore.bin")
+        shutil.copyfile(ctx.cachePath, path)
+        databases = []
+        def restore():
+            databases.append(Database(cachePath=path, useComponentStore=ctx.useComponentStore))
+            databases[-1].finishLoading()
+        yield restore
+        for database in databases:
+            database.flush()
+
+@case("database.recordHistory")
+def recordHistoryCase(ctx):
+    database = ctx.database()
+    entities = ctx.sample(database, EDITS)
+    commands = [PropertyCommand(e, "position", e.position, (1.0, 2.0, 3.0)) for e in entities]
+    while True:
+        database.history.clear()
+        yield lambda: [database.recordHistory(c) for c in commands]
+
+@case("database.edit")
+def editCase(ctx):
+    database = ctx.database()
+    entities = ctx.sample(database, EDITS)
+    while True:
+        yield lambda: [database.entityMoved(e, (1.0, 2.0, 3.0)) for e in entities]
+
+@case("database.undo")
+def undoCase(ctx):
+    database = ctx.database()
+    entities = ctx.sample(database, EDITS)
+    while True:
+        for e in entities:
+            database.entityMoved(e, shifted(e.position))
+        yield lambda: [database.undo() for e in entities]
+
+@case("database.redo")
+def redoCase(ctx):
+    database = ctx.database()
+    entities = ctx.sample(database, EDITS)
+    while True:
+        for e in entities:
+            database.entityMoved(e, shifted(e.position))
+        for e in entities:
+            database.undo()
+        yield lambda: [database.redo() for e in entities]
+
+# Moves entities under the root (making it a wide family), then undoes the moves
+@case("database.reparent")
+def reparentCase(ctx):
+    database = ctx.database()
+    entities = ctx.sample(database, EDITS)
+    def run():
+        with database.transaction():
+            for e in entities:
+                database.entityReparented(e, database.root)
+        database.undo()
+    while True:
+        yield run
+
+# Inserts in the middle of a family as wide as the scene, as when dropping entities between siblings
+@case("childlist.insert")
+def childListInsertCase(ctx):
+    while True:
+        children = ChildList([Entity() for _ in range(ctx.entities)])
+        inserted = [Entity() for _ in range(EDITS)]
+        def run():
+            for i, e in enumerate(inserted):
+                children.insert(len(children) // 2 + i, e)
+        yield run
+
+# Full snapshot of the scene, serialized and written to disk
+@case("database.backup")
+def backupCase(ctx):
+    database = ctx.database()
+    def backup():
+        database.backup()
+        database.autosave.flush()
+    while True:
+        yield backup
+
+# Versions of the scene taken after some edits, and going back to an earlier one
+@case("database.version")
+def versionCase(ctx):
+    database = ctx.database()
+    database.version()
+    entities = ctx.sample(database, EDITS)
+    while True:
+        for e in entities:
+            database.entityMoved(e, shifted(e.position))
+        yield database.version
+
+@case("database.restoreVersion")
+def restoreVersionCase(ctx):
+    database = ctx.database()
+    entities = ctx.sample(database, EDITS)
+    while True:
+        version = database.version()
+        for e in entities:
+            database.entityMoved(e, shifted(e.position))
+        yield lambda: database.restoreVersion(version)
+
+# Name searches as typed in the hierarchy filter, each after a rename so the index can't just return cached work
+@case("database.findEntities")
+def findEntitiesCase(ctx):
+    database = ctx.database()
+    entity = ctx.sample(database, 1)[0]
+    queries = ["E", "En", "Entity 1", "ity 12", "7"]
+    i = 0
+    while True:
+        i += 1
+        database.entityRenamed(entity, "Renamed " + str(i))
+        yield lambda: [database.findEntities(q, 1000) for q in queries]
+
+# Simplification of the teapot into its LOD chain, as done once per asset
+@case("meshlod.buildChain")
+def buildChainCase(ctx):
+    welded = stl.weld(stl.load(TEAPOT))
+    while True:
+        yield lambda: meshlod.buildChain(welded)
+
+# What a mesh whose chain was built already costs to get back
+@case("meshlod.cachedChain")
+def cachedChainCase(ctx):
+    directory = os.path.join(ctx.directory, "mesh_lods")
+    meshlod.loadChain(TEAPOT, directory)
+    while True:
+        yield lambda: meshlod.cachedChain(TEAPOT, directory)
+
+@case("hierarchy.refreshHierarchy")
+def refreshHierarchyCase(ctx):
+    from widgets.hierarchy import Hierarchy
+    database = ctx.database()
+    hierarchy = Hierarchy(database)
+    try:
+        while True:
+            yield hierarchy.refreshHierarchy
+    finally:
+        hierarchy.deleteLater()
+
+# Creation of the 3D nodes of the whole scene
+@case("view.load")
+def viewLoadCase(ctx):
+    from widgets.view import View
+    database = ctx.database()
+    views = []
+    while True:
+        yield lambda: views.append(View(database))
+        for view in views:
+            view.deleteLater()
+        QApplication.sendPostedEvents(None, QEvent.DeferredDelete)
+        views = []
+
+# Undo and redo with a view following the changes
+@case("view.undoRedo")
+def viewUndoRedoCase(ctx):
+    from widgets.view import View
+    database = ctx.database()
+    view = View(database)
+    entities = ctx.sample(database, EDITS)
+    try:
+        while True:
+            for e in entities:
+                database.entityMoved(e, shifted(e.position))
+            yield lambda: ([database.undo() for e in entities], [database.redo() for e in entities])
+    finally:
+        view.deleteLater()
+
+def measure(factory, ctx, repeats):
+    runs = factory(ctx)
+    try:
+        times = []
+        for i in range(repeats):
+            f = next(runs)
+            start = time.perf_counter()
+            f()
+            times.append(time.perf_counter() - start)
+        # Peak memory comes from a separate run, tracing allocations slows everything down
+        f = next(runs)
+        tracemalloc.start()
+        f()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        runs.close()
+    return {"seconds": statistics.median(times), "min": min(times), "max": max(times), "repeats": repeats, "peakBytes": peak}
+
+# Cases slower or using more memory than the baseline by more than threshold (relative), as (name, metric, ratio) tuples
+def regressions(results, baseline, threshold):
+    found = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference == None:
+            continue
+        for metric in ("seconds", "peakBytes"):
+            if reference[metric] > 0 and result[metric] / reference[metric] > 1 + threshold:
+                found.append((name, metric, result[metric] / reference[metric]))
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the scene editor's hot paths")
+    parser.add_argument("--entities", type=int, default=10000)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default="", help="only run the cases whose name contains this text")
+    parser.add_argument("--no-store", action="store_true", help="don't use the NumPy component store")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.25, help="relative slowdown flagged as a regression")
+    parser.add_argument("--trace", metavar="PATH", help="also record a Chrome trace of the run (timings then include the tracing overhead)")
+    args = parser.parse_args()
+    if args.trace != None:
+        tracing.enable()
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    useComponentStore = not args.no_store and importlib.util.find_spec("numpy") != None
+    ctx = Context(args.entities, args.depth, useComponentStore)
+
+    results = {}
+    try:
+        for name, factory in CASES:
+            if args.filter not in name:
+                continue
+            results[name] = measure(factory, ctx, args.repeat)
+            r = results[name]
+            print("%-28s %10.4f s  (min %.4f, max %.4f)  peak %8.1f MiB" % (name, r["seconds"], r["min"], r["max"], r["peakBytes"] / 1048576))
+    finally:
+        ctx.close()
+    if args.trace != None:
+        tracing.exportChromeTrace(args.trace)
+
+    report = {
+        "meta": {"entities": args.entities, "depth": args.depth, "repeat": args.repeat, "componentStore": useComponentStore,
+            "python": platform.python_version(), "platform": platform.platform(), "date": datetime.datetime.now().isoformat()},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to", args.output)
+
+    if args.baseline != None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"]["entities"] != args.entities or baseline["meta"]["depth"] != args.depth:
+            print("Warning: the baseline was measured on a different scene")
+        found = regressions(results, baseline["results"], args.threshold)
+        for name, metric, ratio in found:
+            print("REGRESSION %-28s %-10s %.2fx the baseline" % (name, metric, ratio))
+        if len(found) > 0:
+            sys.exit(1)
+        print("No regressions against", args.baseline)
+
+if __name__ == "__main__":
+    main()
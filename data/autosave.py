@@ -0,0 +1,187 @@
+import collections
+import logging
+import os
+import threading
+import time
+from PySide2 import QtCore
+from data.journal import headerRecord
+from data import tracing
+
+logger = logging.getLogger(__name__)
+
+# Keeps the scene cache on disk up to date without doing any disk I/O on the GUI thread.
+#
+# The cache is a base snapshot plus an append-only journal of edits (see data/journal.py).
+# Every edit appends one small record to the journal. Once the journal grows past compactionThreshold bytes
+# (or when a snapshot is requested explicitly), a new base snapshot is written and the journal starts over.
+# Snapshot requests are coalesced: the snapshot is taken once no request arrived for quietPeriod milliseconds,
+# or at the latest maxLatency milliseconds after the first one.
+#
+# Snapshots are taken on the GUI thread and handed to a writer thread, which serializes them and replaces
+# the base atomically (temporary file + rename). Each base carries a generation number and the journal header
+# names the generation it applies to, so a crash between writing the base and resetting the journal never
+# results in edits being applied twice.
+#
+# Journal records queued before a snapshot are only dropped once the new base is on disk. Should writing it fail,
+# they are appended to the journal of the current base after all, and another snapshot is scheduled.
+class AutosaveWriter(QtCore.QObject):
+    # Emitted by the writer thread when a new base couldn't be written
+    _baseFailedSignal = QtCore.Signal()
+
+    def __init__(self, path, journalPath, snapshot, serialize, generation=0, journalLength=0,
+                 quietPeriod=500, maxLatency=2000, compactionThreshold=4 * 1024 * 1024, parent=None):
+        super(AutosaveWriter, self).__init__(parent)
+        self.path = path
+        self.journalPath = journalPath
+        # Called on the GUI thread. Must return data that won't be mutated by later edits.
+        self.snapshot = snapshot
+        # Called on the writer thread with a snapshot and its generation. Returns the bytes of the base file.
+        self.serialize = serialize
+        self.quietPeriod = quietPeriod
+        self.maxLatency = maxLatency
+        self.compactionThreshold = compactionThreshold
+
+        self.generation = generation
+        self._journalBytes = journalLength
+        self._dirtySince = None
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._submit)
+
+        self._condition = threading.Condition()
+        self._queue = collections.deque()
+        self._writing = False
+        self._closed = False
+        # Only touched by the writer thread
+        self._journalFile = None
+        # Size of the intact part of an existing journal for this generation, 0 if it has to be started over
+        self._journalLength = journalLength
+        self._journalGeneration = generation
+        self._baseFailedSignal.connect(self.markDirty)
+        self._thread = threading.Thread(target=self._run, name="autosave", daemon=True)
+        self._thread.start()
+
+    # Appends encoded journal records. Cheap enough to be called after every single edit.
+    def append(self, data):
+        with self._condition:
+            self._queue.append(("append", data))
+            self._condition.notify_all()
+        self._journalBytes += len(data)
+        if self._journalBytes > self.compactionThreshold:
+            self.markDirty()
+
+    # Schedules a new base snapshot
+    def markDirty(self):
+        now = time.monotonic()
+        if self._dirtySince == None:
+            self._dirtySince = now
+        remaining = self.maxLatency - (now - self._dirtySince) * 1000
+        self._timer.start(max(0, int(min(self.quietPeriod, remaining))))
+
+    # Takes the snapshot and passes it to the writer thread
+    def _submit(self):
+        if self._dirtySince == None:
+            return
+        self._dirtySince = None
+        self._timer.stop()
+        snapshot = self.snapshot()
+        self.generation += 1
+        self._journalBytes = 0
+        with self._condition:
+            # The snapshot contains every edit made so far, so anything still queued is superseded by it (see _run)
+            self._queue.append(("snapshot", snapshot, self.generation))
+            self._condition.notify_all()
+
+    # Writes any pending changes and blocks until they are on disk
+    def flush(self):
+        self._submit()
+        with self._condition:
+            while len(self._queue) > 0 or self._writing:
+                self._condition.wait()
+
+    # Flushes and stops the writer thread. Meant to be called on exit.
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._queue) == 0 and not self._closed:
+                    self._condition.wait()
+                if len(self._queue) == 0:
+                    break
+                # The latest snapshot is taken along with everything queued before it, which it supersedes.
+                # Otherwise consecutive appends are written together.
+                snapshots = [i for i, item in enumerate(self._queue) if item[0] == "snapshot"]
+                if len(snapshots) > 0:
+                    items = [self._queue.popleft() for _ in range(snapshots[-1] + 1)]
+                else:
+                    items = list(self._queue)
+                    self._queue.clear()
+                self._writing = True
+            try:
+                if items[-1][0] == "append":
+                    with tracing.span("AutosaveWriter.appendToJournal", "io", {"records": len(items)}):
+                        self._appendToJournal(b"".join(item[1] for item in items))
+                else:
+                    self._writeSnapshot(items)
+            except Exception as e:
+                logger.error("Autosave failed: %s", e)
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+        if self._journalFile != None:
+            self._journalFile.close()
+
+    # Writes the snapshot ending items as the new base. Should that fail, the journal records it was to supersede are kept.
+    def _writeSnapshot(self, items):
+        _, snapshot, generation = items[-1]
+        try:
+            data = self.serialize(snapshot, generation)
+            with tracing.span("AutosaveWriter.writeBase", "io", {"bytes": len(data)}):
+                self._writeBase(data, generation)
+        except Exception as e:
+            logger.error("Autosave failed to write a new base, keeping the journal: %s", e)
+            self._baseFailedSignal.emit()
+            superseded = [item[1] for item in items if item[0] == "append"]
+            if len(superseded) > 0:
+                self._appendToJournal(b"".join(superseded))
+
+    def _appendToJournal(self, data):
+        if self._journalFile == None:
+            if self._journalLength == 0:
+                self._resetJournal(self._journalGeneration)
+            self._journalFile = open(self.journalPath, "ab")
+            # Drops a damaged tail left behind by a crash
+            self._journalFile.truncate(self._journalLength)
+        self._journalFile.write(data)
+        self._journalFile.flush()
+        os.fsync(self._journalFile.fileno())
+
+    def _writeBase(self, data, generation):
+        self._replaceFile(self.path, data)
+        if self._journalFile != None:
+            self._journalFile.close()
+            self._journalFile = None
+        self._resetJournal(generation)
+
+    def _resetJournal(self, generation):
+        header = headerRecord(generation)
+        self._replaceFile(self.journalPath, header)
+        self._journalLength = len(header)
+        self._journalGeneration = generation
+
+    def _replaceFile(self, path, data):
+        temporaryPath = path + ".tmp"
+        with open(temporaryPath, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporaryPath, path)
@@ -0,0 +1,342 @@
+import heapq
+import math
+
+# Dynamic bounding volume hierarchy over axis aligned boxes, following the dynamic AABB tree of Box2D.
+# Leaves hold items along with a slightly enlarged ("fat") box, so that small movements don't require touching the tree.
+# Insertion picks the sibling by the surface area heuristic and the tree is kept balanced by rotations,
+# which keeps updates and queries logarithmic in the number of items.
+#
+# Boxes are (min x, min y, min z, max x, max y, max z) tuples. Frustum planes are (a, b, c, d) tuples with
+# a * x + b * y + c * z + d >= 0 on the inside.
+
+class _Node:
+    __slots__ = ("box", "parent", "left", "right", "item", "height")
+
+    def __init__(self, box, item=None):
+        self.box = box
+        self.parent = None
+        self.left = None
+        self.right = None
+        self.item = item
+        self.height = 0
+
+    def isLeaf(self):
+        return self.left == None
+
+def union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3]), max(a[4], b[4]), max(a[5], b[5]))
+
+def contains(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] <= inner[2] and
+            outer[3] >= inner[3] and outer[4] >= inner[4] and outer[5] >= inner[5])
+
+def overlaps(a, b):
+    return (a[0] <= b[3] and a[3] >= b[0] and a[1] <= b[4] and a[4] >= b[1] and a[2] <= b[5] and a[5] >= b[2])
+
+def area(box):
+    dx = box[3] - box[0]
+    dy = box[4] - box[1]
+    dz = box[5] - box[2]
+    return 2 * (dx * dy + dy * dz + dz * dx)
+
+# Distance along the ray at which it enters the box, or None if it misses it (slab test).
+# inverse holds 1 / direction per axis (infinite for zero components).
+def rayBox(origin, inverse, box, maxDistance):
+    near = 0.0
+    far = maxDistance
+    for i in range(3):
+        if math.isinf(inverse[i]):
+            if origin[i] < box[i] or origin[i] > box[i + 3]:
+                return None
+            continue
+        t1 = (box[i] - origin[i]) * inverse[i]
+        t2 = (box[i + 3] - origin[i]) * inverse[i]
+        if t1 > t2:
+            t1, t2 = t2, t1
+        if t1 > near:
+            near = t1
+        if t2 < far:
+            far = t2
+        if near > far:
+            return None
+    return near
+
+# -1 if the box is fully outside the frustum, 1 if fully inside, 0 if it crosses its boundary
+def classifyBox(planes, box):
+    result = 1
+    for a, b, c, d in planes:
+        # Corner furthest along the plane normal, and the one furthest against it
+        px = box[3] if a >= 0 else box[0]
+        py = box[4] if b >= 0 else box[1]
+        pz = box[5] if c >= 0 else box[2]
+        if a * px + b * py + c * pz + d < 0:
+            return -1
+        nx = box[0] if a >= 0 else box[3]
+        ny = box[1] if b >= 0 else box[4]
+        nz = box[2] if c >= 0 else box[5]
+        if a * nx + b * ny + c * nz + d < 0:
+            result = 0
+    return result
+
+def distanceSquaredToBox(point, box):
+    d = 0.0
+    for i in range(3):
+        if point[i] < box[i]:
+            d += (box[i] - point[i]) ** 2
+        elif point[i] > box[i + 3]:
+            d += (point[i] - box[i + 3]) ** 2
+    return d
+
+class DynamicBvh:
+    def __init__(self, margin=0.1):
+        # How much leaf boxes are enlarged by
+        self.margin = margin
+        self.root = None
+        # item -> leaf node
+        self.leaves = {}
+
+    def __len__(self):
+        return len(self.leaves)
+
+    def __contains__(self, item):
+        return item in self.leaves
+
+    def _fatten(self, box):
+        m = self.margin
+        return (box[0] - m, box[1] - m, box[2] - m, box[3] + m, box[4] + m, box[5] + m)
+
+    # Inserts an item, or updates its box if it is already in the tree
+    def update(self, item, box):
+        leaf = self.leaves.get(item)
+        if leaf != None:
+            if contains(leaf.box, box):
+                return
+            self._removeLeaf(leaf)
+            leaf.box = self._fatten(box)
+        else:
+            leaf = _Node(self._fatten(box), item)
+            self.leaves[item] = leaf
+        self._insertLeaf(leaf)
+
+    def remove(self, item):
+        leaf = self.leaves.pop(item, None)
+        if leaf != None:
+            self._removeLeaf(leaf)
+
+    def box(self, item):
+        return self.leaves[item].box
+
+    def _insertLeaf(self, leaf):
+        if self.root == None:
+            self.root = leaf
+            leaf.parent = None
+            return
+
+        # Find the best sibling
+        box = leaf.box
+        node = self.root
+        while not node.isLeaf():
+            combinedArea = area(union(node.box, box))
+            # Cost of making a new parent for this node and the leaf
+            cost = 2 * combinedArea
+            # Minimum cost of pushing the leaf further down
+            inheritance = 2 * (combinedArea - area(node.box))
+            costLeft = self._descendCost(node.left, box) + inheritance
+            costRight = self._descendCost(node.right, box) + inheritance
+            if cost < costLeft and cost < costRight:
+                break
+            node = node.left if costLeft < costRight else node.right
+
+        sibling = node
+        oldParent = sibling.parent
+        parent = _Node(union(box, sibling.box))
+        parent.parent = oldParent
+        parent.height = sibling.height + 1
+        parent.left = sibling
+        parent.right = leaf
+        sibling.parent = parent
+        leaf.parent = parent
+        if oldParent == None:
+            self.root = parent
+        elif oldParent.left is sibling:
+            oldParent.left = parent
+        else:
+            oldParent.right = parent
+
+        self._refit(leaf.parent)
+
+    def _descendCost(self, node, box):
+        if node.isLeaf():
+            return area(union(node.box, box))
+        return area(union(node.box, box)) - area(node.box)
+
+    def _removeLeaf(self, leaf):
+        if leaf is self.root:
+            self.root = None
+            return
+        parent = leaf.parent
+        grandparent = parent.parent
+        sibling = parent.right if parent.left is leaf else parent.left
+        if grandparent == None:
+            self.root = sibling
+            sibling.parent = None
+        else:
+            if grandparent.left is parent:
+                grandparent.left = sibling
+            else:
+                grandparent.right = sibling
+            sibling.parent = grandparent
+            self._refit(grandparent)
+        leaf.parent = None
+
+    # Walks up from node, rebalancing and fixing boxes and heights
+    def _refit(self, node):
+        while node != None:
+            node = self._balance(node)
+            node.height = 1 + max(node.left.height, node.right.height)
+            node.box = union(node.left.box, node.right.box)
+            node = node.parent
+
+    # Performs a left or right rotation if node is imbalanced. Returns the new root of the subtree.
+    def _balance(self, a):
+        if a.isLeaf() or a.height < 2:
+            return a
+        b = a.left
+        c = a.right
+        balance = c.height - b.height
+        if balance > 1:
+            return self._rotate(a, c, b, True)
+        if balance < -1:
+            return self._rotate(a, b, c, False)
+        return a
+
+    # Promotes child (the taller child of a) above a. other is a's other child.
+    def _rotate(self, a, child, other, childIsRight):
+        f = child.left
+        g = child.right
+        child.left = a
+        child.parent = a.parent
+        a.parent = child
+        if child.parent == None:
+            self.root = child
+        elif child.parent.left is a:
+            child.parent.left = child
+        else:
+            child.parent.right = child
+
+        # Keep the taller grandchild under child, the other one goes to a
+        if f.height > g.height:
+            child.right = f
+            kept, moved = f, g
+        else:
+            child.right = g
+            kept, moved = g, f
+        if childIsRight:
+            a.right = moved
+        else:
+            a.left = moved
+        moved.parent = a
+        a.box = union(other.box, moved.box)
+        a.height = 1 + max(other.height, moved.height)
+        child.box = union(a.box, kept.box)
+        child.height = 1 + max(a.height, kept.height)
+        return child
+
+    # Items whose boxes overlap box
+    def queryBox(self, box):
+        result = []
+        stack = [self.root] if self.root != None else []
+        while len(stack) > 0:
+            node = stack.pop()
+            if not overlaps(node.box, box):
+                continue
+            if node.isLeaf():
+                result.append(node.item)
+            else:
+                stack.append(node.left)
+                stack.append(node.right)
+        return result
+
+    # Items whose boxes are at least partially inside the frustum
+    def queryFrustum(self, planes):
+        result = []
+        stack = [self.root] if self.root != None else []
+        while len(stack) > 0:
+            node = stack.pop()
+            c = classifyBox(planes, node.box)
+            if c < 0:
+                continue
+            if c > 0:
+                # Fully inside, no need to test anything below
+                self._collect(node, result)
+            elif node.isLeaf():
+                result.append(node.item)
+            else:
+                stack.append(node.left)
+                stack.append(node.right)
+        return result
+
+    def _collect(self, node, result):
+        stack = [node]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.isLeaf():
+                result.append(node.item)
+            else:
+                stack.append(node.left)
+                stack.append(node.right)
+
+    # Closest item hit by the ray, as (item, distance), or (None, None).
+    # hitTest(item, origin, direction) refines the hit against the item's actual shape and returns a distance or None;
+    # without it the leaf boxes are used.
+    def raycast(self, origin, direction, hitTest=None, maxDistance=math.inf):
+        inverse = tuple(1.0 / d if d != 0 else math.inf for d in direction)
+        best = None
+        bestDistance = maxDistance
+        # Closest boxes first, and anything further than the best hit so far is skipped
+        heap = []
+        counter = 0
+        if self.root != None:
+            t = rayBox(origin, inverse, self.root.box, bestDistance)
+            if t != None:
+                heap.append((t, counter, self.root))
+        while len(heap) > 0:
+            t, _, node = heapq.heappop(heap)
+            if t > bestDistance:
+                break
+            if node.isLeaf():
+                distance = hitTest(node.item, origin, direction) if hitTest != None else t
+                if distance != None and distance < bestDistance:
+                    best = node.item
+                    bestDistance = distance
+                continue
+            for child in (node.left, node.right):
+                tc = rayBox(origin, inverse, child.box, bestDistance)
+                if tc != None:
+                    counter += 1
+                    heapq.heappush(heap, (tc, counter, child))
+        return (best, bestDistance if best != None else None)
+
+    # Item closest to point, as (item, distance), or (None, None).
+    # distance(item, point) may refine the distance to the item, by default the distance to its leaf box is used.
+    def nearest(self, point, distance=None):
+        best = None
+        bestDistance = math.inf
+        heap = []
+        counter = 0
+        if self.root != None:
+            heap.append((distanceSquaredToBox(point, self.root.box), counter, self.root))
+        while len(heap) > 0:
+            d, _, node = heapq.heappop(heap)
+            if d >= bestDistance * bestDistance:
+                break
+            if node.isLeaf():
+                exact = distance(node.item, point) if distance != None else math.sqrt(d)
+                if exact < bestDistance:
+                    best = node.item
+                    bestDistance = exact
+                continue
+            for child in (node.left, node.right):
+                counter += 1
+                heapq.heappush(heap, (distanceSquaredToBox(point, child.box), counter, child))
+        return (best, bestDistance if best != None else None)
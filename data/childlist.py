@@ -0,0 +1,203 @@
+# Ordered list of the children of an entity, with cheap removal, position lookup and insertion.
+#
+# Children are kept in blocks of at most 2 * blockSize of them, in order, and a Fenwick tree over the blocks counts
+# the children before any block. Each child knows its block, and each block its position among the blocks.
+# So [] takes O(log n), and index(), remove() and insert() at any position O(log n) plus a scan or shift within
+# a single block (done by list itself, in C) - instead of shifting and scanning the whole family, which made emptying
+# or filling a wide family child by child quadratic. Appending takes O(log n) as well.
+# A block which outgrows 2 * blockSize gets split in two and an emptied block is dropped, which renumbers
+# the blocks after it: O(n / blockSize), once per blockSize insertions or removals at most. When removals leave
+# many small blocks behind, the blocks are rebuilt, which is amortized over those removals.
+#
+# Supports the read-only part of the list interface, plus append, insert and remove.
+#
+# Most entities are leaves, so empty lists share immutable placeholders and only get their own containers once
+# a child is added. Entities without any children share a single list, EMPTY, which Entity.setParent replaces
+# with their own once they get one.
+_NO_BLOCKS = ()
+_NO_TREE = (0,)
+_NO_CHILDREN = {}
+
+class _Block:
+    __slots__ = ("children", "position")
+
+    def __init__(self, children, position):
+        self.children = children
+        self.position = position
+
+class ChildList:
+    __slots__ = ("_blocks", "_tree", "_blockOf", "_count")
+
+    blockSize = 256
+
+    def __init__(self, children=None):
+        if children != None:
+            children = list(children)
+        if children == None or len(children) == 0:
+            self._blocks = _NO_BLOCKS
+            self._tree = _NO_TREE
+            self._blockOf = _NO_CHILDREN
+            self._count = 0
+        else:
+            self._build(children)
+
+    def _build(self, children):
+        size = ChildList.blockSize
+        self._blocks = [_Block(children[i:i + size], i // size) for i in range(0, len(children), size)]
+        # Block of each child
+        self._blockOf = {c: b for b in self._blocks for c in b.children}
+        self._count = len(children)
+        self._buildTree()
+
+    # Fenwick tree (1-based) of the number of children per block
+    def _buildTree(self):
+        tree = [0] + [len(b.children) for b in self._blocks]
+        for i in range(1, len(tree)):
+            j = i + (i & -i)
+            if j < len(tree):
+                tree[j] += tree[i]
+        self._tree = tree
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for b in self._blocks:
+            yield from b.children
+
+    def __reversed__(self):
+        for b in reversed(self._blocks):
+            yield from reversed(b.children)
+
+    def __contains__(self, child):
+        return child in self._blockOf
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        if i < 0:
+            i += self._count
+        if i < 0 or i >= self._count:
+            raise IndexError("child index out of range")
+        position, offset = self._find(i)
+        return self._blocks[position].children[offset]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "ChildList(" + repr(list(self)) + ")"
+
+    def index(self, child):
+        block = self._blockOf.get(child)
+        if block == None:
+            raise ValueError("not a child")
+        return self._prefix(block.position - 1) + block.children.index(child)
+
+    def append(self, child):
+        if self._blocks is _NO_BLOCKS:
+            self._build([child])
+            return
+        block = self._blocks[-1]
+        if len(block.children) >= ChildList.blockSize:
+            block = _Block([], len(self._blocks))
+            self._blocks.append(block)
+            # The new node covers the blocks since its lowest set bit, itself included
+            i = block.position + 1
+            self._tree.append(self._prefix(block.position - 1) - self._prefix(i - (i & -i) - 1))
+        block.children.append(child)
+        self._blockOf[child] = block
+        self._add(block.position, 1)
+        self._count += 1
+
+    def insert(self, index, child):
+        if index < 0:
+            index = max(0, index + self._count)
+        if index >= self._count:
+            self.append(child)
+            return
+        position, offset = self._find(index)
+        block = self._blocks[position]
+        block.children.insert(offset, child)
+        self._blockOf[child] = block
+        self._add(position, 1)
+        self._count += 1
+        if len(block.children) > 2 * ChildList.blockSize:
+            self._split(block)
+
+    def remove(self, child):
+        block = self._blockOf.pop(child, None)
+        if block == None:
+            raise ValueError("not a child")
+        block.children.remove(child)
+        self._count -= 1
+        if len(block.children) > 0:
+            self._add(block.position, -1)
+        elif self._count == 0:
+            self._blocks = _NO_BLOCKS
+            self._tree = _NO_TREE
+            self._blockOf = _NO_CHILDREN
+        else:
+            del self._blocks[block.position]
+            self._renumber(block.position)
+        # Mostly small blocks left, after removals all over the family
+        if len(self._blocks) > 2 * (self._count // ChildList.blockSize) + 8:
+            self._build(list(self))
+
+    def _split(self, block):
+        half = len(block.children) // 2
+        newBlock = _Block(block.children[half:], block.position + 1)
+        del block.children[half:]
+        for c in newBlock.children:
+            self._blockOf[c] = newBlock
+        self._blocks.insert(newBlock.position, newBlock)
+        self._renumber(newBlock.position)
+
+    # Positions of the blocks from position on, and the tree, after a block was added or removed there
+    def _renumber(self, position):
+        blocks = self._blocks
+        for i in range(position, len(blocks)):
+            blocks[i].position = i
+        self._buildTree()
+
+    # Number of children in the blocks up to and including the one at position
+    def _prefix(self, position):
+        total = 0
+        i = position + 1
+        tree = self._tree
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def _add(self, position, delta):
+        i = position + 1
+        tree = self._tree
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    # Position of the block holding the child at the given index, and the child's offset within the block
+    def _find(self, index):
+        tree = self._tree
+        position = 0
+        remaining = index
+        step = 1 << (len(tree) - 1).bit_length()
+        while step > 0:
+            next = position + step
+            if next < len(tree) and tree[next] <= remaining:
+                position = next
+                remaining -= tree[next]
+            step >>= 1
+        return (position, remaining)
+
+class _EmptyChildList(ChildList):
+    __slots__ = ()
+
+    def append(self, child):
+        raise TypeError("The shared empty child list can't be modified")
+
+    def insert(self, index, child):
+        raise TypeError("The shared empty child list can't be modified")
+
+EMPTY = _EmptyChildList()
@@ -0,0 +1,175 @@
+import weakref
+import numpy
+
+# Columnar (struct-of-arrays) storage for the per-entity components: transforms, colors and shape parameters.
+# Every entity bound to the store owns one row, which stays the same for the entity's whole lifetime.
+# The entity's attributes then become thin views over that row (see Entity), while bulk operations
+# (serialization, culling, batch edits...) can work on whole columns at once.
+#
+# Requires NumPy, which is an optional dependency - Database only creates a store when asked to.
+class ComponentStore:
+    def __init__(self, capacity=1024):
+        self.positions = numpy.zeros((capacity, 3), numpy.float32)
+        # (scalar, x, y, z)
+        self.rotations = numpy.zeros((capacity, 4), numpy.float32)
+        self.colors = numpy.full((capacity, 3), 255, numpy.uint8)
+        # Cube dimensions, or the sphere radius in the first column
+        self.shapes = numpy.zeros((capacity, 3), numpy.float32)
+        self._free = []
+        self._used = 0
+        # Row of every bound entity, keyed by a weak reference to it. Cheaper than a weakref.finalize per entity.
+        self._rows = {}
+
+    def __len__(self):
+        return self._used - len(self._free)
+
+    def allocate(self):
+        if len(self._free) > 0:
+            return self._free.pop()
+        if self._used == len(self.positions):
+            self._grow(self._used + 1)
+        self._used += 1
+        return self._used - 1
+
+    # Allocates count consecutive rows, returns them as an array
+    def allocateBlock(self, count):
+        if self._used + count > len(self.positions):
+            self._grow(self._used + count)
+        rows = numpy.arange(self._used, self._used + count)
+        self._used += count
+        return rows
+
+    def release(self, row):
+        self._free.append(row)
+
+    def _grow(self, minimum):
+        capacity = max(minimum, len(self.positions) * 2)
+        for name in ("positions", "rotations", "colors", "shapes"):
+            old = getattr(self, name)
+            new = numpy.zeros((capacity,) + old.shape[1:], old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    # Moves the components of an entity (and its subtree) into the store
+    def bind(self, entity):
+        if entity._store != self:
+            values = {name: getattr(entity, name) for name in entity._components}
+            self.adopt(entity, self.allocate())
+            for name, value in values.items():
+                setattr(entity, name, value)
+                # The row holds the value now
+                setattr(entity, "_" + name, None)
+        for c in entity.children:
+            self.bind(c)
+
+    # Makes an entity use a row whose contents were already filled in
+    def adopt(self, entity, row):
+        entity._store = self
+        entity._row = row
+        # Give the row back once the entity is gone
+        self._rows[weakref.ref(entity, self._collected)] = row
+
+    def _collected(self, reference):
+        self.release(self._rows.pop(reference))
+
+    # Per-entity access, used by the Entity attributes
+    def read(self, name, row):
+        if name == "position":
+            return tuple(self.positions[row].tolist())
+        elif name == "rotation":
+            return tuple(self.rotations[row].tolist())
+        elif name == "color":
+            return tuple(self.colors[row].tolist())
+        elif name == "dimensions":
+            return tuple(self.shapes[row].tolist())
+        elif name == "radius":
+            return float(self.shapes[row, 0])
+        else:
+            raise Exception("Trying to read an unknown component " + name)
+
+    def write(self, name, row, value):
+        if name == "position":
+            self.positions[row] = value
+        elif name == "rotation":
+            self.rotations[row] = value
+        elif name == "color":
+            self.colors[row] = value
+        elif name == "dimensions":
+            self.shapes[row] = value
+        elif name == "radius":
+            self.shapes[row, 0] = value
+        else:
+            raise Exception("Trying to write an unknown component " + name)
+
+    # Bulk access by rows. Values are arrays (or anything NumPy can turn into one) of matching length.
+    def rowsOf(self, entities):
+        return numpy.fromiter((e._row for e in entities), numpy.int64, len(entities))
+
+    def column(self, name):
+        if name == "position":
+            return self.positions
+        elif name == "rotation":
+            return self.rotations
+        elif name == "color":
+            return self.colors
+        elif name == "dimensions" or name == "radius":
+            return self.shapes
+        else:
+            raise Exception("Unknown component " + name)
+
+    def gather(self, name, rows):
+        if name == "radius":
+            return self.shapes[rows, 0]
+        return self.column(name)[rows]
+
+    def scatter(self, name, rows, values):
+        if name == "radius":
+            self.shapes[rows, 0] = values
+        else:
+            self.column(name)[rows] = values
+
+    # Computes the world transforms (see Entity.worldTransform) of many entities at once. Entities are processed in waves:
+    # all the ones whose parent transform is known get their transform composed column-wise in a single pass.
+    # Entities under a dirty ancestor which isn't part of the batch are left to be computed lazily.
+    def updateWorldTransforms(self, entities):
+        pending = [e for e in entities if e._world == None and e._store is self]
+        while len(pending) > 0:
+            ready = []
+            waiting = []
+            for e in pending:
+                parent = e.getParent()
+                if parent != None and parent._world == None and parent.getParent() == None:
+                    # The scene root is the world's origin
+                    parent.worldTransform()
+                if parent != None and parent._world != None:
+                    ready.append(e)
+                elif parent == None:
+                    e.worldTransform()
+                else:
+                    waiting.append(e)
+            if len(ready) == 0:
+                break
+            self._composeWorldTransforms(ready)
+            pending = waiting
+
+    def _composeWorldTransforms(self, entities):
+        rows = self.rowsOf(entities)
+        w, x, y, z = self.rotations[rows].astype(numpy.float64).T
+        # Same formula as transform.quaternionMatrix
+        local = numpy.empty((len(rows), 3, 3))
+        local[:, 0, 0] = 1 - 2 * (y * y + z * z)
+        local[:, 0, 1] = 2 * (x * y - w * z)
+        local[:, 0, 2] = 2 * (x * z + w * y)
+        local[:, 1, 0] = 2 * (x * y + w * z)
+        local[:, 1, 1] = 1 - 2 * (x * x + z * z)
+        local[:, 1, 2] = 2 * (y * z - w * x)
+        local[:, 2, 0] = 2 * (x * z - w * y)
+        local[:, 2, 1] = 2 * (y * z + w * x)
+        local[:, 2, 2] = 1 - 2 * (x * x + y * y)
+        parents = [e.getParent()._world for e in entities]
+        parentMatrices = numpy.array([p[0] for p in parents]).reshape(-1, 3, 3)
+        parentTranslations = numpy.array([p[1] for p in parents])
+        matrices = numpy.matmul(parentMatrices, local).reshape(-1, 9).tolist()
+        translations = (numpy.einsum("nij,nj->ni", parentMatrices, self.positions[rows]) + parentTranslations).tolist()
+        for e, m, t in zip(entities, matrices, translations):
+            e._world = (tuple(m), tuple(t))
@@ -1,9 +1,20 @@
-import pickle
-import json
+import contextlib
+import logging
 import os
+import struct
 from data.entity import Entity
+from data import sceneformat
+from data import versions
+from data import tracing
+from data.streaming import SceneStream, isStreamable
+from data.nameindex import NameIndex
+from data.autosave import AutosaveWriter
+from data.journal import readJournal, encodeRecord, encodeProperty, decodeProperty
+from data.history import PropertyCommand, CreateCommand, DestroyCommand, ReparentCommand, CompositeCommand, BatchCommand
+from data.historystore import HistoryStore
 from PySide2 import QtCore
-from PySide2.QtGui import QVector3D, QColor, QQuaternion
+
+logger = logging.getLogger(__name__)
 
 class Database(QtCore.QObject):
 
@@ -14,150 +25,739 @@ class Database(QtCore.QObject):
     onOrbitCameraSignal = QtCore.Signal()
 
     onEntitySelectedSignal = QtCore.Signal()
+    # Emitted right before an entity (and its subtree) gets removed from the tree, for models which need its old position
+    onEntityAboutToBeDestroyedSignal = QtCore.Signal(Entity)
     onEntityDestroyedSignal = QtCore.Signal(Entity)
     onEntityCreatedSignal = QtCore.Signal(Entity)
+    # Emitted right before and right after an entity (and its subtree) moves, with its new parent and position among its children
+    onEntityAboutToBeReparentedSignal = QtCore.Signal(Entity, Entity, int)
+    onEntityReparentedSignal = QtCore.Signal(Entity)
     onEntityRenamedSignal = QtCore.Signal(Entity, str)
-    onEntityMovedSignal = QtCore.Signal(Entity, QVector3D)
-    onEntityRotatedSignal = QtCore.Signal(Entity, QQuaternion)
-    onEntityColorChangedSignal = QtCore.Signal(Entity, QColor)
-    onEntityCubeDimensionsChangedSignal = QtCore.Signal(Entity, QVector3D)
+    # Component values are tuples, see Entity
+    onEntityMovedSignal = QtCore.Signal(Entity, object)
+    onEntityRotatedSignal = QtCore.Signal(Entity, object)
+    onEntityColorChangedSignal = QtCore.Signal(Entity, object)
+    onEntityCubeDimensionsChangedSignal = QtCore.Signal(Entity, object)
     onEntitySphereDimensionsChangedSignal = QtCore.Signal(Entity, float)
+    # Emitted once per bulk change, with a dict mapping each changed attribute to the list of entities it changed for
+    onEntitiesChangedSignal = QtCore.Signal(object)
+    # Emitted when the children of an entity got loaded from a streamed scene file (see data/streaming.py)
+    onEntityChildrenLoadedSignal = QtCore.Signal(Entity)
+    # Emitted while a streamed scene file is being loaded, with the number of entities loaded so far and the total
+    onLoadProgressSignal = QtCore.Signal(int, int)
 
     onHistoryChange = QtCore.Signal()
 
+    # Signal emitted by _setProperty for each of the editable entity attributes
+    _propertySignals = {
+        "name": "onEntityRenamedSignal",
+        "position": "onEntityMovedSignal",
+        "rotation": "onEntityRotatedSignal",
+        "color": "onEntityColorChangedSignal",
+        "dimensions": "onEntityCubeDimensionsChangedSignal",
+        "radius": "onEntitySphereDimensionsChangedSignal",
+    }
+
 
-    def __init__(self):
+    # The scene cache consists of a base snapshot (cachePath, see data/sceneformat.py) and a journal of the edits made since (cachePath + ".journal")
+    # With useComponentStore, the entity components are kept in NumPy arrays (see data/componentstore.py), which requires NumPy
+    # With streamScene, only the top levels of the base snapshot are loaded up front, the rest follows while the editor is idle
+    # Older undo steps are compressed, and moved to a temporary file past historyMemoryBudget bytes (see data/historystore.py)
+    def __init__(self, cachePath="cache.bin", autosaveQuietPeriod=500, autosaveMaxLatency=2000, compactionThreshold=4 * 1024 * 1024, useComponentStore=False,
+            streamScene=True, initialLevels=2, loadStepBudget=0.008, historyMemoryBudget=8 * 1024 * 1024):
         super(Database, self).__init__()
 
+        self.store = None
+        if useComponentStore:
+            from data.componentstore import ComponentStore
+            self.store = ComponentStore()
+
+        # Entities of the scene by id, built once the scene is loaded, and their names (see findEntities)
+        self.entities = None
+        self.names = NameIndex()
+        self.nextId = 1
+
         # Try to load data from cache (as to resume from a shutdown)
         root = None
-        if os.path.isfile("cache.bin"):
-            f = open("cache.bin", "r")
+        generation = 0
+        journalPath = cachePath + ".journal"
+        self.stream = None
+        if os.path.isfile(cachePath):
             try:
-                j = json.load(f)
-                root = Entity.fromDict(j)
-            except:
-                pass
-            f.close()
-        
+                if streamScene and isStreamable(cachePath):
+                    with tracing.span("SceneStream.open", "io"):
+                        self.stream = SceneStream(cachePath, self.store)
+                        root = self.stream.root()
+                        generation = self.stream.generation
+                        self.nextId = self.stream.nextId
+                        # The first levels are loaded right away, so that there is something to show
+                        level = [root]
+                        for _ in range(initialLevels):
+                            level = [c for e in level for c in self.stream.loadChildren(e)]
+                else:
+                    with tracing.span("sceneformat.loadScene", "io"):
+                        root, generation = sceneformat.loadScene(cachePath, self.store)
+            except (OSError, ValueError, KeyError, TypeError, struct.error) as e:
+                self._closeStream()
+                # Keep the unreadable cache around instead of silently overwriting it
+                logger.warning("Failed to load the scene cache (%s), it was moved to %s", e, cachePath + ".corrupt")
+                os.replace(cachePath, cachePath + ".corrupt")
+                root = None
+                generation = None
+
         if root == None:
             root = Entity()
             root.name = "root"
-
         self.root = root
+
+        # Replay the edits which didn't make it into the base snapshot yet
+        journalLength = 0
+        replayFailed = False
+        if generation != None:
+            journalGeneration, records, journalLength = readJournal(journalPath)
+            if journalGeneration == generation:
+                try:
+                    with tracing.span("Database.replayJournal", "io", {"records": len(records)}):
+                        for record in records:
+                            self._replay(record)
+                except (IndexError, KeyError, TypeError, ValueError, AttributeError) as e:
+                    logger.warning("Failed to replay the journal (%s), stopping at the last valid record", e)
+                    replayFailed = True
+            else:
+                journalLength = 0
+        else:
+            generation = 0
+
+        if self.store != None:
+            self.store.bind(self.root)
+
+        self.entities = {}
+        self._index(self.root)
+
         self.selectedEntity = None
-        self.history = []
+        self.history = HistoryStore(self, memoryBudget=historyMemoryBudget)
         self.redoBuffer = []
+        # Open transactions: the commands executed so far, where each nested transaction starts, and the journal records held back
+        self._transactionCommands = None
+        self._transactionStarts = []
+        self._journalBuffer = None
+        # Token of each open transaction, innermost last, and the next one to hand out
+        self._transactionTokens = []
+        self._nextTransactionToken = 1
+        # Open gesture as (owner, transaction token), and whether one of its edits is being applied, see gestureEdit
+        self._gesture = None
+        self._inGestureEdit = False
+
+        # The rest of a streamed scene is loaded in steps of loadStepBudget seconds, whenever the event loop is idle
+        self.loadStepBudget = loadStepBudget
+        self.loadTimer = QtCore.QTimer(self)
+        self.loadTimer.setInterval(0)
+        self.loadTimer.timeout.connect(self._loadStep)
+        if self.stream != None:
+            self.loadTimer.start()
+
+        # The cache is written in the background, see backup(). Snapshots are versions of the scene (see _snapshot()), which
+        # only cost as much as the edits made since the previous one on the GUI thread - the writer thread flattens them.
+        self.autosave = AutosaveWriter(cachePath, journalPath, self._snapshot, sceneformat.pack,
+            generation=generation, journalLength=journalLength, quietPeriod=autosaveQuietPeriod, maxLatency=autosaveMaxLatency,
+            compactionThreshold=compactionThreshold, parent=self)
+        if replayFailed:
+            # Persist what could be replayed as a new base right away, the journal can't be appended to anymore
+            self.backup()
+            self.autosave.flush()
 
     def fpsCamera(self):
-        self.onFpsCameraSignal.emit()
+        self._emit("onFpsCameraSignal")
 
     def orbitCamera(self):
-        self.onOrbitCameraSignal.emit()
+        self._emit("onOrbitCameraSignal")
 
+    @tracing.traced(category="mutation")
     def entitySelected(self, newlySelectedEntity):
+        self.endGesture()
         self.selectedEntity = newlySelectedEntity
-        print("Selecting: ", self.selectedEntity.name)
-        self.onEntitySelectedSignal.emit()
+        logger.debug("Selecting: %s", self.selectedEntity.name)
+        self._emit("onEntitySelectedSignal")
 
+    @tracing.traced(category="mutation")
     def entityDestroyed(self, entityToDestroy):
-        self.recordHistory()
-        print("Destroying: ", entityToDestroy.name)
-        entityToDestroy.setParent(None)
-        if entityToDestroy == self.selectedEntity:
-            self.selectedEntity = None
-        self.onEntityDestroyedSignal.emit(entityToDestroy)
-        self.backup()
+        logger.debug("Destroying: %s", entityToDestroy.name)
+        parent = entityToDestroy.getParent()
+        self._execute(DestroyCommand(entityToDestroy, parent, parent.children.index(entityToDestroy)))
 
+    @tracing.traced(category="mutation")
     def entityCreated(self, createdEntity):
-        self.recordHistory()
-        print("Creating: ", createdEntity.name)
+        logger.debug("Creating: %s", createdEntity.name)
         if self.selectedEntity != None:
-            createdEntity.setParent(self.selectedEntity)
+            parent = self.selectedEntity
         else:
-            createdEntity.setParent(self.root)
-        self.onEntityCreatedSignal.emit(createdEntity)
-        self.backup()
+            parent = self.root
+        self.loadChildren(parent)
+        self._execute(CreateCommand(createdEntity, parent, len(parent.children)))
+
+    # Adds several entities under the selected entity (or the root) at once, as a single undoable step
+    @tracing.traced(category="mutation")
+    def entitiesCreated(self, createdEntities):
+        if len(createdEntities) == 0:
+            return
+        logger.debug("Creating %d entities", len(createdEntities))
+        parent = self.selectedEntity if self.selectedEntity != None else self.root
+        self.loadChildren(parent)
+        with self.transaction():
+            for entity in createdEntities:
+                self._execute(CreateCommand(entity, parent, len(parent.children)))
+
+    # Moves an entity (with its subtree) under newParent, at the given position among its children (the last one by default).
+    # The position is counted without the entity itself, as it will be once moved. Moves into the entity's own subtree are refused.
+    @tracing.traced(category="mutation")
+    def entityReparented(self, entity, newParent, index=None):
+        oldParent = entity.getParent()
+        if oldParent == None or self._isInSubtree(newParent, entity):
+            raise ValueError("An entity can't be moved into its own subtree, nor can the root be moved")
+        self.loadChildren(newParent)
+        oldIndex = oldParent.children.index(entity)
+        count = len(newParent.children) - (1 if newParent is oldParent else 0)
+        if index == None or index > count:
+            index = count
+        if newParent is oldParent and index == oldIndex:
+            return
+        logger.debug("Moving entity %s under %s", entity.name, newParent.name)
+        self._execute(ReparentCommand(entity, oldParent, oldIndex, newParent, index))
+
+    # Brings the scene back to an earlier version, as a single undoable step. Only the entities which differ get touched,
+    # through the same commands (and signals) as interactive edits, so widgets only update what differs.
+    @tracing.traced(category="mutation")
+    def restoreVersion(self, version):
+        current = self.version()
+        if version.id != current.id:
+            raise ValueError("The version belongs to another scene")
+        changes = versions.diff(current, version)
+        if changes.isEmpty():
+            return
+        logger.debug("Restoring a version: %d changed, %d added, %d removed", len(changes.changed), len(changes.added), len(changes.removed))
+        removedIds = {v.id for v in changes.removed}
+        with self.transaction():
+            # Parents come first, so every entity is where it belongs by the time its own children get placed
+            for v in changes.reordered:
+                parent = self.entities[v.id]
+                for i, c in enumerate(v.children):
+                    child = self.entities.get(c.id)
+                    if child == None:
+                        self._execute(CreateCommand(Entity.fromDict(c.toDict(children=False)), parent, i))
+                    elif child.getParent() is not parent or parent.children.index(child) != i:
+                        oldParent = child.getParent()
+                        self._execute(ReparentCommand(child, oldParent, oldParent.children.index(child), parent, i))
+            for old, new in changes.changed:
+                entity = self.entities[new.id]
+                for attribute in versions.EntityVersion.attributes:
+                    if getattr(new, attribute) != getattr(old, attribute):
+                        self._execute(PropertyCommand(entity, attribute, getattr(entity, attribute), getattr(new, attribute)))
+            # Removed subtrees go as a whole, whatever had to be kept was moved out of them already
+            for v in changes.removed:
+                entity = self.entities.get(v.id)
+                if entity != None and entity.getParent().id not in removedIds:
+                    parent = entity.getParent()
+                    self._execute(DestroyCommand(entity, parent, parent.children.index(entity)))
 
+    @tracing.traced(category="mutation")
     def entityRenamed(self, renamedEntity, newName):
-        self.recordHistory()
-        print("Renaming entity: ", renamedEntity.name, " -> ", newName)
-        renamedEntity.name = newName
-        self.onEntityRenamedSignal.emit(renamedEntity, newName)
-        self.backup()
+        logger.debug("Renaming entity: %s -> %s", renamedEntity.name, newName)
+        self._execute(PropertyCommand(renamedEntity, "name", renamedEntity.name, newName))
 
+    @tracing.traced(category="mutation")
     def entityMoved(self, movedEntity, newPosition):
-        self.recordHistory()
-        print("Moving entity: (", movedEntity.name, ") ", movedEntity.position, " -> ", newPosition)
-        movedEntity.position = newPosition
-        self.onEntityMovedSignal.emit(movedEntity, newPosition)
-        self.backup()
+        logger.debug("Moving entity: (%s) -> %s", movedEntity.name, newPosition)
+        self._execute(PropertyCommand(movedEntity, "position", movedEntity.position, decodeProperty("position", newPosition)))
 
+    @tracing.traced(category="mutation")
     def entityRotated(self, rotatedEntity, newRotation):
-        self.recordHistory()
-        print("Rotating entity: (", rotatedEntity.name, ") ", rotatedEntity.rotation, " -> ", newRotation)
-        rotatedEntity.rotation = newRotation
-        self.onEntityRotatedSignal.emit(rotatedEntity, newRotation)
-        self.backup()    
+        logger.debug("Rotating entity: (%s) -> %s", rotatedEntity.name, newRotation)
+        self._execute(PropertyCommand(rotatedEntity, "rotation", rotatedEntity.rotation, decodeProperty("rotation", newRotation)))
 
+    @tracing.traced(category="mutation")
     def entityColorChanged(self, changedEntity, newColor):
-        self.recordHistory()
-        print("Changing entity color: (", changedEntity.name, ") ", changedEntity.color, " -> ", newColor)
-        changedEntity.color = newColor
-        self.onEntityColorChangedSignal.emit(changedEntity, newColor)
-        self.backup()
+        logger.debug("Changing entity color: (%s) -> %s", changedEntity.name, newColor)
+        self._execute(PropertyCommand(changedEntity, "color", changedEntity.color, decodeProperty("color", newColor)))
 
+    @tracing.traced(category="mutation")
     def entityCubeDimensionsChanged(self, changedEntity, newDimensions):
-        self.recordHistory()
-        print("Changing cube dimensions: (", changedEntity.name, ") ", changedEntity.dimensions, " -> ", newDimensions)
-        changedEntity.dimensions = newDimensions
-        self.onEntityCubeDimensionsChangedSignal.emit(changedEntity, newDimensions)
-        self.backup()
+        logger.debug("Changing cube dimensions: (%s) -> %s", changedEntity.name, newDimensions)
+        self._execute(PropertyCommand(changedEntity, "dimensions", changedEntity.dimensions, decodeProperty("dimensions", newDimensions)))
 
+    @tracing.traced(category="mutation")
     def entitySphereRadiusChanged(self, changedEntity, newRadius):
-        self.recordHistory()
-        print("Changigng sphere radius: (", changedEntity.name, ") ", changedEntity.radius, " -> ", newRadius)
-        changedEntity.radius = newRadius
-        self.onEntitySphereDimensionsChangedSignal.emit(changedEntity, newRadius)
-        self.backup()
+        logger.debug("Changing sphere radius: (%s) -> %s", changedEntity.name, newRadius)
+        self._execute(PropertyCommand(changedEntity, "radius", changedEntity.radius, newRadius))
 
+    # Bulk changes: a single pass over the entities, a single onEntitiesChangedSignal, a single undo step and journal record per attribute.
+    # changes is an iterable of (entity, attribute, value). Raises ValueError, before changing anything,
+    # when an attribute doesn't belong to the entity's type (e.g. dimensions of a sphere).
+    @tracing.traced(category="mutation")
+    def entitiesChanged(self, changes):
+        groups = {}
+        for entity, attribute, value in changes:
+            group = groups.setdefault(attribute, ([], []))
+            group[0].append(entity)
+            group[1].append(value)
+        self._executeBatch([(entities, attribute, values) for attribute, (entities, values) in groups.items()])
+
+    # Sets the same attribute of many entities. Values can be given as Qt values, plain tuples/lists,
+    # or as an (N, 3) / (N, 4) array (a flat one for radii) - which is applied column-wise when the component store is used.
+    @tracing.traced(category="mutation")
+    def entitiesPropertyChanged(self, entities, attribute, values):
+        self._executeBatch([(list(entities), attribute, values)])
+
+    def _executeBatch(self, groups):
+        for entities, attribute, _ in groups:
+            if attribute not in Database._propertySignals:
+                raise ValueError("Unknown entity attribute: %s" % attribute)
+            if attribute != "name":
+                for e in entities:
+                    if attribute not in e._components:
+                        raise ValueError("%s entities have no %s" % (type(e).__name__, attribute))
+        logger.debug("Changing %d entities", sum(len(g[0]) for g in groups))
+        oldGroups = [(entities, attribute, self._getProperties(entities, attribute)) for entities, attribute, _ in groups]
+        self._execute(BatchCommand(oldGroups, groups))
+
+    # Transactions group edits - an interactive gesture, a scripted sequence... - into a single history entry
+    # and a single journal write, both happening on commit. Consecutive changes of the same attribute of the same entity
+    # are merged. The edits themselves are applied (and signalled) right away, so views keep following along.
+    # Transactions may be nested, only the outermost commit records anything.
+    # Returns a token for the transaction, which commitTransaction can be given to only commit that very transaction
+    def beginTransaction(self):
+        self._endInterruptedGesture()
+        if self._transactionCommands == None:
+            self._transactionCommands = []
+            self._journalBuffer = []
+        self._transactionStarts.append(len(self._transactionCommands))
+        token = self._nextTransactionToken
+        self._nextTransactionToken += 1
+        self._transactionTokens.append(token)
+        return token
+
+    # Commits the innermost transaction. Given a token which isn't the innermost transaction's (e.g. that of a transaction
+    # which was aborted already), nothing happens.
+    @tracing.traced(category="mutation")
+    def commitTransaction(self, token=None):
+        if len(self._transactionStarts) == 0:
+            return
+        if token != None and self._transactionTokens[-1] != token:
+            return
+        self._transactionStarts.pop()
+        self._transactionTokens.pop()
+        if len(self._transactionStarts) == 0:
+            self._closeTransaction()
+
+    # Reverts the edits done within the innermost transaction
+    @tracing.traced(category="mutation")
+    def abortTransaction(self):
+        if len(self._transactionStarts) == 0:
+            return
+        start = self._transactionStarts.pop()
+        self._transactionTokens.pop()
+        commands = self._transactionCommands
+        for c in reversed(commands[start:]):
+            c.undo(self)
+        del commands[start:]
+        if len(self._transactionStarts) == 0:
+            # Nothing to persist, the scene is back where it was
+            self._journalBuffer = []
+            self._closeTransaction()
+
+    # Context manager form: commits on success, aborts if an exception escapes.
+    # A gesture started within it is ended first, so that the transaction committed is this very one.
+    @contextlib.contextmanager
+    def transaction(self):
+        token = self.beginTransaction()
+        try:
+            yield self
+        except:
+            self._endInterruptedGesture()
+            self.abortTransaction()
+            raise
+        self._endInterruptedGesture()
+        self.commitTransaction(token)
+
+    def inTransaction(self):
+        return len(self._transactionStarts) > 0
+
+    # Interactive edits spread over time (holding a spinbox arrow, typing a name...) are grouped into a single undo step:
+    # the edits applied within gestureEdit(owner) share a transaction, which stays open between them until endGesture.
+    # Any other edit, selection change or undo/redo ends the open gesture first, so nothing else gets folded into it.
+    @contextlib.contextmanager
+    def gestureEdit(self, owner):
+        if self._gesture != None and self._gesture[0] is not owner:
+            self.endGesture()
+        if self._gesture == None:
+            self._gesture = (owner, self.beginTransaction())
+        self._inGestureEdit = True
+        try:
+            yield self
+        finally:
+            self._inGestureEdit = False
+
+    # Commits the open gesture. Given an owner, only a gesture of that owner gets ended.
+    def endGesture(self, owner=None):
+        if self._gesture == None or (owner != None and self._gesture[0] is not owner):
+            return
+        token = self._gesture[1]
+        self._gesture = None
+        self.commitTransaction(token)
+
+    def _endInterruptedGesture(self):
+        if self._gesture != None and not self._inGestureEdit:
+            self.endGesture()
+
+    def _closeTransaction(self):
+        commands = self._transactionCommands
+        records = self._journalBuffer
+        self._transactionCommands = None
+        self._journalBuffer = None
+        if len(records) > 0:
+            self.autosave.append(b"".join(encodeRecord(r) for r in records))
+        if len(commands) == 1:
+            self.recordHistory(commands[0])
+        elif len(commands) > 1:
+            self.recordHistory(CompositeCommand(commands))
+
+    # Undo/redo only replay the inverse (or the original) operation of a single command.
+    # Entities are patched in place, so every widget keeps its references and receives the same fine-grained signals as for a regular edit.
     def undo(self):
-        j = self.history.pop()
-        self.redoBuffer.append(json.dumps(self.root.toDict()))
-        j = json.loads(j)
-        self.root = Entity.fromDict(j)
-        #print(j)
-        #self.dumpEntityTree()
-        self.selectedEntity = None
-        self.onUndoSignal.emit()
-        self.onHistoryChange.emit()
-        self.backup()
+        with tracing.span("Database.undo", "mutation"):
+            self._endGestureForHistory()
+            if len(self.history) == 0:
+                return
+            command = self.history.pop()
+            command.undo(self)
+            self.redoBuffer.append(command)
+            self._emit("onUndoSignal")
+            self._emit("onHistoryChange")
 
     def redo(self):
-        j = self.redoBuffer.pop()
-        self.history.append(json.dumps(self.root.toDict()))
-        j = json.loads(j)
-        self.root = Entity.fromDict(j)
-        #print(j)
-        #self.dumpEntityTree()
-        self.selectedEntity = None
-        self.onRedoSignal.emit()
-        self.onHistoryChange.emit()
-        self.backup()
+        with tracing.span("Database.redo", "mutation"):
+            # Committing an open gesture records a new step, which leaves nothing to redo
+            self._endGestureForHistory()
+            if len(self.redoBuffer) == 0:
+                return
+            command = self.redoBuffer.pop()
+            command.redo(self)
+            self.history.append(command)
+            self._emit("onRedoSignal")
+            self._emit("onHistoryChange")
 
+    # Schedules a fresh base snapshot of the whole scene, written off the GUI thread.
+    # Regular edits don't need it - they are persisted through the journal as they happen.
     def backup(self):
-        #print("backup")
-        f = open("cache.bin", "w")
-        d = json.dumps(self.root.toDict(), indent=2)
-        f.write(d)
-        f.close()
-
-    def recordHistory(self):
-        d = json.dumps(self.root.toDict())
-        self.history.append(d)
-        self.onHistoryChange.emit()
+        self.autosave.markDirty()
+
+    # Writes pending changes to the cache right away. Should be called before exiting.
+    def flush(self):
+        self.endGesture()
+        self.autosave.close()
+        self._closeStream()
+
+    # Whether a streamed scene is still being loaded
+    def isLoading(self):
+        return self.stream != None
+
+    # Whether an entity has children which haven't been loaded yet
+    def hasPendingChildren(self, entity):
+        return self.stream != None and self.stream.isPending(entity)
+
+    # Entity of the scene with the given id, or None
+    def entity(self, id):
+        return self.entities.get(id)
+
+    # Immutable version of the whole scene, see data/versions.py. Taking one after a few edits only costs as much as the edits,
+    # as it shares whatever didn't change with the previous one. Loads whatever remains of a streamed scene.
+    @tracing.traced(category="query")
+    def version(self):
+        return self.finishLoading().version()
+
+    # Snapshot of the scene for the autosave. While a scene is streamed, that's a version of its loaded part along with
+    # where to find the records still in the file (see SceneStream.unloadedRecords), rather than a version of the whole scene.
+    def _snapshot(self):
+        # Windows can't replace a file which is still mapped, the scene has to be loaded in full first there
+        if self.stream == None or os.name == "nt":
+            return self.version()
+        return (self.root.version(), self.stream.unloadedRecords())
+
+    # Entities of the scene whose name contains text (ignoring case), those starting with it first, at most limit of them.
+    # The part of a streamed scene still in the file is searched by the names stored there, and only the matching
+    # entities get loaded.
+    @tracing.traced(category="query")
+    def findEntities(self, text, limit=None):
+        if self.stream != None:
+            self._loadMatches(text, limit)
+        ids = self.names.prefix(text, limit)
+        if limit == None or len(ids) < limit:
+            found = set(ids)
+            for id in self.names.search(text):
+                if id not in found:
+                    ids.append(id)
+                    if len(ids) == limit:
+                        break
+        return [self.entities[id] for id in ids]
+
+    # Loads the children of an entity right away, if they weren't loaded yet
+    @tracing.traced(category="io")
+    def loadChildren(self, entity):
+        if self.stream != None and len(self.stream.loadChildren(entity)) > 0:
+            self._announceChildren([entity])
+
+    # Loads whatever remains of a streamed scene, and returns the root
+    @tracing.traced(category="io")
+    def finishLoading(self):
+        if self.stream != None:
+            loaded = []
+            while not self.stream.isDone():
+                loaded.extend(self.stream.step(self.loadStepBudget))
+            self._announceChildren(loaded)
+            self._closeStream()
+        return self.root
+
+    # Loads the entities still in the file which findEntities could list
+    def _loadMatches(self, text, limit):
+        matches = self.stream.search(text, limit, lambda e: self._isInSubtree(e, self.root))
+        if len(matches) > 0:
+            self._announceChildren(self.stream.loadRecords(matches))
+            if self.stream.isDone():
+                self._closeStream()
+
+    def _loadStep(self):
+        with tracing.span("Database.loadStep", "io"):
+            self._announceChildren(self.stream.step(self.loadStepBudget))
+            if self.stream.isDone():
+                self._closeStream()
+
+    def _announceChildren(self, parents):
+        for parent in parents:
+            # Subtrees removed from the scene meanwhile are announced (and indexed) along with their root, should it come back
+            if self._isInSubtree(parent, self.root):
+                if self.entities != None:
+                    self._indexEntities(parent.children)
+                self._emit("onEntityChildrenLoadedSignal", parent)
+        if self.stream != None:
+            self._emit("onLoadProgressSignal", self.stream.loaded, self.stream.total)
+
+    def _closeStream(self):
+        if self.stream == None:
+            return
+        total = self.stream.total
+        self.stream.close()
+        self.stream = None
+        if hasattr(self, "loadTimer"):
+            self.loadTimer.stop()
+            self._emit("onLoadProgressSignal", total, total)
+
+    def recordHistory(self, command):
+        self.history.append(command)
+        self._emit("onHistoryChange")
         self.redoBuffer = []
 
+    # Undo/redo commit the open gesture first. Other transactions are left to whoever opened them, undo/redo are refused meanwhile.
+    def _endGestureForHistory(self):
+        self.endGesture()
+        if self.inTransaction():
+            raise RuntimeError("Undo and redo aren't possible within a transaction")
+
+    # Applies a freshly created command and records it in the history (or in the open transaction)
+    def _execute(self, command):
+        self._endInterruptedGesture()
+        command.redo(self)
+        if self._transactionCommands == None:
+            self.recordHistory(command)
+            return
+        commands = self._transactionCommands
+        # Merge with the previous change of the same attribute, as long as it belongs to the same (nested) transaction
+        if isinstance(command, PropertyCommand) and len(commands) > self._transactionStarts[-1]:
+            last = commands[-1]
+            if isinstance(last, PropertyCommand) and last.entity is command.entity and last.attribute == command.attribute:
+                last.newValue = command.newValue
+                return
+        commands.append(command)
+
+    # The primitives below are the only places where the entity tree gets mutated.
+    # They are shared by regular edits and by undo/redo, and each of them appends a record to the journal.
+    def _setProperty(self, entity, attribute, value):
+        setattr(entity, attribute, value)
+        if attribute == "name":
+            self._rename(entity)
+        self._journal({"op": "set", "path": self._entityPath(entity), "attribute": attribute, "value": encodeProperty(attribute, value)})
+        self._emit(Database._propertySignals[attribute], entity, value)
+
+    def _setProperties(self, groups):
+        changed = {}
+        for entities, attribute, values in groups:
+            if self._isVectorized(attribute):
+                values = self._asArray(attribute, values)
+                self.store.scatter(attribute, self.store.rowsOf(entities), values)
+                for e in entities:
+                    e._componentChanged(attribute)
+                encoded = values.tolist()
+            else:
+                values = [self._asValue(attribute, v) for v in values]
+                for e, v in zip(entities, values):
+                    setattr(e, attribute, v)
+                    if attribute == "name":
+                        self._rename(e)
+                encoded = [encodeProperty(attribute, v) for v in values]
+            self._journal({"op": "setMany", "paths": [self._entityPath(e) for e in entities], "attribute": attribute, "values": encoded})
+            changed.setdefault(attribute, []).extend(entities)
+        self._emit("onEntitiesChangedSignal", changed)
+
+    def _getProperties(self, entities, attribute):
+        if self._isVectorized(attribute):
+            return self.store.gather(attribute, self.store.rowsOf(entities))
+        return [getattr(e, attribute) for e in entities]
+
+    # Whether an attribute can be read and written column-wise
+    def _isVectorized(self, attribute):
+        return self.store != None and attribute != "name"
+
+    def _asArray(self, attribute, values):
+        import numpy
+        return numpy.asarray(values)
+
+    def _asValue(self, attribute, value):
+        if attribute == "name" or attribute == "radius":
+            return value.item() if hasattr(value, "item") else value
+        return decodeProperty(attribute, value.tolist() if hasattr(value, "tolist") else value)
+
+    def _attach(self, entity, parent, index):
+        if self.store != None:
+            self.store.bind(entity)
+        # Indices are only meaningful once all the siblings are there
+        self.loadChildren(parent)
+        entity.setParent(parent, index)
+        self._index(entity)
+        self._journal({"op": "attach", "path": self._entityPath(parent), "index": index, "entity": entity.toDict()})
+        self._emit("onEntityCreatedSignal", entity)
+
+    def _detach(self, entity):
+        if self._isInSubtree(self.selectedEntity, entity):
+            self.selectedEntity = None
+        self._journal({"op": "detach", "path": self._entityPath(entity)})
+        self._emit("onEntityAboutToBeDestroyedSignal", entity)
+        entity.setParent(None)
+        self._unindex(entity)
+        self._emit("onEntityDestroyedSignal", entity)
+
+    # Adds an entity and its (loaded) subtree to the indices, giving ids to the entities which don't have one yet.
+    # Entities keep their ids while out of the scene, so those of a removed subtree come back with it (e.g. with undo).
+    def _index(self, entity):
+        self._indexEntities(self._subtree(entity))
+
+    def _indexEntities(self, entities):
+        for e in entities:
+            if e.id == None or self.entities.get(e.id, e) is not e:
+                e.id = self.nextId
+                e.invalidateVersion()
+            self.nextId = max(self.nextId, e.id + 1)
+            self.entities[e.id] = e
+        # Sorting all the names again beats inserting many of them one at a time
+        if len(entities) < 64:
+            for e in entities:
+                self.names.add(e.id, e.name)
+        else:
+            self.names.addMany((e.id, e.name) for e in entities)
+
+    def _unindex(self, entity):
+        for e in self._subtree(entity):
+            if self.entities.get(e.id) is e:
+                del self.entities[e.id]
+                self.names.remove(e.id)
+
+    def _rename(self, entity):
+        if self.entities != None and self.entities.get(entity.id) is entity:
+            self.names.rename(entity.id, entity.name)
+
+    def _subtree(self, entity):
+        entities = []
+        stack = [entity]
+        while len(stack) > 0:
+            e = stack.pop()
+            entities.append(e)
+            stack.extend(e.children)
+        return entities
+
+    # Nothing gets re-created: the entity objects keep their identity (and ids), widgets only move what they show for them
+    def _reparent(self, entity, parent, index):
+        self.loadChildren(parent)
+        path = self._entityPath(entity)
+        self._emit("onEntityAboutToBeReparentedSignal", entity, parent, index)
+        entity.setParent(None)
+        # The parent is located as it is once the entity is gone, which is how the journal gets replayed
+        self._journal({"op": "move", "path": path, "parent": self._entityPath(parent), "index": index})
+        entity.setParent(parent, index)
+        self._emit("onEntityReparentedSignal", entity)
+
+    # Emits a signal by name, timing how long its slots take altogether
+    def _emit(self, name, *args):
+        with tracing.span(name, "signal"):
+            getattr(self, name).emit(*args)
+
+    def _journal(self, record):
+        if self._journalBuffer == None:
+            self.autosave.append(encodeRecord(record))
+            return
+        # Within a transaction, only the last value set to an attribute needs to be persisted
+        buffer = self._journalBuffer
+        if record["op"] == "set" and len(buffer) > 0:
+            last = buffer[-1]
+            if last["op"] == "set" and last["path"] == record["path"] and last["attribute"] == record["attribute"]:
+                buffer[-1] = record
+                return
+        buffer.append(record)
+
+    # Applies a journal record while loading the cache
+    def _replay(self, record):
+        op = record["op"]
+        if op == "setMany":
+            attribute = record["attribute"]
+            for path, value in zip(record["paths"], record["values"]):
+                setattr(self._entityAtPath(path), attribute, decodeProperty(attribute, value))
+            return
+        entity = self._entityAtPath(record["path"])
+        if op == "set":
+            setattr(entity, record["attribute"], decodeProperty(record["attribute"], record["value"]))
+        elif op == "attach":
+            self.loadChildren(entity)
+            Entity.fromDict(record["entity"]).setParent(entity, record["index"])
+        elif op == "detach":
+            entity.setParent(None)
+        elif op == "move":
+            entity.setParent(None)
+            parent = self._entityAtPath(record["parent"])
+            self.loadChildren(parent)
+            entity.setParent(parent, record["index"])
+
+    # Position of an entity in the tree, as the list of child indices leading to it from the root
+    def _entityPath(self, entity):
+        path = []
+        parent = entity.getParent()
+        while parent != None:
+            path.append(parent.children.index(entity))
+            entity = parent
+            parent = entity.getParent()
+        path.reverse()
+        return path
+
+    def _entityAtPath(self, path):
+        entity = self.root
+        for i in path:
+            self.loadChildren(entity)
+            entity = entity.children[i]
+        return entity
+
+    # Returns True if entity is subtreeRoot or one of its descendants
+    def _isInSubtree(self, entity, subtreeRoot):
+        while entity != None:
+            if entity is subtreeRoot:
+                return True
+            entity = entity.getParent()
+        return False
+
     # Prints the entity tree, for debugging purposes
     def dumpEntityTree(self):
         Database._printOneEntity(self.root)
@@ -1,28 +1,104 @@
 import weakref
-from PySide2.QtGui import QVector3D, QColor, QQuaternion
-from PySide2 import QtCore
+from data import transform
+from data.childlist import ChildList, EMPTY
+from data.versions import EntityVersion
+
+# Half extents of meshes whose bounds aren't known yet (e.g. still loading)
+_PLACEHOLDER_EXTENTS = (0.5, 0.5, 0.5)
+
+# An entity attribute which is stored on the entity itself, or in the rows of a ComponentStore once the entity is bound to one
+def _component(name):
+    attribute = "_" + name
+    def getter(self):
+        if self._store == None:
+            return getattr(self, attribute)
+        return self._store.read(name, self._row)
+    def setter(self, value):
+        if self._store == None:
+            setattr(self, attribute, value)
+        else:
+            self._store.write(name, self._row, value)
+        self._componentChanged(name)
+    return property(getter, setter)
+
+# A node of the scene. Plain Python objects with fixed slots, as there may be millions of them:
+# components are tuples - position (x, y, z), rotation (scalar, x, y, z), color (red, green, blue) from 0 to 255,
+# cube dimensions (x, y, z) and sphere radius - and Qt value types only get created by the widgets showing them.
+class Entity:
+    __slots__ = ("__weakref__", "children", "parent", "id", "_name", "_store", "_row", "_world", "_worldBounds", "_version",
+        "_position", "_rotation", "_color")
+    # Components of this entity type that a ComponentStore keeps in its arrays
+    _components = ("position", "rotation", "color")
+
+    position = _component("position")
+    rotation = _component("rotation")
+    color = _component("color")
 
-class Entity(QtCore.QObject):
     def __init__(self):
-        super().__init__()
-        self.children = []
+        self._store = None
+        self._row = None
+        # Cached world transform and world bounds, None when they have to be recomputed.
+        # A dirty entity always has a dirty subtree, so invalidation can stop at entities which are dirty already.
+        self._world = None
+        self._worldBounds = None
+        # Cached persistent version (see data/versions.py), None when it has to be rebuilt.
+        # An entity without a version never has an ancestor with one, so invalidation can stop at entities which have none.
+        self._version = None
+        # Persistent identifier, saved along with the scene. Assigned by Database when the entity joins the scene
+        # and kept from then on - through undo/redo, saving and loading. None until then.
+        self.id = None
+        self.children = EMPTY
         self.parent = None
         self.name = "Entity"
-        self.position = QVector3D(0, 0, 0)
-        self.rotation = QQuaternion(0, 0, 0, 0)
-        self.color = QColor.fromRgb(255, 255, 255)
+        self.position = (0.0, 0.0, 0.0)
+        self.rotation = (0.0, 0.0, 0.0, 0.0)
+        self.color = (255, 255, 255)
+
+    # Sets up an entity created with __new__ (see restore) without going through the attributes: nothing is cached yet,
+    # so there is nothing to invalidate. Components are None for entities about to be bound to a ComponentStore.
+    def _restore(self, id, name, position, rotation, color, extra):
+        self._store = None
+        self._row = None
+        self._world = None
+        self._worldBounds = None
+        self._version = None
+        self.id = id
+        self.children = EMPTY
+        self.parent = None
+        self._name = name
+        self._position = position
+        self._rotation = rotation
+        self._color = color
+
+    def _getName(self):
+        return self._name
+
+    def _setName(self, name):
+        self._name = name
+        self.invalidateVersion()
+
+    name = property(_getName, _setName)
 
     # Sets the parent of this entity. Handles removal from the previous parent and parent's children arrays.
-    def setParent(self, parent):
+    # When index is given, the entity is inserted at that position among the new parent's children instead of appended.
+    def setParent(self, parent, index=None):
+        self.invalidateWorld()
         # Remove this entity from previous parent's children
         if self.parent != None and self.parent() != None:
             self.parent().children.remove(self)
+            self.parent().invalidateVersion()
         # Handle the new parent
         if parent == None:
             self.parent = None
         else:
+            parent.invalidateVersion()
             self.parent = weakref.ref(parent)
-            parent.children.append(self)
+            if parent.children is EMPTY:
+                parent.children = ChildList()
+            if index == None:
+                parent.children.append(self)
+            else:
+                parent.children.insert(index, self)
 
     # Returns the parent Entity    
     def getParent(self):
@@ -31,15 +107,97 @@ class Entity(QtCore.QObject):
         else:
             return self.parent()
 
+    # Transform of the entity relative to its parent, see data/transform.py
+    def localTransform(self):
+        return transform.local(self.position, self.rotation)
+
+    # Transform from the entity's space to world space. Entities without a parent (the scene root) are the world's origin.
+    # Cached until the entity or one of its ancestors moves, so repeated queries are O(1).
+    def worldTransform(self):
+        if self._world == None:
+            # Walk up to the closest ancestor with a valid transform, then compute the chain back down
+            chain = []
+            e = self
+            while e != None and e._world == None:
+                chain.append(e)
+                e = e.getParent()
+            world = e._world if e != None else transform.IDENTITY
+            for e in reversed(chain):
+                world = transform.compose(world, e.localTransform()) if e.getParent() != None else transform.IDENTITY
+                e._world = world
+        return self._world
+
+    # Bounds of the entity's shape in its own space as (center, half extents), or None if it has no shape
+    def localBounds(self):
+        return None
+
+    # World space axis aligned (min x, min y, min z, max x, max y, max z) bounds of the entity's shape, or None if it has no shape
+    def worldBounds(self):
+        if self._worldBounds == None:
+            self._worldBounds = self._computeWorldBounds(self.worldTransform())
+        return self._worldBounds
+
+    def _computeWorldBounds(self, world):
+        bounds = self.localBounds()
+        if bounds == None:
+            return None
+        return transform.transformBox(world, bounds[0], bounds[1])
+
+    # Marks the world transform of this entity and its subtree as outdated
+    def invalidateWorld(self):
+        stack = [self]
+        while len(stack) > 0:
+            e = stack.pop()
+            e._worldBounds = None
+            if e._world == None:
+                continue
+            e._world = None
+            stack.extend(e.children)
+
+    # Immutable copy of the entity and its subtree, sharing the subtrees which didn't change since the previous version
+    def version(self):
+        if self._version == None:
+            # Children first, only for the entities whose version is outdated
+            stack = [(self, False)]
+            while len(stack) > 0:
+                e, ready = stack.pop()
+                if ready:
+                    e._version = e._newVersion(tuple(c._version for c in e.children))
+                else:
+                    stack.append((e, True))
+                    stack.extend((c, False) for c in e.children if c._version == None)
+        return self._version
+
+    def _newVersion(self, children):
+        return EntityVersion(self.id, "Entity", self.name, self.position, self.rotation, self.color, None, None, None, children)
+
+    # Marks the version of this entity and of its ancestors as outdated
+    def invalidateVersion(self):
+        e = self
+        while e != None and e._version != None:
+            e._version = None
+            e = e.getParent()
+
+    # Keeps the cached world state in line with a component which got written, either through the attributes or column-wise
+    def _componentChanged(self, name):
+        self.invalidateVersion()
+        if name == "position" or name == "rotation":
+            self.invalidateWorld()
+        elif name == "dimensions" or name == "radius":
+            self._worldBounds = None
+
     def toDict(self):
         v = {}
         v["name"] = self.name
-        v["position"] = [self.position.x(), self.position.y(), self.position.z()]
-        r = self.rotation.toVector4D()
-        v["rotation"] = [r.x(), r.y(), r.z(), r.w()]
-        v["color"] = [self.color.toRgb().red(), self.color.toRgb().green(), self.color.toRgb().blue()]
+        v["position"] = list(self.position)
+        # Stored as (x, y, z, scalar)
+        r = self.rotation
+        v["rotation"] = [r[1], r[2], r[3], r[0]]
+        v["color"] = list(self.color)
         v["children"] = [x.toDict() for x in self.children]
         v["identifier"] = "Entity"
+        if self.id != None:
+            v["id"] = self.id
         return v
 
     def fromDict(d):
@@ -55,16 +213,18 @@ class Entity(QtCore.QObject):
             entity = MeshEntity(None)
 
         entity.name = d["name"]
-        entity.position = QVector3D(d["position"][0], d["position"][1], d["position"][2])
-        entity.rotation = QQuaternion(d["rotation"][0], d["rotation"][1], d["rotation"][2], d["rotation"][3])
-        entity.color = QColor(d["color"][0], d["color"][1], d["color"][2])
+        entity.position = tuple(float(x) for x in d["position"])
+        r = d["rotation"]
+        entity.rotation = (float(r[3]), float(r[0]), float(r[1]), float(r[2]))
+        entity.color = tuple(int(x) for x in d["color"])
+        entity.id = d.get("id")
         
         if i == "Entity":
             pass
         elif i == "Sphere":
             entity.radius = d["radius"]
         elif i == "Cube":
-            entity.dimensions = QVector3D(d["dimensions"][0], d["dimensions"][1], d["dimensions"][2])
+            entity.dimensions = tuple(float(x) for x in d["dimensions"])
         elif i == "Mesh":
             entity.meshPath = d["meshPath"]
 
@@ -74,12 +234,45 @@ class Entity(QtCore.QObject):
 
         return entity
 
+# New entity of the given type with the given values, much cheaper than setting them one by one when loading many
+# entities at once. Extra is the radius of spheres, the dimensions of cubes and the mesh path of meshes.
+# The entity isn't part of any tree yet, loaders link parents and children on their own (see linkChildren).
+def restore(entityType, id, name, position, rotation, color, extra=None):
+    entity = entityType.__new__(entityType)
+    entity._restore(id, name, position, rotation, color, extra)
+    return entity
+
+# Makes the given restored entities the children of parent, at once
+def linkChildren(parent, children):
+    reference = weakref.ref(parent)
+    for c in children:
+        c.parent = reference
+    parent.children = ChildList(children)
+
 class SphereEntity(Entity):
+    __slots__ = ("_radius",)
+    _components = Entity._components + ("radius",)
+    radius = _component("radius")
+
     def __init__(self):
         super().__init__()
-        self.radius = 1
+        self.radius = 1.0
         self.name = "Sphere"
 
+    def _restore(self, id, name, position, rotation, color, extra):
+        Entity._restore(self, id, name, position, rotation, color, extra)
+        self._radius = extra
+
+    def localBounds(self):
+        r = float(self.radius)
+        return ((0.0, 0.0, 0.0), (r, r, r))
+
+    def _computeWorldBounds(self, world):
+        return transform.transformSphere(world, (0.0, 0.0, 0.0), float(self.radius))
+
+    def _newVersion(self, children):
+        return EntityVersion(self.id, "Sphere", self.name, self.position, self.rotation, self.color, None, self.radius, None, children)
+
     def toDict(self):
         v = Entity.toDict(self)
         v["radius"] = self.radius
@@ -87,22 +280,59 @@ class SphereEntity(Entity):
         return v
 
 class CubeEntity(Entity):
+    __slots__ = ("_dimensions",)
+    _components = Entity._components + ("dimensions",)
+    dimensions = _component("dimensions")
+
     def __init__(self):
         super().__init__()
-        self.dimensions = QVector3D(1, 1, 1)
+        self.dimensions = (1.0, 1.0, 1.0)
         self.name = "Cube"
 
+    def _restore(self, id, name, position, rotation, color, extra):
+        Entity._restore(self, id, name, position, rotation, color, extra)
+        self._dimensions = extra
+
+    def localBounds(self):
+        d = self.dimensions
+        return ((0.0, 0.0, 0.0), (d[0] / 2, d[1] / 2, d[2] / 2))
+
+    def _newVersion(self, children):
+        return EntityVersion(self.id, "Cube", self.name, self.position, self.rotation, self.color, self.dimensions, None, None, children)
+
     def toDict(self):
         v = Entity.toDict(self)
-        v["dimensions"] = [self.dimensions.x(), self.dimensions.y(), self.dimensions.z()]
+        v["dimensions"] = list(self.dimensions)
         v["identifier"] = "Cube"
         return v
 
 class MeshEntity(Entity):
+    __slots__ = ("meshPath", "meshBounds")
+
     def __init__(self, meshPath):
         super().__init__()
         self.name = "Mesh"
         self.meshPath = meshPath
+        # Local ((min x, min y, min z), (max x, max y, max z)) bounds of the mesh, known once it is loaded
+        self.meshBounds = None
+
+    def _restore(self, id, name, position, rotation, color, extra):
+        Entity._restore(self, id, name, position, rotation, color, extra)
+        self.meshPath = extra
+        self.meshBounds = None
+
+    def setMeshBounds(self, bounds):
+        self.meshBounds = bounds
+        self._worldBounds = None
+
+    def localBounds(self):
+        if self.meshBounds == None:
+            return ((0.0, 0.0, 0.0), _PLACEHOLDER_EXTENTS)
+        low, high = self.meshBounds
+        return (tuple((low[i] + high[i]) / 2 for i in range(3)), tuple((high[i] - low[i]) / 2 for i in range(3)))
+
+    def _newVersion(self, children):
+        return EntityVersion(self.id, "Mesh", self.name, self.position, self.rotation, self.color, None, None, self.meshPath, children)
 
     def toDict(self):
         v = Entity.toDict(self)
@@ -0,0 +1,157 @@
+# Undo/redo commands. Each command stores only what is needed to revert a single mutation,
+# so undoing or redoing costs as much as the change itself rather than the whole scene.
+# Commands never touch entities directly - they go through the database primitives, which
+# patch the existing entity objects in place and emit the usual fine-grained signals.
+#
+# Old commands can be encoded into plain tuples (see data/historystore.py), which refer to entities by id.
+# Decoding resolves the ids back to entity objects, and must happen while the scene is in the state right after
+# the command - i.e. once every newer command has been undone.
+import abc
+from data.entity import Entity
+
+# Every command implements all three, so that a command missing one fails when it is created rather than halfway through an undo
+class Command(abc.ABC):
+    # Reverts the mutation
+    @abc.abstractmethod
+    def undo(self, database):
+        pass
+
+    # Applies the mutation (again)
+    @abc.abstractmethod
+    def redo(self, database):
+        pass
+
+    # Plain tuple form of the command, see decodeCommand
+    @abc.abstractmethod
+    def encode(self):
+        pass
+
+# Rebuilds a command from its encoded form. resolve maps an id to its entity.
+# Entities recreated while decoding (the subtrees of destroy commands) are added to entities, which resolve looks at first.
+def decodeCommand(data, resolve, entities):
+    kind = data[0]
+    if kind == "property":
+        return PropertyCommand(resolve(data[1]), data[2], data[3], data[4])
+    elif kind == "create":
+        return CreateCommand(resolve(data[1]), resolve(data[2]), data[3])
+    elif kind == "destroy":
+        entity = Entity.fromDict(data[1])
+        stack = [entity]
+        while len(stack) > 0:
+            e = stack.pop()
+            entities[e.id] = e
+            stack.extend(e.children)
+        return DestroyCommand(entity, resolve(data[2]), data[3])
+    elif kind == "reparent":
+        return ReparentCommand(resolve(data[1]), resolve(data[2]), data[3], resolve(data[4]), data[5])
+    elif kind == "composite":
+        # Newest first, so that the entities destroyed by a command are there for the ones before it
+        commands = [decodeCommand(c, resolve, entities) for c in reversed(data[1])]
+        commands.reverse()
+        return CompositeCommand(commands)
+    elif kind == "batch":
+        decodeGroups = lambda groups: [([resolve(id) for id in ids], attribute, values) for ids, attribute, values in groups]
+        return BatchCommand(decodeGroups(data[1]), decodeGroups(data[2]))
+    else:
+        raise ValueError("Unknown command kind " + str(kind))
+
+# Change of a single attribute (position, rotation, color, name, dimensions, radius...)
+class PropertyCommand(Command):
+    def __init__(self, entity, attribute, oldValue, newValue):
+        self.entity = entity
+        self.attribute = attribute
+        self.oldValue = oldValue
+        self.newValue = newValue
+
+    def undo(self, database):
+        database._setProperty(self.entity, self.attribute, self.oldValue)
+
+    def redo(self, database):
+        database._setProperty(self.entity, self.attribute, self.newValue)
+
+    def encode(self):
+        return ("property", self.entity.id, self.attribute, self.oldValue, self.newValue)
+
+# Insertion of an entity (with its whole subtree) under a parent, at a given position
+class CreateCommand(Command):
+    def __init__(self, entity, parent, index):
+        self.entity = entity
+        self.parent = parent
+        self.index = index
+
+    def undo(self, database):
+        database._detach(self.entity)
+
+    def redo(self, database):
+        database._attach(self.entity, self.parent, self.index)
+
+    def encode(self):
+        return ("create", self.entity.id, self.parent.id, self.index)
+
+# Removal of an entity (with its whole subtree). The detached entity objects are kept alive by the command.
+class DestroyCommand(Command):
+    def __init__(self, entity, parent, index):
+        self.entity = entity
+        self.parent = parent
+        self.index = index
+
+    def undo(self, database):
+        database._attach(self.entity, self.parent, self.index)
+
+    def redo(self, database):
+        database._detach(self.entity)
+
+    # The detached subtree is saved along, it gets recreated when decoding
+    def encode(self):
+        return ("destroy", self.entity.toDict(), self.parent.id, self.index)
+
+# Move of an entity (with its whole subtree) to another parent, or to another position among its siblings
+class ReparentCommand(Command):
+    def __init__(self, entity, oldParent, oldIndex, newParent, newIndex):
+        self.entity = entity
+        self.oldParent = oldParent
+        self.oldIndex = oldIndex
+        self.newParent = newParent
+        self.newIndex = newIndex
+
+    def undo(self, database):
+        database._reparent(self.entity, self.oldParent, self.oldIndex)
+
+    def redo(self, database):
+        database._reparent(self.entity, self.newParent, self.newIndex)
+
+    def encode(self):
+        return ("reparent", self.entity.id, self.oldParent.id, self.oldIndex, self.newParent.id, self.newIndex)
+
+# Several commands undone and redone as one, e.g. everything done within a transaction
+class CompositeCommand(Command):
+    def __init__(self, commands):
+        self.commands = commands
+
+    def undo(self, database):
+        for c in reversed(self.commands):
+            c.undo(database)
+
+    def redo(self, database):
+        for c in self.commands:
+            c.redo(database)
+
+    def encode(self):
+        return ("composite", [c.encode() for c in self.commands])
+
+# Bulk change of attributes of many entities. Both states are lists of (entities, attribute, values) groups,
+# where values may be a NumPy array when the entities live in a ComponentStore.
+class BatchCommand(Command):
+    def __init__(self, oldGroups, newGroups):
+        self.oldGroups = oldGroups
+        self.newGroups = newGroups
+
+    def undo(self, database):
+        database._setProperties(self.oldGroups)
+
+    def redo(self, database):
+        database._setProperties(self.newGroups)
+
+    def encode(self):
+        encodeGroups = lambda groups: [([e.id for e in entities], attribute, values) for entities, attribute, values in groups]
+        return ("batch", encodeGroups(self.oldGroups), encodeGroups(self.newGroups))
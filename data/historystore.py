@@ -0,0 +1,111 @@
+import collections
+import pickle
+import tempfile
+import zlib
+from data.history import decodeCommand
+
+# Undo stack with a bounded memory footprint. Commands hold on to entity objects, values and (for removals)
+# whole detached subtrees, so a long session would otherwise keep growing the history until memory runs out.
+#
+# The newest commands are kept as they are. Older ones get encoded (see Command.encode, entities are referred to by id),
+# pickled and compressed in chunks, and once the compressed chunks take more than memoryBudget bytes, the oldest
+# of them are moved to a temporary file. Being a stack, the file only ever grows or shrinks at its end.
+# Undoing past the live commands decodes a whole chunk back, the scene being in the state right after its newest command.
+class HistoryStore:
+    def __init__(self, database, liveEntries=64, chunkSize=32, memoryBudget=8 * 1024 * 1024, compressionLevel=6):
+        self.database = database
+        self.liveEntries = liveEntries
+        self.chunkSize = chunkSize
+        self.memoryBudget = memoryBudget
+        self.compressionLevel = compressionLevel
+        # Commands, oldest first
+        self._live = []
+        # Compressed chunks in memory as (command count, data), oldest first
+        self._compressed = collections.deque()
+        self._compressedBytes = 0
+        # Chunks moved to the file as (command count, offset, length), oldest first
+        self._spilled = []
+        self._file = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, command):
+        self._live.append(command)
+        self._count += 1
+        # Entities still in the scene file can't be encoded, they would be missing from removed subtrees
+        if len(self._live) >= self.liveEntries + self.chunkSize and not self.database.isLoading():
+            self._compress()
+
+    # Removes and returns the newest command
+    def pop(self):
+        if len(self._live) == 0:
+            self._decompress()
+        self._count -= 1
+        return self._live.pop()
+
+    def clear(self):
+        self._live = []
+        self._compressed.clear()
+        self._compressedBytes = 0
+        self._spilled = []
+        self._count = 0
+        if self._file != None:
+            self._file.truncate(0)
+
+    def close(self):
+        self.clear()
+        if self._file != None:
+            self._file.close()
+            self._file = None
+
+    # Bytes taken by the compressed commands, in memory and in the file
+    def memoryBytes(self):
+        return self._compressedBytes
+
+    def diskBytes(self):
+        if len(self._spilled) == 0:
+            return 0
+        _, offset, length = self._spilled[-1]
+        return offset + length
+
+    # Number of commands kept as they are, compressed in memory and moved to the file
+    def counts(self):
+        return (len(self._live), sum(c for c, _ in self._compressed), sum(c for c, _, _ in self._spilled))
+
+    def _compress(self):
+        chunk = self._live[:self.chunkSize]
+        del self._live[:self.chunkSize]
+        data = zlib.compress(pickle.dumps([c.encode() for c in chunk], pickle.HIGHEST_PROTOCOL), self.compressionLevel)
+        self._compressed.append((len(chunk), data))
+        self._compressedBytes += len(data)
+        while self._compressedBytes > self.memoryBudget and len(self._compressed) > 0:
+            self._spill()
+
+    def _spill(self):
+        count, data = self._compressed.popleft()
+        self._compressedBytes -= len(data)
+        if self._file == None:
+            self._file = tempfile.TemporaryFile(prefix="history")
+        offset = self.diskBytes()
+        self._file.seek(offset)
+        self._file.write(data)
+        self._spilled.append((count, offset, len(data)))
+
+    def _decompress(self):
+        if len(self._compressed) > 0:
+            _, data = self._compressed.pop()
+            self._compressedBytes -= len(data)
+        else:
+            _, offset, length = self._spilled.pop()
+            self._file.seek(offset)
+            data = self._file.read(length)
+            self._file.truncate(offset)
+        encoded = pickle.loads(zlib.decompress(data))
+        # Newest first, see decodeCommand
+        entities = {}
+        resolve = lambda id: entities[id] if id in entities else self.database.entity(id)
+        commands = [decodeCommand(c, resolve, entities) for c in reversed(encoded)]
+        commands.reverse()
+        self._live = commands
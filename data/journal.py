@@ -0,0 +1,69 @@
+import json
+import logging
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# The edit journal is a text file of small operation records, appended to after every edit.
+# Together with the base snapshot (see Database) it describes the current scene, so an edit costs
+# as much disk I/O as the edit itself instead of a rewrite of the whole scene.
+#
+# Every line is "<crc32 of the payload, 8 hex digits> <json payload>". The first record is a header holding
+# the generation of the base snapshot the journal applies to. A record whose checksum doesn't match
+# (typically a line torn by a crash) ends the journal - it and everything after it is skipped.
+
+def encodeRecord(record):
+    payload = json.dumps(record, separators=(",", ":"))
+    return ("%08x %s\n" % (zlib.crc32(payload.encode("utf-8")), payload)).encode("utf-8")
+
+def decodeRecord(line):
+    line = line.decode("utf-8").rstrip("\n")
+    checksum, payload = line.split(" ", 1)
+    if len(checksum) != 8 or int(checksum, 16) != zlib.crc32(payload.encode("utf-8")):
+        raise ValueError("Journal record checksum mismatch")
+    return json.loads(payload)
+
+def headerRecord(generation):
+    return encodeRecord({"generation": generation})
+
+# Reads a journal file. Returns (generation, records, length), where length is the size in bytes of the
+# intact part of the file - new records must be appended from there on. Returns (None, [], 0) if there is no usable journal.
+def readJournal(path):
+    try:
+        with open(path, "rb") as f:
+            lines = f.readlines()
+    except OSError:
+        return (None, [], 0)
+
+    records = []
+    length = 0
+    for line in lines:
+        if not line.endswith(b"\n"):
+            break
+        try:
+            records.append(decodeRecord(line))
+        except (ValueError, UnicodeDecodeError):
+            break
+        length += len(line)
+    if len(records) == 0 or "generation" not in records[0]:
+        return (None, [], 0)
+    if len(records) < len(lines):
+        logger.warning("Skipping damaged journal tail: %d record(s) in %s", len(lines) - len(records), path)
+    return (records[0]["generation"], records[1:], length)
+
+# Conversion of entity attributes to and from their journal representation.
+# Vectors, rotations and colors are tuples on entities (see Entity) and lists in the journal.
+def encodeProperty(attribute, value):
+    if attribute == "position" or attribute == "dimensions" or attribute == "rotation" or attribute == "color":
+        return list(value)
+    else:
+        return value
+
+# Also normalizes values coming from elsewhere (lists, NumPy rows...) to the tuples entities hold
+def decodeProperty(attribute, value):
+    if attribute == "position" or attribute == "dimensions" or attribute == "rotation":
+        return tuple(float(x) for x in value)
+    elif attribute == "color":
+        return tuple(int(x) for x in value)
+    else:
+        return value
@@ -0,0 +1,113 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from PySide2 import QtCore
+from data.entity import MeshEntity
+from data import stl
+from data import meshlod
+from data import tracing
+
+logger = logging.getLogger(__name__)
+
+# The STL files among paths, directories being searched recursively, sorted and without duplicates
+def findMeshes(paths):
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, files in os.walk(path):
+                found.update(os.path.join(directory, f) for f in files if f.lower().endswith(".stl"))
+        else:
+            found.add(path)
+    return sorted(os.path.abspath(p) for p in found)
+
+# Bulk import of STL files. Every file is parsed, welded and validated (see stl.inspect) in a pool of processes,
+# one per core by default, so neither the GUI thread nor the GIL are held up. The workers also store the LOD chains
+# of the meshes (see meshlod.prepare), but only the reports come back - the geometry itself gets loaded by the view as usual.
+# Once every file is done, one MeshEntity per valid file is created through Database.entitiesCreated, in a single history step,
+# with its bounds already known.
+class MeshImport(QtCore.QObject):
+    # Emitted on the GUI thread with the number of files done and the total
+    onProgressSignal = QtCore.Signal(int, int)
+    # Emitted once the import is over with the list of reports (see stl.MeshReport), in path order
+    onFinishedSignal = QtCore.Signal(object)
+    _inspectedSignal = QtCore.Signal(object)
+
+    def __init__(self, database, paths, workers=None, lodDirectory=meshlod.DEFAULT_DIRECTORY, parent=None):
+        super(MeshImport, self).__init__(parent)
+        self.database = database
+        self.paths = findMeshes(paths)
+        self.workers = workers
+        self.lodDirectory = lodDirectory
+        self.reports = {}
+        self.cancelled = False
+        self._executor = None
+        self._futures = []
+        self._inspectedSignal.connect(self._onInspected)
+
+    def start(self):
+        logger.info("Importing %d meshes", len(self.paths))
+        if len(self.paths) == 0:
+            self._finish()
+            return
+        # Forking a process running Qt threads isn't safe, the workers start from a fresh interpreter instead
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        for path in self.paths:
+            future = self._executor.submit(meshlod.prepare, path, self.lodDirectory)
+            future.add_done_callback(lambda f, path=path: self._inspectedSignal.emit((path, f)))
+            self._futures.append(future)
+        self.onProgressSignal.emit(0, len(self.paths))
+
+    # Drops the files not parsed yet. Nothing gets created.
+    def cancel(self):
+        if self.cancelled or self._executor == None:
+            return
+        self.cancelled = True
+        for f in self._futures:
+            f.cancel()
+        self._shutdown()
+        self.onFinishedSignal.emit([])
+
+    def isRunning(self):
+        return self._executor != None
+
+    # Runs on the GUI thread
+    @tracing.traced()
+    def _onInspected(self, result):
+        path, future = result
+        if self.cancelled or future.cancelled():
+            return
+        try:
+            report = future.result()
+        except Exception as e:
+            # The worker process itself failed, e.g. ran out of memory
+            report = stl.MeshReport(path)
+            report.error = str(e)
+        self.reports[path] = report
+        self.onProgressSignal.emit(len(self.reports), len(self.paths))
+        if len(self.reports) == len(self.paths):
+            self._shutdown()
+            self._finish()
+
+    def _shutdown(self):
+        if self._executor != None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._futures = []
+
+    def _finish(self):
+        reports = [self.reports[p] for p in self.paths]
+        entities = []
+        for report in reports:
+            if not report.isValid():
+                logger.warning("Skipping mesh %s: %s", report.path, report.error)
+                continue
+            warnings = report.warnings()
+            if len(warnings) > 0:
+                logger.info("Mesh %s: %s", report.path, ", ".join(warnings))
+            entity = MeshEntity(report.path)
+            entity.name = os.path.splitext(os.path.basename(report.path))[0]
+            entity.setMeshBounds(report.bounds)
+            entities.append(entity)
+        self.database.entitiesCreated(entities)
+        self.onFinishedSignal.emit(reports)
@@ -0,0 +1,223 @@
+import array
+import hashlib
+import logging
+import math
+import os
+import struct
+import sys
+import tempfile
+from data import stl
+from data import tracing
+
+logger = logging.getLogger(__name__)
+
+# Level of detail chains of STL meshes, cached on disk.
+#
+# A chain starts with the welded mesh (see stl.weld), each next level having about REDUCTION times fewer triangles,
+# until LEVELS levels or fewer than MIN_TRIANGLES triangles. Levels are simplified by vertex clustering: positions are
+# merged per cell of a grid over the bounds, and triangles which lose a corner in the process disappear. Every level is
+# simplified from the welded mesh itself rather than from the previous level, so errors don't add up along the chain.
+#
+# Chains are stored by the hash of the file's content, in a directory shared by every scene: an asset is simplified once,
+# whatever its path and however many entities use it, and an edited file gets a chain of its own. The format version
+# is part of the file name, so chains made by an older version are rebuilt rather than misread.
+#
+# Layout of a chain file (little endian):
+#   header - magic "MLOD", format version (u16), level count (u16)
+#   levels - vertex count (u32), index count (u32), bounds (6 f32), then the vertices (6 f32 each, see stl.IndexedMeshData)
+#            and the indices (u32)
+
+DEFAULT_DIRECTORY = "mesh_lods"
+LEVELS = 4
+REDUCTION = 4
+MIN_TRIANGLES = 32
+
+MAGIC = b"MLOD"
+VERSION = 1
+
+_HEADER = struct.Struct("<4sHH")
+_LEVEL = struct.Struct("<II6f")
+
+def contentHash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+# Simplification of an indexed mesh down to at most targetTriangles triangles (or to a 2x2x2 grid, whichever comes first)
+def decimate(mesh, targetTriangles):
+    low, high = mesh.bounds
+    size = max(max(high[i] - low[i] for i in range(3)), 1e-12)
+    # The triangle count of a surface grows with the square of the grid's resolution
+    resolution = max(2, int(math.sqrt(mesh.triangleCount * 2)))
+    while True:
+        result = _cluster(mesh, size / resolution, low)
+        if result.triangleCount <= targetTriangles or resolution == 2:
+            return result
+        resolution = max(2, min(resolution - 1, int(resolution * math.sqrt(targetTriangles / result.triangleCount))))
+
+def _cluster(mesh, cellSize, low):
+    v = mesh.vertices
+    scale = 1.0 / cellSize
+    cells = []
+    cellIndex = {}
+    # Sum of the positions in each cell, and their count
+    sums = []
+    for i in range(0, len(v), 6):
+        x, y, z = v[i], v[i + 1], v[i + 2]
+        key = (int((x - low[0]) * scale), int((y - low[1]) * scale), int((z - low[2]) * scale))
+        c = cellIndex.get(key)
+        if c == None:
+            c = len(sums)
+            cellIndex[key] = c
+            sums.append([0.0, 0.0, 0.0, 0])
+        s = sums[c]
+        s[0] += x
+        s[1] += y
+        s[2] += z
+        s[3] += 1
+        cells.append(c)
+    positions = [(s[0] / s[3], s[1] / s[3], s[2] / s[3]) for s in sums]
+
+    faces = []
+    seen = set()
+    indices = mesh.indices
+    for t in range(0, len(indices), 3):
+        a, b, c = cells[indices[t]], cells[indices[t + 1]], cells[indices[t + 2]]
+        if a == b or b == c or a == c:
+            continue
+        # Several triangles may collapse into the same one, with the same winding
+        key = min((a, b, c), (b, c, a), (c, a, b))
+        if key in seen:
+            continue
+        seen.add(key)
+        n = stl.faceNormal(positions[a], positions[b], positions[c])
+        if n == (0.0, 0.0, 0.0):
+            continue
+        faces.append((a, b, c, n))
+    return stl.indexTriangles(positions, faces, mesh.bounds)
+
+@tracing.traced(category="io")
+def buildChain(welded):
+    chain = [welded]
+    while len(chain) < LEVELS:
+        target = chain[-1].triangleCount // REDUCTION
+        if target < MIN_TRIANGLES:
+            break
+        level = decimate(welded, target)
+        if level.triangleCount >= chain[-1].triangleCount:
+            break
+        chain.append(level)
+    return chain
+
+def _littleEndian(values):
+    if sys.byteorder == "little":
+        return values
+    values = array.array(values.typecode, values)
+    values.byteswap()
+    return values
+
+def encode(chain):
+    parts = [_HEADER.pack(MAGIC, VERSION, len(chain))]
+    for mesh in chain:
+        low, high = mesh.bounds
+        parts.append(_LEVEL.pack(mesh.vertexCount, len(mesh.indices), *(tuple(low) + tuple(high))))
+        parts.append(_littleEndian(mesh.vertices).tobytes())
+        parts.append(_littleEndian(mesh.indices).tobytes())
+    return b"".join(parts)
+
+def decode(data):
+    if len(data) < _HEADER.size:
+        raise ValueError("Truncated mesh LOD file")
+    magic, version, count = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a mesh LOD file of version %d" % VERSION)
+    offset = _HEADER.size
+    chain = []
+    for _ in range(count):
+        if offset + _LEVEL.size > len(data):
+            raise ValueError("Truncated mesh LOD file")
+        level = _LEVEL.unpack_from(data, offset)
+        vertexCount, indexCount = level[0], level[1]
+        offset += _LEVEL.size
+        end = offset + vertexCount * 24 + indexCount * 4
+        if end > len(data):
+            raise ValueError("Truncated mesh LOD file")
+        vertices = array.array("f")
+        vertices.frombytes(data[offset:offset + vertexCount * 24])
+        indices = array.array("I")
+        indices.frombytes(data[offset + vertexCount * 24:end])
+        offset = end
+        chain.append(stl.IndexedMeshData(_littleEndian(vertices), _littleEndian(indices), (level[2:5], level[5:8])))
+    return chain
+
+# Chain files in a directory, by content hash
+class LodStore:
+    def __init__(self, directory=DEFAULT_DIRECTORY):
+        self.directory = directory
+
+    def path(self, digest):
+        return os.path.join(self.directory, "%s.v%d.lod" % (digest, VERSION))
+
+    # The stored chain, None if there is none (or it can't be read, in which case it gets rebuilt)
+    def read(self, digest):
+        try:
+            with open(self.path(digest), "rb") as f:
+                return decode(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring mesh LOD file %s: %s", self.path(digest), e)
+            return None
+
+    # Written to a temporary file first, several processes may be storing the same chain at once
+    def write(self, digest, chain):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temporaryPath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(encode(chain))
+            os.replace(temporaryPath, self.path(digest))
+        except OSError:
+            os.unlink(temporaryPath)
+            raise
+
+# The stored chain of the mesh file at path, None if it wasn't built yet
+def cachedChain(path, directory=DEFAULT_DIRECTORY):
+    with open(path, "rb") as f:
+        return LodStore(directory).read(contentHash(f.read()))
+
+# The chain of the mesh file at path, built and stored if needed. Raises OSError or ValueError when the file can't be used.
+# Slow for big meshes, meant to run in another process.
+def loadChain(path, directory=DEFAULT_DIRECTORY):
+    with open(path, "rb") as f:
+        data = f.read()
+    store = LodStore(directory)
+    digest = contentHash(data)
+    chain = store.read(digest)
+    if chain != None:
+        return chain
+    report, welded = stl.validate(path, stl.parse(data))
+    if welded == None:
+        raise ValueError(report.error)
+    chain = buildChain(welded)
+    store.write(digest, chain)
+    return chain
+
+# Validates the mesh file at path as stl.inspect does, and stores the chain of a valid mesh. Never raises.
+def prepare(path, directory=DEFAULT_DIRECTORY):
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        report, welded = stl.validate(path, stl.parse(data))
+    except (OSError, ValueError) as e:
+        report = stl.MeshReport(path)
+        report.error = str(e)
+        return report
+    if welded != None:
+        store = LodStore(directory)
+        digest = contentHash(data)
+        try:
+            if not os.path.exists(store.path(digest)):
+                store.write(digest, buildChain(welded))
+        except OSError as e:
+            # The view builds it again when it needs it
+            logger.warning("Failed to store the LOD chain of %s: %s", path, e)
+    return report
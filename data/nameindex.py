@@ -0,0 +1,106 @@
+import bisect
+
+# Case-insensitive index of entity names, for the hierarchy filter.
+# Prefix queries bisect a list of (lowercase name, id) pairs kept in order, substring queries run str.find over all
+# the names joined into a single string, in the same order - a scan in C over a few bytes per entity rather than
+# a Python loop over the entities. Both give their results sorted by name.
+#
+# Single additions and removals keep the sorted list up to date in place. Bulk additions (e.g. a scene being loaded)
+# only mark it as stale, and it gets sorted again when next queried. The joined string is rebuilt lazily as well.
+class NameIndex:
+    # Joins the names in the search string. Queries containing it can't match anything.
+    _SEPARATOR = "\x00"
+
+    def __init__(self):
+        # Lowercase name per id
+        self.names = {}
+        # (lowercase name, id) pairs sorted by name, None when stale
+        self._sorted = []
+        # All names joined, the offset each of them starts at, and the ids in the same order. None when stale.
+        self._text = None
+        self._starts = None
+        self._ids = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, id):
+        return id in self.names
+
+    def add(self, id, name):
+        lower = name.lower()
+        self.names[id] = lower
+        if self._sorted != None:
+            bisect.insort(self._sorted, (lower, id))
+        self._text = None
+
+    def addMany(self, pairs):
+        for id, name in pairs:
+            self.names[id] = name.lower()
+        self._sorted = None
+        self._text = None
+
+    def remove(self, id):
+        lower = self.names.pop(id, None)
+        if lower == None:
+            return
+        if self._sorted != None:
+            del self._sorted[bisect.bisect_left(self._sorted, (lower, id))]
+        self._text = None
+
+    def rename(self, id, name):
+        self.remove(id)
+        self.add(id, name)
+
+    # Ids of the entities whose name starts with text, at most limit of them.
+    # With accept, only the ids it returns true for are listed (and count towards the limit).
+    def prefix(self, text, limit=None, accept=None):
+        text = text.lower()
+        entries = self._sortedEntries()
+        result = []
+        for i in range(bisect.bisect_left(entries, (text,)), len(entries)):
+            name, id = entries[i]
+            if not name.startswith(text) or len(result) == limit:
+                break
+            if accept == None or accept(id):
+                result.append(id)
+        return result
+
+    # Ids of the entities whose name contains text, at most limit of them. See prefix for accept.
+    def search(self, text, limit=None, accept=None):
+        text = text.lower()
+        if text == "":
+            return self.prefix(text, limit, accept)
+        if NameIndex._SEPARATOR in text:
+            return []
+        self._build()
+        result = []
+        starts = self._starts
+        offset = self._text.find(text)
+        while offset != -1 and len(result) != limit:
+            i = bisect.bisect_right(starts, offset) - 1
+            if accept == None or accept(self._ids[i]):
+                result.append(self._ids[i])
+            # Carry on from the next name, a name containing the text several times is only reported once
+            if i + 1 == len(starts):
+                break
+            offset = self._text.find(text, starts[i + 1])
+        return result
+
+    def _sortedEntries(self):
+        if self._sorted == None:
+            self._sorted = sorted((name, id) for id, name in self.names.items())
+        return self._sorted
+
+    def _build(self):
+        if self._text != None:
+            return
+        entries = self._sortedEntries()
+        starts = []
+        offset = 0
+        for name, _ in entries:
+            starts.append(offset)
+            offset += len(name) + 1
+        self._text = NameIndex._SEPARATOR.join(name for name, _ in entries)
+        self._starts = starts
+        self._ids = [id for _, id in entries]
@@ -0,0 +1,477 @@
+import contextlib
+import gc
+import json
+import struct
+from data.entity import Entity, SphereEntity, CubeEntity, MeshEntity, restore, linkChildren
+from data.versions import EntityVersion
+from data import tracing
+
+# Compact binary scene format.
+#
+# Layout (little endian):
+#   header   - magic "SCNB", format version (u16), reserved (u16), generation (u32), string count (u32), record count (u32),
+#              next entity id (u64) - higher than the id of any entity in the file
+#   strings  - string count + 1 offsets (u32) into the UTF-8 bytes of all the strings, which follow them.
+#              Holds entity names and mesh paths, and any string can be decoded without reading the others.
+#   records  - record count fixed-width entity records (see _RECORD), in depth-first pre-order.
+#              Each record stores the number of its direct children, which is enough to rebuild the tree,
+#              and the number of its descendants, so that whole subtrees can be skipped (see data/streaming.py).
+#
+# Older files can still be read: version 2 (no entity ids) and version 1 (strings as a length followed by the bytes,
+# records without the descendant count either).
+#
+# Entities without an id in the file (older versions, scenes saved outside of Database) are given the next entity id
+# plus the index of their record, so that they get the same ids every time the file is loaded.
+#
+# The generation is not part of the scene itself - it is used by the cache to match the base snapshot with its journal.
+# The JSON format produced by Entity.toDict is still supported for reading, see loadScene.
+
+MAGIC = b"SCNB"
+VERSION = 3
+
+_HEADER = struct.Struct("<4sHHIII")
+_NEXT_ID = struct.Struct("<Q")
+_LENGTH = struct.Struct("<I")
+# kind, red, green, blue, child count, name index, position (3), rotation (scalar, x, y, z), shape (3), mesh path index,
+# descendant count, entity id (0 for none). Shape holds the cube dimensions or, in its first component, the sphere radius.
+_RECORD = struct.Struct("<BBBBII3f4f3fIIQ")
+_RECORD_V2 = struct.Struct("<BBBBII3f4f3fII")
+_RECORD_V1 = struct.Struct("<BBBBII3f4f3fI")
+_RECORDS = {1: _RECORD_V1, 2: _RECORD_V2, 3: _RECORD}
+_NO_STRING = 0xFFFFFFFF
+
+_ENTITY = 0
+_SPHERE = 1
+_CUBE = 2
+_MESH = 3
+# Record kind of each entity type identifier, see Entity.toDict
+_KINDS = {"Entity": _ENTITY, "Sphere": _SPHERE, "Cube": _CUBE, "Mesh": _MESH}
+# Entity type of each record kind
+_TYPES = {_ENTITY: Entity, _SPHERE: SphereEntity, _CUBE: CubeEntity, _MESH: MeshEntity}
+
+# Flattens the tree into plain tuples. Cheap, and the result isn't affected by later edits, so it can be packed on another thread.
+# Trees bound to a ComponentStore are flattened into a NumPy record array instead, copying whole component columns at once.
+@tracing.traced(category="serialization")
+def snapshot(root):
+    if root._store != None:
+        return _snapshotColumns(root)
+
+    records = []
+    strings = []
+    stringIndices = {}
+
+    def intern(s):
+        i = stringIndices.get(s)
+        if i == None:
+            i = len(strings)
+            stringIndices[s] = i
+            strings.append(s)
+        return i
+
+    stack = [root]
+    while len(stack) > 0:
+        entity = stack.pop()
+        p = entity.position
+        r = entity.rotation
+        c = entity.color
+        shape = (0.0, 0.0, 0.0)
+        meshIndex = _NO_STRING
+        if isinstance(entity, SphereEntity):
+            kind = _SPHERE
+            shape = (entity.radius, 0.0, 0.0)
+        elif isinstance(entity, CubeEntity):
+            kind = _CUBE
+            d = entity.dimensions
+            shape = d
+        elif isinstance(entity, MeshEntity):
+            kind = _MESH
+            if entity.meshPath != None:
+                meshIndex = intern(entity.meshPath)
+        else:
+            kind = _ENTITY
+        records.append((kind, c[0], c[1], c[2], len(entity.children), intern(entity.name),
+            p[0], p[1], p[2], r[0], r[1], r[2], r[3], shape[0], shape[1], shape[2], meshIndex, entity.id or 0))
+        # Reversed so that children come out of the stack in order
+        stack.extend(reversed(entity.children))
+    return (records, strings)
+
+# Records of a streamed scene file which weren't loaded yet (see data/streaming.py), to be packed again along with
+# a version of the loaded part of the scene. Only their positions are known up front: the records themselves (and the
+# strings) get read when flattened, on the thread packing them, through a file of their own.
+class UnloadedRecords:
+    def __init__(self, file, header, subtrees):
+        # Opened on the scene file, which it keeps readable even once the file got replaced or the stream closed
+        self.file = file
+        self.header = header
+        # (child count, index of the first record, record count) of each subtree still in the file,
+        # by the id of the loaded entity it belongs under
+        self.subtrees = subtrees
+        self._strings = None
+
+    # Records of a subtree in the layout of _flattenVersion, with strings interned anew
+    def flatten(self, subtree, intern):
+        header = self.header
+        if self._strings == None:
+            self._strings = Strings(self._read(0, header.recordsOffset), header)
+        strings = self._strings
+        size = header.recordStruct.size
+        data = self._read(header.recordsOffset + subtree[1] * size, subtree[2] * size)
+        records = []
+        for i, r in enumerate(header.recordStruct.iter_unpack(data), subtree[1]):
+            meshIndex = intern(strings[r[16]]) if r[16] != _NO_STRING else _NO_STRING
+            id = r[18] if len(r) > 18 and r[18] != 0 else header.nextId + i
+            records.append(r[:5] + (intern(strings[r[5]]),) + r[6:16] + (meshIndex, id))
+        return records
+
+    def close(self):
+        self.file.close()
+
+    def _read(self, offset, size):
+        self.file.seek(offset)
+        data = self.file.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated binary scene file")
+        return data
+
+# Flattens a version of the tree (see data/versions.py) like snapshot does with entities.
+# Versions are immutable, so unlike entities they can be flattened on another thread.
+# The subtrees of unloaded (see UnloadedRecords) go under the entities of the version which have no children yet.
+def _flattenVersion(root, unloaded=None):
+    records = []
+    strings = []
+    stringIndices = {}
+
+    def intern(s):
+        i = stringIndices.get(s)
+        if i == None:
+            i = len(strings)
+            stringIndices[s] = i
+            strings.append(s)
+        return i
+
+    stack = [root]
+    while len(stack) > 0:
+        v = stack.pop()
+        p = v.position
+        r = v.rotation
+        c = v.color
+        shape = (0.0, 0.0, 0.0)
+        meshIndex = _NO_STRING
+        kind = _KINDS[v.kind]
+        if kind == _SPHERE:
+            shape = (v.radius, 0.0, 0.0)
+        elif kind == _CUBE:
+            shape = v.dimensions
+        elif kind == _MESH and v.meshPath != None:
+            meshIndex = intern(v.meshPath)
+        childCount = len(v.children)
+        subtree = unloaded.subtrees.get(v.id) if unloaded != None and childCount == 0 else None
+        if subtree != None:
+            childCount = subtree[0]
+        records.append((kind, c[0], c[1], c[2], childCount, intern(v.name),
+            p[0], p[1], p[2], r[0], r[1], r[2], r[3], shape[0], shape[1], shape[2], meshIndex, v.id or 0))
+        if subtree != None:
+            records.extend(unloaded.flatten(subtree, intern))
+        stack.extend(reversed(v.children))
+    return (records, strings)
+
+# Packs a snapshot, a version of the tree, or a (version, UnloadedRecords) pair, into the binary format
+@tracing.traced(category="serialization")
+def pack(flattened, generation=0):
+    if isinstance(flattened, EntityVersion):
+        flattened = _flattenVersion(flattened)
+    elif isinstance(flattened[0], EntityVersion):
+        version, unloaded = flattened
+        try:
+            flattened = _flattenVersion(version, unloaded)
+        finally:
+            unloaded.close()
+    records, strings = flattened
+    if isinstance(records, list):
+        nextId = max((r[17] for r in records), default=0) + 1
+    else:
+        nextId = int(records["id"].max()) + 1 if len(records) > 0 else 1
+    parts = [_HEADER.pack(MAGIC, VERSION, 0, generation, len(strings), len(records)), _NEXT_ID.pack(nextId)]
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = [0]
+    for b in encoded:
+        offsets.append(offsets[-1] + len(b))
+    parts.append(struct.pack("<" + str(len(offsets)) + "I", *offsets))
+    parts.extend(encoded)
+    if isinstance(records, list):
+        descendants = _descendantCounts([r[4] for r in records])
+        recordPack = _RECORD.pack
+        parts.extend(recordPack(*r[:17], d, r[17]) for r, d in zip(records, descendants))
+    else:
+        records["descendants"] = _descendantCounts(records["children"].tolist())
+        parts.append(records.tobytes())
+    return b"".join(parts)
+
+# Number of descendants of every record, from the child counts of records in pre-order
+def _descendantCounts(childCounts):
+    counts = [0] * len(childCounts)
+    # Walking backwards, the subtrees of a record's children are complete (and on top of the stack) when the record is reached
+    stack = []
+    for i in range(len(childCounts) - 1, -1, -1):
+        total = 0
+        for _ in range(childCounts[i]):
+            total += stack.pop() + 1
+        counts[i] = total
+        stack.append(total)
+    return counts
+
+def dumps(root, generation=0):
+    return pack(snapshot(root), generation)
+
+def isBinary(data):
+    return data[:len(MAGIC)] == MAGIC
+
+# Parsed header of binary scene data: where the strings and the records are, and how many there are of each
+class Header:
+    def __init__(self, data):
+        magic, self.version, _, self.generation, self.stringCount, self.recordCount = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a binary scene file")
+        if self.version not in _RECORDS:
+            raise ValueError("Unsupported binary scene version " + str(self.version))
+        self.recordStruct = _RECORDS[self.version]
+        self.size = _HEADER.size
+        self.nextId = 1
+        if self.version >= 3:
+            (self.nextId,) = _NEXT_ID.unpack_from(data, _HEADER.size)
+            self.size += _NEXT_ID.size
+        # Above the ids of all the entities once loaded, including those given to entities without one
+        self.freeId = self.nextId + self.recordCount
+        if self.version == 1:
+            self.stringsOffset = _HEADER.size
+            offset = self.stringsOffset
+            for _ in range(self.stringCount):
+                (length,) = _LENGTH.unpack_from(data, offset)
+                offset += _LENGTH.size + length
+            self.recordsOffset = offset
+        else:
+            self.stringsOffset = self.size + (self.stringCount + 1) * _LENGTH.size
+            (length,) = _LENGTH.unpack_from(data, self.stringsOffset - _LENGTH.size)
+            self.recordsOffset = self.stringsOffset + length
+        if self.recordCount == 0 or self.recordsOffset + self.recordCount * self.recordStruct.size > len(data):
+            raise ValueError("Truncated binary scene file")
+
+# The strings of version 2 (and later) data, decoded one at a time when asked for
+class Strings:
+    def __init__(self, data, header):
+        self.data = data
+        self.indexOffset = header.size
+        self.stringsOffset = header.stringsOffset
+
+    def __getitem__(self, i):
+        start, end = struct.unpack_from("<II", self.data, self.indexOffset + i * _LENGTH.size)
+        return bytes(self.data[self.stringsOffset + start:self.stringsOffset + end]).decode("utf-8")
+
+def _readStrings(data, header):
+    if header.version != 1:
+        # All the offsets at once, and all the bytes in one piece
+        offsets = struct.unpack_from("<" + str(header.stringCount + 1) + "I", data, header.size)
+        text = bytes(data[header.stringsOffset:header.recordsOffset])
+        return [text[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(header.stringCount)]
+    strings = []
+    offset = header.stringsOffset
+    for _ in range(header.stringCount):
+        (length,) = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        strings.append(bytes(data[offset:offset + length]).decode("utf-8"))
+        offset += length
+    return strings
+
+# Rebuilds the whole entity tree from binary data at once. Returns (root, generation).
+# When a ComponentStore is given, the entities are bound to it and their components are copied over column by column.
+@tracing.traced(category="serialization")
+def loads(data, store=None):
+    header = Header(data)
+    strings = _readStrings(data, header)
+    offset = header.recordsOffset
+    recordCount = header.recordCount
+    generation = header.generation
+    end = offset + recordCount * header.recordStruct.size
+
+    with _collectionPaused():
+        if store != None:
+            return (_loadColumns(data, offset, recordCount, strings, store, header), generation)
+        nextId = header.nextId
+        records = list(header.recordStruct.iter_unpack(memoryview(data)[offset:end]))
+        entities = [_entityFromRecord(r, strings, nextId + i) for i, r in enumerate(records)]
+        return (_link(entities, [r[4] for r in records]), generation)
+
+# The cyclic garbage collector keeps going over all the objects created so far while a scene gets loaded, which takes
+# about as long as loading itself. None of them can be garbage yet, so collection is paused meanwhile.
+@contextlib.contextmanager
+def _collectionPaused():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+# Links restored entities, in record order, into a tree according to their child counts. Returns the root.
+# Each family gets linked at once, when its last child comes (see entity.linkChildren).
+def _link(entities, childCounts):
+    # Entities still waiting for some of their children, with the number of children missing and the children so far
+    stack = []
+    for entity, childCount in zip(entities, childCounts):
+        if len(stack) > 0:
+            parent = stack[-1]
+            parent[2].append(entity)
+            parent[1] -= 1
+            if parent[1] == 0:
+                linkChildren(parent[0], parent[2])
+                stack.pop()
+        if childCount > 0:
+            stack.append([entity, childCount, []])
+        elif len(stack) == 0:
+            break
+    return entities[0]
+
+def _entityFromRecord(r, strings, defaultId):
+    kind = r[0]
+    extra = None
+    if kind == _SPHERE:
+        extra = r[13]
+    elif kind == _CUBE:
+        extra = (r[13], r[14], r[15])
+    elif kind == _MESH and r[16] != _NO_STRING:
+        extra = strings[r[16]]
+    return restore(_TYPES.get(kind, Entity), r[18] if len(r) > 18 and r[18] != 0 else defaultId, strings[r[5]],
+        (r[6], r[7], r[8]), (r[9], r[10], r[11], r[12]), (r[1], r[2], r[3]), extra)
+
+# Entity of the given record kind, for entities about to be bound to a ComponentStore: the components, shape included,
+# are left to the store (see entity.restore)
+def _newEntity(kind, id, name, mesh, strings):
+    return restore(_TYPES.get(kind, Entity), id, name, None, None, None,
+        strings[mesh] if kind == _MESH and mesh != _NO_STRING else None)
+
+# Same layout as _RECORD (or _RECORD_V1), used for the ComponentStore code paths
+def _recordType(version=VERSION):
+    import numpy
+    fields = [("kind", "u1"), ("color", "u1", (3,)), ("children", "<u4"), ("name", "<u4"),
+        ("position", "<f4", (3,)), ("rotation", "<f4", (4,)), ("shape", "<f4", (3,)), ("mesh", "<u4")]
+    if version >= 2:
+        fields.append(("descendants", "<u4"))
+    if version >= 3:
+        fields.append(("id", "<u8"))
+    return numpy.dtype(fields)
+
+def _snapshotColumns(root):
+    import numpy
+    store = root._store
+    kinds = []
+    childCounts = []
+    names = []
+    meshes = []
+    ids = []
+    rows = []
+    strings = []
+    stringIndices = {}
+
+    def intern(s):
+        i = stringIndices.get(s)
+        if i == None:
+            i = len(strings)
+            stringIndices[s] = i
+            strings.append(s)
+        return i
+
+    stack = [root]
+    while len(stack) > 0:
+        entity = stack.pop()
+        meshIndex = _NO_STRING
+        if isinstance(entity, SphereEntity):
+            kind = _SPHERE
+        elif isinstance(entity, CubeEntity):
+            kind = _CUBE
+        elif isinstance(entity, MeshEntity):
+            kind = _MESH
+            if entity.meshPath != None:
+                meshIndex = intern(entity.meshPath)
+        else:
+            kind = _ENTITY
+        kinds.append(kind)
+        childCounts.append(len(entity.children))
+        names.append(intern(entity.name))
+        meshes.append(meshIndex)
+        ids.append(entity.id or 0)
+        rows.append(entity._row)
+        stack.extend(reversed(entity.children))
+
+    records = numpy.zeros(len(rows), _recordType())
+    records["kind"] = kinds
+    records["children"] = childCounts
+    records["name"] = names
+    records["mesh"] = meshes
+    records["id"] = ids
+    rows = numpy.array(rows)
+    records["color"] = store.colors[rows]
+    records["position"] = store.positions[rows]
+    records["rotation"] = store.rotations[rows]
+    records["shape"] = store.shapes[rows]
+    # Only cubes and spheres have a shape
+    records["shape"][(records["kind"] != _CUBE) & (records["kind"] != _SPHERE)] = 0
+    return (records, strings)
+
+def _loadColumns(data, offset, recordCount, strings, store, header):
+    import numpy
+    records = numpy.frombuffer(data, _recordType(header.version), recordCount, offset)
+    rows = store.allocateBlock(recordCount)
+    store.colors[rows] = records["color"]
+    store.positions[rows] = records["position"]
+    store.rotations[rows] = records["rotation"]
+    store.shapes[rows] = records["shape"]
+
+    ids = records["id"].tolist() if header.version >= 3 else [0] * recordCount
+
+    nextId = header.nextId
+    entities = [_newEntity(kind, id if id != 0 else nextId + i, strings[name], mesh, strings)
+        for i, (kind, id, name, mesh) in enumerate(zip(records["kind"].tolist(), ids, records["name"].tolist(), records["mesh"].tolist()))]
+    for entity, row in zip(entities, rows.tolist()):
+        store.adopt(entity, row)
+    return _link(entities, records["children"].tolist())
+
+# Loads a scene file in either format. Returns (root, generation).
+# JSON files may hold either a bare entity tree (as exported) or {"generation": ..., "root": ...} (older caches).
+# When a ComponentStore is given, entities loaded from the binary format are bound to it right away.
+def loadScene(path, store=None):
+    with open(path, "rb") as f:
+        data = f.read()
+    if isBinary(data):
+        return loads(data, store)
+    j = json.loads(data.decode("utf-8"))
+    generation = 0
+    if "root" in j:
+        generation = j["generation"]
+        j = j["root"]
+    root = Entity.fromDict(j)
+    _assignMissingIds(root)
+    return (root, generation)
+
+# Gives ids to the entities of a tree which don't have one, in pre-order after the highest id in use
+def _assignMissingIds(root):
+    entities = []
+    stack = [root]
+    while len(stack) > 0:
+        entity = stack.pop()
+        entities.append(entity)
+        stack.extend(reversed(entity.children))
+    nextId = max((e.id for e in entities if e.id != None), default=0) + 1
+    for e in entities:
+        if e.id == None:
+            e.id = nextId
+            nextId += 1
+
+# Saves a scene file, either in the binary format or as JSON (for export)
+def saveScene(root, path, binary=True):
+    if binary:
+        data = dumps(root)
+    else:
+        data = json.dumps(root.toDict(), indent=2).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(data)
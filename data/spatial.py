@@ -0,0 +1,144 @@
+import math
+from PySide2 import QtCore
+from data import bvh
+from data import transform
+from data.entity import SphereEntity
+
+# Spatial index of the scene: a DynamicBvh over the world space bounds of cubes, spheres and meshes (see Entity.worldBounds).
+# Kept up to date from the database signals - a move or rotation updates the entity and its subtree only, and leaves
+# which stay within their enlarged box don't touch the tree at all.
+class SpatialIndex(QtCore.QObject):
+    def __init__(self, database, margin=0.1, parent=None):
+        super(SpatialIndex, self).__init__(parent)
+        self.database = database
+        self.tree = bvh.DynamicBvh(margin)
+
+        for c in self.database.root.children:
+            self._insert(c)
+
+        self.database.onEntityCreatedSignal.connect(self._insert)
+        self.database.onEntityDestroyedSignal.connect(self._remove)
+        self.database.onEntityMovedSignal.connect(self.onEntityTransformed)
+        self.database.onEntityRotatedSignal.connect(self.onEntityTransformed)
+        self.database.onEntityCubeDimensionsChangedSignal.connect(self.onEntityShapeChanged)
+        self.database.onEntitySphereDimensionsChangedSignal.connect(self.onEntityShapeChanged)
+        self.database.onEntitiesChangedSignal.connect(self.onEntitiesChanged)
+        self.database.onEntityChildrenLoadedSignal.connect(self.onEntityChildrenLoaded)
+        # The world transforms of a moved subtree change along with its parent
+        self.database.onEntityReparentedSignal.connect(self._updateSubtree)
+
+    def __len__(self):
+        return len(self.tree)
+
+    # Closest entity hit by a ray, as (entity, distance along direction), or (None, None).
+    # Hits are tested against the actual shapes, not only their bounding boxes.
+    def raycast(self, origin, direction, maxDistance=math.inf):
+        return self.tree.raycast(tuple(origin), tuple(direction), self._hitTest, maxDistance)
+
+    # Entities whose world bounds overlap a (min x, min y, min z, max x, max y, max z) box
+    def queryBox(self, box):
+        return self.tree.queryBox(box)
+
+    # Entities whose world bounds are at least partially inside the frustum given by its (a, b, c, d) planes
+    def queryFrustum(self, planes):
+        return self.tree.queryFrustum(planes)
+
+    # Entity whose world bounds are closest to a point, as (entity, distance), or (None, None)
+    def nearest(self, point):
+        return self.tree.nearest(tuple(point), lambda e, p: math.sqrt(bvh.distanceSquaredToBox(p, e.worldBounds())))
+
+    # Updates the bounds of an entity (e.g. once its mesh got loaded)
+    def refresh(self, entity):
+        self._updateShape(entity)
+
+    def onEntityTransformed(self, entity, _):
+        self._updateSubtree(entity)
+
+    def onEntityShapeChanged(self, entity, _):
+        self._updateShape(entity)
+
+    def onEntitiesChanged(self, changes):
+        updated = set()
+        moved = []
+        for attribute in ("position", "rotation"):
+            for e in changes.get(attribute, ()):
+                if e not in updated:
+                    moved.extend(self._subtree(e, updated))
+        # Transforms of the whole batch are computed column-wise when the entities live in a ComponentStore
+        if self.database.store != None:
+            self.database.store.updateWorldTransforms(moved)
+        for e in moved:
+            self._place(e)
+        for attribute in ("dimensions", "radius"):
+            for e in changes.get(attribute, ()):
+                if e not in updated:
+                    self._updateShape(e)
+
+    def onEntityChildrenLoaded(self, entity):
+        for c in entity.children:
+            self._place(c)
+
+    def _insert(self, entity):
+        self._updateSubtree(entity)
+
+    def _remove(self, entity):
+        for e in self._subtree(entity):
+            self.tree.remove(e)
+
+    # Updates the bounds of an entity and its descendants, whose world transforms changed
+    def _updateSubtree(self, entity):
+        for e in self._subtree(entity):
+            self._place(e)
+
+    # The entity and its descendants, parents first, skipping the ones in (and adding them to) visited
+    def _subtree(self, entity, visited=None):
+        result = []
+        stack = [entity]
+        while len(stack) > 0:
+            e = stack.pop()
+            if visited != None:
+                if e in visited:
+                    continue
+                visited.add(e)
+            result.append(e)
+            stack.extend(reversed(e.children))
+        return result
+
+    def _updateShape(self, entity):
+        if entity in self.tree:
+            self._place(entity)
+
+    def _place(self, entity):
+        bounds = entity.worldBounds()
+        if bounds == None:
+            self.tree.remove(entity)
+        else:
+            self.tree.update(entity, bounds)
+
+    # Exact hit of a world space ray against an entity's shape. The ray is brought into the entity's local space,
+    # where distances along it are the same as in world space, since the direction isn't renormalized.
+    def _hitTest(self, entity, origin, direction):
+        inverse = transform.inverse(entity.worldTransform())
+        if inverse == None:
+            return bvh.rayBox(origin, tuple(1.0 / d if d != 0 else math.inf for d in direction), entity.worldBounds(), math.inf)
+        o = transform.applyPoint(inverse, origin)
+        d = transform.applyDirection(inverse, direction)
+        if isinstance(entity, SphereEntity):
+            return self._raySphere(o, d, (0.0, 0.0, 0.0), float(entity.radius))
+        center, half = entity.localBounds()
+        box = (center[0] - half[0], center[1] - half[1], center[2] - half[2], center[0] + half[0], center[1] + half[1], center[2] + half[2])
+        return bvh.rayBox(o, tuple(1.0 / x if x != 0 else math.inf for x in d), box, math.inf)
+
+    def _raySphere(self, origin, direction, center, radius):
+        oc = (origin[0] - center[0], origin[1] - center[1], origin[2] - center[2])
+        a = direction[0] ** 2 + direction[1] ** 2 + direction[2] ** 2
+        b = 2 * (oc[0] * direction[0] + oc[1] * direction[1] + oc[2] * direction[2])
+        c = oc[0] ** 2 + oc[1] ** 2 + oc[2] ** 2 - radius * radius
+        discriminant = b * b - 4 * a * c
+        if a == 0 or discriminant < 0:
+            return None
+        root = math.sqrt(discriminant)
+        t = (-b - root) / (2 * a)
+        if t < 0:
+            t = (-b + root) / (2 * a)
+        return t if t >= 0 else None
@@ -0,0 +1,264 @@
+import array
+import math
+import re
+import struct
+from data import tracing
+
+# Reading of STL meshes (binary and ASCII) into flat vertex data ready to be uploaded to the GPU.
+# Doesn't depend on Qt, so it can run on worker threads and processes.
+
+_BINARY_HEADER = 80
+_BINARY_TRIANGLE = struct.Struct("<12fH")
+_ASCII_NUMBER = r"([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)"
+_ASCII_FACET = re.compile(r"facet\s+normal\s+" + r"\s+".join([_ASCII_NUMBER] * 3))
+_ASCII_VERTEX = re.compile(r"vertex\s+" + r"\s+".join([_ASCII_NUMBER] * 3))
+
+# Triangle soup: every triangle has its own 3 vertices, each made of a position and a normal (6 floats, interleaved)
+class MeshData:
+    def __init__(self, vertices, bounds):
+        self.vertices = vertices
+        self.vertexCount = len(vertices) // 6
+        # ((min x, min y, min z), (max x, max y, max z))
+        self.bounds = bounds
+
+    # Size of the vertex data in bytes
+    def byteSize(self):
+        return self.vertexCount * 24
+
+@tracing.traced(category="io")
+def load(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    return parse(data)
+
+def parse(data):
+    if _isBinary(data):
+        triangles = _binaryTriangles(data)
+    else:
+        triangles = _asciiTriangles(data.decode("ascii", "replace"))
+    return _buildMeshData(triangles)
+
+# ASCII files start with "solid", but so do some binary ones - the size check settles it
+def _isBinary(data):
+    if len(data) < _BINARY_HEADER + 4:
+        return False
+    (count,) = struct.unpack_from("<I", data, _BINARY_HEADER)
+    if len(data) == _BINARY_HEADER + 4 + count * _BINARY_TRIANGLE.size:
+        return True
+    return not data.lstrip()[:5].lower() == b"solid"
+
+# Yields (normal, v1, v2, v3) tuples
+def _binaryTriangles(data):
+    (count,) = struct.unpack_from("<I", data, _BINARY_HEADER)
+    start = _BINARY_HEADER + 4
+    end = start + count * _BINARY_TRIANGLE.size
+    if end > len(data):
+        raise ValueError("Truncated binary STL file")
+    for t in _BINARY_TRIANGLE.iter_unpack(memoryview(data)[start:end]):
+        yield (t[0:3], t[3:6], t[6:9], t[9:12])
+
+def _asciiTriangles(text):
+    normals = [tuple(float(x) for x in m) for m in _ASCII_FACET.findall(text)]
+    vertices = [tuple(float(x) for x in m) for m in _ASCII_VERTEX.findall(text)]
+    if len(vertices) != len(normals) * 3:
+        raise ValueError("Malformed ASCII STL file")
+    for i, n in enumerate(normals):
+        yield (n, vertices[3 * i], vertices[3 * i + 1], vertices[3 * i + 2])
+
+# Normal of a triangle computed from its vertices, used when the file doesn't provide a usable one
+def faceNormal(v1, v2, v3):
+    ax, ay, az = v2[0] - v1[0], v2[1] - v1[1], v2[2] - v1[2]
+    bx, by, bz = v3[0] - v1[0], v3[1] - v1[1], v3[2] - v1[2]
+    nx, ny, nz = ay * bz - az * by, az * bx - ax * bz, ax * by - ay * bx
+    length = math.sqrt(nx * nx + ny * ny + nz * nz)
+    if length == 0:
+        return (0.0, 0.0, 0.0)
+    return (nx / length, ny / length, nz / length)
+
+def _buildMeshData(triangles):
+    vertices = array.array("f")
+    low = [math.inf] * 3
+    high = [-math.inf] * 3
+    for n, v1, v2, v3 in triangles:
+        if n[0] == 0 and n[1] == 0 and n[2] == 0:
+            n = faceNormal(v1, v2, v3)
+        for v in (v1, v2, v3):
+            vertices.extend(v)
+            vertices.extend(n)
+            for i in range(3):
+                if v[i] < low[i]:
+                    low[i] = v[i]
+                if v[i] > high[i]:
+                    high[i] = v[i]
+    if len(vertices) == 0:
+        low = [0.0] * 3
+        high = [0.0] * 3
+    return MeshData(vertices, (tuple(low), tuple(high)))
+
+# Triangles sharing their vertices: positions closer than the welding tolerance are merged, and corners of triangles
+# with the same normal at the same position share a vertex (6 floats, interleaved as in MeshData), so shading stays flat.
+class IndexedMeshData:
+    def __init__(self, vertices, indices, bounds):
+        self.vertices = vertices
+        self.vertexCount = len(vertices) // 6
+        # 3 vertex indices per triangle
+        self.indices = indices
+        self.triangleCount = len(indices) // 3
+        self.bounds = bounds
+        # Triangles dropped because they had no area once welded
+        self.degenerate = 0
+        # Triangles whose normal in the file pointed against their winding
+        self.flipped = 0
+        # Edges of a single triangle (holes in the surface), and edges shared by more than two triangles
+        self.boundaryEdges = 0
+        self.nonManifoldEdges = 0
+
+    def byteSize(self):
+        return self.vertexCount * 24 + len(self.indices) * 4
+
+    def isWatertight(self):
+        return self.boundaryEdges == 0 and self.nonManifoldEdges == 0
+
+# Welds a triangle soup into an indexed mesh. Positions are merged on a grid of tolerance sized cells,
+# by default a millionth of the diagonal of the bounds. Normals are recomputed from the welded triangles' winding.
+def weld(mesh, tolerance=None):
+    v = mesh.vertices
+    low, high = mesh.bounds
+    if tolerance == None:
+        tolerance = max(math.sqrt(sum((high[i] - low[i]) ** 2 for i in range(3))) * 1e-6, 1e-12)
+    scale = 1.0 / tolerance
+    positions = []
+    positionIndex = {}
+    corners = []
+    for i in range(0, len(v), 6):
+        key = (round(v[i] * scale), round(v[i + 1] * scale), round(v[i + 2] * scale))
+        j = positionIndex.get(key)
+        if j == None:
+            j = len(positions)
+            positionIndex[key] = j
+            positions.append((v[i], v[i + 1], v[i + 2]))
+        corners.append(j)
+
+    faces = []
+    edges = {}
+    degenerate = 0
+    flipped = 0
+    for t in range(0, len(corners), 3):
+        a, b, c = corners[t], corners[t + 1], corners[t + 2]
+        n = faceNormal(positions[a], positions[b], positions[c])
+        if a == b or b == c or a == c or n == (0.0, 0.0, 0.0):
+            degenerate += 1
+            continue
+        o = t * 6 + 3
+        if v[o] * n[0] + v[o + 1] * n[1] + v[o + 2] * n[2] < 0:
+            flipped += 1
+        for e in ((a, b), (b, c), (c, a)):
+            e = (e[0], e[1]) if e[0] < e[1] else (e[1], e[0])
+            edges[e] = edges.get(e, 0) + 1
+        faces.append((a, b, c, n))
+
+    result = indexTriangles(positions, faces, mesh.bounds)
+    result.degenerate = degenerate
+    result.flipped = flipped
+    for count in edges.values():
+        if count == 1:
+            result.boundaryEdges += 1
+        elif count > 2:
+            result.nonManifoldEdges += 1
+    return result
+
+# Indexed mesh of (a, b, c, normal) faces over a list of positions. Corners sharing a position and a normal share a vertex.
+def indexTriangles(positions, faces, bounds):
+    vertices = array.array("f")
+    indices = array.array("I")
+    vertexIndex = {}
+    for a, b, c, n in faces:
+        # Normals of coplanar triangles only differ by rounding errors
+        normalKey = (round(n[0] * 1e5), round(n[1] * 1e5), round(n[2] * 1e5))
+        for j in (a, b, c):
+            key = (j, normalKey)
+            index = vertexIndex.get(key)
+            if index == None:
+                index = len(vertexIndex)
+                vertexIndex[key] = index
+                vertices.extend(positions[j])
+                vertices.extend(n)
+            indices.append(index)
+    return IndexedMeshData(vertices, indices, bounds)
+
+# Outcome of checking a mesh file, see inspect. Plain values only, so it can be sent back from another process.
+class MeshReport:
+    def __init__(self, path):
+        self.path = path
+        # Reason the file can't be used, None if it can
+        self.error = None
+        self.bounds = None
+        self.triangles = 0
+        # Vertex count once welded
+        self.vertices = 0
+        self.degenerate = 0
+        self.flipped = 0
+        self.boundaryEdges = 0
+        self.nonManifoldEdges = 0
+
+    def isValid(self):
+        return self.error == None
+
+    # Problems which don't prevent the mesh from being used, as a list of strings
+    def warnings(self):
+        result = []
+        if self.degenerate > 0:
+            result.append("%d degenerate triangles" % self.degenerate)
+        if self.flipped > 0:
+            result.append("%d normals against the winding" % self.flipped)
+        if self.boundaryEdges > 0:
+            result.append("%d open edges" % self.boundaryEdges)
+        if self.nonManifoldEdges > 0:
+            result.append("%d non-manifold edges" % self.nonManifoldEdges)
+        return result
+
+# Loads, welds and validates a mesh file. Never raises: failures end up in the report's error.
+def inspect(path):
+    try:
+        mesh = load(path)
+    except (OSError, ValueError) as e:
+        report = MeshReport(path)
+        report.error = str(e)
+        return report
+    return validate(path, mesh)[0]
+
+# Welds and validates a mesh read from path. Returns the report and the welded mesh, None if the mesh can't be used.
+def validate(path, mesh):
+    report = MeshReport(path)
+    if mesh.vertexCount == 0:
+        report.error = "No triangles"
+        return (report, None)
+    # NaNs and infinities propagate through the sum
+    if not math.isfinite(sum(mesh.vertices)):
+        report.error = "Coordinates which aren't finite numbers"
+        return (report, None)
+    welded = weld(mesh)
+    if welded.triangleCount == 0:
+        report.error = "Only degenerate triangles"
+        return (report, None)
+    report.bounds = welded.bounds
+    report.triangles = welded.triangleCount
+    report.vertices = welded.vertexCount
+    report.degenerate = welded.degenerate
+    report.flipped = welded.flipped
+    report.boundaryEdges = welded.boundaryEdges
+    report.nonManifoldEdges = welded.nonManifoldEdges
+    return (report, welded)
+
+# Closed box around ((min x, min y, min z), (max x, max y, max z)) bounds, as a 12 triangle mesh.
+# Stands in for meshes too far away for their details to be seen.
+def boxMesh(bounds):
+    low, high = bounds
+    corners = [(x, y, z) for x in (low[0], high[0]) for y in (low[1], high[1]) for z in (low[2], high[2])]
+    # Each face as 4 corner indices, counter-clockwise seen from outside
+    faces = ((0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3))
+    triangles = []
+    for a, b, c, d in faces:
+        for v1, v2, v3 in ((corners[a], corners[b], corners[c]), (corners[a], corners[c], corners[d])):
+            triangles.append(((0.0, 0.0, 0.0), v1, v2, v3))
+    return _buildMeshData(triangles)
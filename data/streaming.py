@@ -0,0 +1,195 @@
+import bisect
+import collections
+import mmap
+import os
+import time
+from data import sceneformat
+from data.nameindex import NameIndex
+
+# Lazy loading of binary scene files (see data/sceneformat.py), for scenes too large to be rebuilt before the first frame.
+# The file is memory-mapped and entities are only created when asked for, one family at a time: loading the children
+# of an entity creates all of them at once, so that the children lists (and the child index paths used by the journal)
+# are always complete. Entities whose children are still in the file are "pending", and the descendant counts of
+# the records let their subtrees be skipped without reading them.
+#
+# Whatever remains gets loaded in small steps while the editor is idle (see Database), until the file can be closed.
+# Searches by name (see search) go through the names in the file rather than waiting for that, and only the matching
+# entities get loaded, along with the families on the way down to them (see loadRecords).
+
+# Whether a scene file can be streamed - version 1 files lack the descendant counts
+def isStreamable(path):
+    with open(path, "rb") as f:
+        data = f.read(sceneformat._HEADER.size)
+    if len(data) < sceneformat._HEADER.size or not sceneformat.isBinary(data):
+        return False
+    return sceneformat._HEADER.unpack_from(data, 0)[1] in (2, sceneformat.VERSION)
+
+class SceneStream:
+    # When a ComponentStore is given, loaded entities are bound to it right away, copying their components column-wise
+    def __init__(self, path, store=None):
+        self.file = open(path, "rb")
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.header = sceneformat.Header(self.data)
+        except:
+            self.close()
+            raise
+        self.store = store
+        self.strings = sceneformat.Strings(self.data, self.header)
+        self.generation = self.header.generation
+        # Ids of entities not loaded yet are all below it
+        self.nextId = self.header.freeId
+        self.total = self.header.recordCount
+        self.loaded = 0
+        # Loaded entities whose children are still in the file, with the index of their record, oldest first
+        self.pending = collections.OrderedDict()
+        self.records = None
+        # Names of all the records by record index, built on the first search
+        self._names = None
+        if store != None:
+            import numpy
+            self.records = numpy.frombuffer(self.data, sceneformat._recordType(self.header.version), self.total, self.header.recordsOffset)
+
+    def _record(self, i):
+        record = self.header.recordStruct
+        return record.unpack_from(self.data, self.header.recordsOffset + i * record.size)
+
+    # Creates the root entity. Its children are left pending.
+    def root(self):
+        root = self._create([0], [self._record(0)])[0]
+        self._markPending(root, 0, self._record(0))
+        return root
+
+    def isPending(self, entity):
+        return entity in self.pending
+
+    def isDone(self):
+        return len(self.pending) == 0
+
+    # Creates the children of a pending entity, and returns them. Returns an empty list for entities which aren't pending.
+    def loadChildren(self, entity):
+        i = self.pending.pop(entity, None)
+        if i == None:
+            return []
+        indices = []
+        records = []
+        j = i + 1
+        for _ in range(self._record(i)[4]):
+            r = self._record(j)
+            indices.append(j)
+            records.append(r)
+            # The next sibling comes after this one's subtree
+            j += r[17] + 1
+        children = self._create(indices, records)
+        for child, index, r in zip(children, indices, records):
+            child.setParent(entity)
+            self._markPending(child, index, r)
+        return children
+
+    # Loads pending families, oldest first (so roughly level by level), until the time budget (in seconds) runs out.
+    # Returns the entities whose children got loaded.
+    def step(self, budget):
+        loaded = []
+        deadline = time.perf_counter() + budget
+        while len(self.pending) > 0 and time.perf_counter() < deadline:
+            entity = next(iter(self.pending))
+            self.loadChildren(entity)
+            loaded.append(entity)
+        return loaded
+
+    # Indices of the records still in the file whose name starts with text, then of those whose name contains it
+    # (ignoring case, see NameIndex), at most limit of each. Only the subtrees of the pending entities include is true for count.
+    def search(self, text, limit, include):
+        if self._names == None:
+            self._names = NameIndex()
+            self._names.addMany((i, self.strings[self._record(i)[5]]) for i in range(self.total))
+        firsts, lasts, _ = self._unloadedRanges(include)
+
+        def isUnloaded(i):
+            k = bisect.bisect_right(firsts, i) - 1
+            return k >= 0 and i <= lasts[k]
+
+        indices = self._names.prefix(text, limit, isUnloaded)
+        found = set(indices)
+        indices.extend(i for i in self._names.search(text, limit, isUnloaded) if i not in found)
+        return indices
+
+    # Loads the families on the way down to the given records, so that their entities get created.
+    # Returns the entities whose children got loaded.
+    def loadRecords(self, indices):
+        firsts, lasts, entities = self._unloadedRanges()
+        # Records to reach under each pending entity, in file order
+        targets = {}
+        for i in sorted(indices):
+            k = bisect.bisect_right(firsts, i) - 1
+            if k >= 0 and i <= lasts[k]:
+                targets.setdefault(entities[k], []).append(i)
+        work = list(targets.items())
+        loaded = []
+        while len(work) > 0:
+            entity, records = work.pop()
+            j = self.pending[entity] + 1
+            loaded.append(entity)
+            t = 0
+            for child in self.loadChildren(entity):
+                # The child's subtree ends with its last descendant
+                last = j + self._record(j)[17]
+                below = []
+                while t < len(records) and records[t] <= last:
+                    if records[t] != j:
+                        below.append(records[t])
+                    t += 1
+                if len(below) > 0:
+                    work.append((child, below))
+                j = last + 1
+        return loaded
+
+    # Records not loaded yet, as the first and last record index of the subtree of each pending entity (include
+    # is true for), sorted, and those entities
+    def _unloadedRanges(self, include=None):
+        ranges = sorted((i + 1, i + self._record(i)[17], e) for e, i in self.pending.items() if include == None or include(e))
+        return ([r[0] for r in ranges], [r[1] for r in ranges], [r[2] for r in ranges])
+
+    # The records still in the file, so that a new scene file can be written while they aren't loaded.
+    # Only where they are gets looked up here, they are read by whoever packs them (see sceneformat.UnloadedRecords).
+    def unloadedRecords(self):
+        subtrees = {}
+        for entity, i in self.pending.items():
+            r = self._record(i)
+            subtrees[entity.id] = (r[4], i + 1, r[17])
+        return sceneformat.UnloadedRecords(os.fdopen(os.dup(self.file.fileno()), "rb"), self.header, subtrees)
+
+    # Releases the file. The scene file may only be replaced once it is closed (on Windows at least).
+    def close(self):
+        # The NumPy view has to go before the mapping can be closed
+        self.records = None
+        self._names = None
+        if getattr(self, "data", None) != None:
+            self.data.close()
+            self.data = None
+        self.file.close()
+
+    def _markPending(self, entity, index, record):
+        if record[4] > 0:
+            self.pending[entity] = index
+
+    def _create(self, indices, records):
+        self.loaded += len(records)
+        if self.store == None:
+            return [sceneformat._entityFromRecord(r, self.strings, self.header.nextId + i) for i, r in zip(indices, records)]
+
+        import numpy
+        store = self.store
+        selected = self.records[numpy.array(indices)]
+        rows = store.allocateBlock(len(indices))
+        store.colors[rows] = selected["color"]
+        store.positions[rows] = selected["position"]
+        store.rotations[rows] = selected["rotation"]
+        store.shapes[rows] = selected["shape"]
+        entities = []
+        for i, r, row in zip(indices, records, rows.tolist()):
+            id = r[18] if len(r) > 18 and r[18] != 0 else self.header.nextId + i
+            entity = sceneformat._newEntity(r[0], id, self.strings[r[5]], r[16], self.strings)
+            store.adopt(entity, row)
+            entities.append(entity)
+        return entities
@@ -0,0 +1,109 @@
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+# Timing instrumentation: spans around database mutations, signal emissions, widget slots, serialization and disk writes.
+# Disabled by default - a disabled span() hands out a shared no-op object and a traced() function only checks a flag,
+# so the instrumentation can stay in the hot paths. Once enabled, spans are recorded in a bounded ring buffer
+# and can be exported in the Chrome trace event format (chrome://tracing, Perfetto) or summed up per name.
+
+enabled = False
+_events = collections.deque(maxlen=1000000)
+_origin = time.perf_counter_ns()
+
+# Starts recording spans, keeping at most capacity of them (the oldest are dropped first)
+def enable(capacity=1000000):
+    global enabled, _events
+    if _events.maxlen != capacity:
+        _events = collections.deque(_events, maxlen=capacity)
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def clear():
+    _events.clear()
+
+# Recorded spans, as (name, category, thread id, start, duration, args) tuples, with times in nanoseconds
+def events():
+    return list(_events)
+
+class _Span:
+    __slots__ = ("name", "category", "args", "start")
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *_):
+        _events.append((self.name, self.category, threading.get_ident(), self.start, time.perf_counter_ns() - self.start, self.args))
+        return False
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+# Context manager timing the enclosed block. args is an optional dict shown alongside the span in trace viewers.
+def span(name, category="editor", args=None):
+    if not enabled:
+        return _NULL_SPAN
+    return _Span(name, category, args)
+
+# Decorator timing every call of a function, under its qualified name by default (prefixed with the module for plain functions).
+# The wrapper takes any arguments: when used on Qt slots, the signal has to provide exactly the ones the slot expects.
+def traced(name=None, category="slot"):
+    def decorate(f):
+        label = name
+        if label == None:
+            label = f.__qualname__ if "." in f.__qualname__ else f.__module__.split(".")[-1] + "." + f.__qualname__
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return f(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                _events.append((label, category, threading.get_ident(), start, time.perf_counter_ns() - start, None))
+        return wrapper
+    return decorate
+
+# Count, total and maximum duration (in seconds) per span name, slowest total first
+def summary():
+    totals = {}
+    for name, _, _, _, duration, _ in list(_events):
+        entry = totals.setdefault(name, [0, 0, 0])
+        entry[0] += 1
+        entry[1] += duration
+        entry[2] = max(entry[2], duration)
+    rows = [(name, count, total / 1e9, longest / 1e9) for name, (count, total, longest) in totals.items()]
+    rows.sort(key=lambda r: -r[2])
+    return rows
+
+def exportChromeTrace(path):
+    pid = os.getpid()
+    trace = []
+    for name, category, thread, start, duration, args in list(_events):
+        event = {"name": name, "cat": category, "ph": "X", "pid": pid, "tid": thread,
+            "ts": (start - _origin) / 1000, "dur": duration / 1000}
+        if args != None:
+            event["args"] = args
+        trace.append(event)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,88 @@
+import math
+
+# Plain Python affine transform math, used for world space computations outside of Qt3D.
+# A transform is a (matrix, translation) pair: a row-major 3x3 matrix as a 9-tuple and a translation 3-tuple.
+
+IDENTITY = ((1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0), (0.0, 0.0, 0.0))
+
+# Rotation matrix of a (scalar, x, y, z) quaternion. Same formula as QMatrix4x4::rotate, which doesn't normalize
+# the quaternion either - in particular the zero quaternion new entities start with gives the identity.
+def quaternionMatrix(q):
+    w, x, y, z = q
+    x2, y2, z2 = x + x, y + y, z + z
+    xx, yy, zz = x * x2, y * y2, z * z2
+    xy, xz, yz = x * y2, x * z2, y * z2
+    wx, wy, wz = w * x2, w * y2, w * z2
+    return (1.0 - (yy + zz), xy - wz, xz + wy,
+            xy + wz, 1.0 - (xx + zz), yz - wx,
+            xz - wy, yz + wx, 1.0 - (xx + yy))
+
+# Transform of an entity relative to its parent, from its position and (scalar, x, y, z) rotation
+def local(position, rotation):
+    return (quaternionMatrix(rotation), tuple(position))
+
+def multiplyMatrix(a, b):
+    return tuple(a[r * 3] * b[c] + a[r * 3 + 1] * b[3 + c] + a[r * 3 + 2] * b[6 + c] for r in range(3) for c in range(3))
+
+def applyMatrix(m, v):
+    return (m[0] * v[0] + m[1] * v[1] + m[2] * v[2],
+            m[3] * v[0] + m[4] * v[1] + m[5] * v[2],
+            m[6] * v[0] + m[7] * v[1] + m[8] * v[2])
+
+# parent * child: the child's transform expressed in the parent's space
+def compose(parent, child):
+    pm, pt = parent
+    cm, ct = child
+    t = applyMatrix(pm, ct)
+    return (multiplyMatrix(pm, cm), (t[0] + pt[0], t[1] + pt[1], t[2] + pt[2]))
+
+def applyPoint(transform, p):
+    m, t = transform
+    v = applyMatrix(m, p)
+    return (v[0] + t[0], v[1] + t[1], v[2] + t[2])
+
+def applyDirection(transform, d):
+    return applyMatrix(transform[0], d)
+
+# Inverse transform, or None if the matrix is singular
+def inverse(transform):
+    m, t = transform
+    a, b, c, d, e, f, g, h, i = m
+    c0 = e * i - f * h
+    c1 = f * g - d * i
+    c2 = d * h - e * g
+    det = a * c0 + b * c1 + c * c2
+    if abs(det) < 1e-12:
+        return None
+    s = 1.0 / det
+    im = (c0 * s, (c * h - b * i) * s, (b * f - c * e) * s,
+          c1 * s, (a * i - c * g) * s, (c * d - a * f) * s,
+          c2 * s, (b * g - a * h) * s, (a * e - b * d) * s)
+    it = applyMatrix(im, t)
+    return (im, (-it[0], -it[1], -it[2]))
+
+# World space axis aligned box (min x, min y, min z, max x, max y, max z) enclosing a local box given by its
+# center and half extents
+def transformBox(transform, center, halfExtents):
+    m, t = transform
+    c = applyPoint(transform, center)
+    e = (abs(m[0]) * halfExtents[0] + abs(m[1]) * halfExtents[1] + abs(m[2]) * halfExtents[2],
+         abs(m[3]) * halfExtents[0] + abs(m[4]) * halfExtents[1] + abs(m[5]) * halfExtents[2],
+         abs(m[6]) * halfExtents[0] + abs(m[7]) * halfExtents[1] + abs(m[8]) * halfExtents[2])
+    return (c[0] - e[0], c[1] - e[1], c[2] - e[2], c[0] + e[0], c[1] + e[1], c[2] + e[2])
+
+def normalize(v):
+    length = math.sqrt(v[0] * v[0] + v[1] * v[1] + v[2] * v[2])
+    if length == 0:
+        return v
+    return (v[0] / length, v[1] / length, v[2] / length)
+
+# World space axis aligned box enclosing a local sphere. Tighter than transformBox for rotated spheres:
+# the extent along each axis is the radius scaled by the length of the corresponding matrix row.
+def transformSphere(transform, center, radius):
+    m = transform[0]
+    c = applyPoint(transform, center)
+    e = (radius * math.sqrt(m[0] * m[0] + m[1] * m[1] + m[2] * m[2]),
+         radius * math.sqrt(m[3] * m[3] + m[4] * m[4] + m[5] * m[5]),
+         radius * math.sqrt(m[6] * m[6] + m[7] * m[7] + m[8] * m[8]))
+    return (c[0] - e[0], c[1] - e[1], c[2] - e[2], c[0] + e[0], c[1] + e[1], c[2] + e[2])
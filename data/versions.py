@@ -0,0 +1,137 @@
+# Persistent versions of the entity tree.
+#
+# An EntityVersion is an immutable copy of an entity's values and of the versions of its children. Entities cache
+# their version (see Entity.version) and an edit only drops the cached versions of the entity and its ancestors,
+# so the next version of the scene is rebuilt along the edited paths and shares every other subtree with the previous one.
+# Holding on to a version of the scene costs as much as what changed since, and comparing two versions (see diff)
+# skips the subtrees they share by identity.
+class EntityVersion:
+    __slots__ = ("id", "kind", "name", "position", "rotation", "color", "dimensions", "radius", "meshPath", "children")
+
+    # Values which can be edited (see Database), dimensions and radius being None for entities which don't have them
+    attributes = ("name", "position", "rotation", "color", "dimensions", "radius")
+
+    def __init__(self, id, kind, name, position, rotation, color, dimensions, radius, meshPath, children):
+        self.id = id
+        # Identifier of the entity type, as in Entity.toDict
+        self.kind = kind
+        self.name = name
+        self.position = position
+        self.rotation = rotation
+        self.color = color
+        self.dimensions = dimensions
+        self.radius = radius
+        self.meshPath = meshPath
+        # Tuple of the versions of the children
+        self.children = children
+
+    def sameValues(self, other):
+        return all(getattr(self, a) == getattr(other, a) for a in EntityVersion.attributes)
+
+    # Same layout as Entity.toDict. Without children, the "children" list is left empty.
+    def toDict(self, children=True):
+        v = {}
+        v["name"] = self.name
+        v["position"] = list(self.position)
+        r = self.rotation
+        v["rotation"] = [r[1], r[2], r[3], r[0]]
+        v["color"] = list(self.color)
+        v["children"] = [c.toDict() for c in self.children] if children else []
+        v["identifier"] = self.kind
+        if self.id != None:
+            v["id"] = self.id
+        if self.dimensions != None:
+            v["dimensions"] = list(self.dimensions)
+        if self.radius != None:
+            v["radius"] = self.radius
+        if self.kind == "Mesh":
+            v["meshPath"] = self.meshPath
+        return v
+
+# Differences between two versions of a tree, by entity id
+class Diff:
+    def __init__(self):
+        # (old, new) versions of entities whose own values differ
+        self.changed = []
+        # New versions of entities whose list of children differs (as ids), parents before their descendants
+        self.reordered = []
+        # Versions of the entities only found in the new tree, parents before their descendants
+        self.added = []
+        # Versions of the entities only found in the old tree
+        self.removed = []
+
+    def isEmpty(self):
+        return len(self.changed) == 0 and len(self.reordered) == 0 and len(self.added) == 0 and len(self.removed) == 0
+
+# Compares two versions of a tree whose roots are the same entity.
+# Both trees are walked together from their roots, matching children by id and skipping shared subtrees.
+# Children which left or joined a parent are matched up by id as well, so a moved subtree is only walked if it changed.
+# Only subtrees which were really added or removed - which may still have moved entities in them - get walked in full.
+def diff(old, new):
+    result = Diff()
+    # Unmatched children which left their old parent, and which joined their new one, by id
+    departed = {}
+    arrived = {}
+    pairs = [(old, new)]
+
+    def depart(o):
+        n = arrived.pop(o.id, None)
+        if n != None:
+            pairs.append((o, n))
+        else:
+            departed[o.id] = o
+
+    def arrive(n):
+        o = departed.pop(n.id, None)
+        if o != None:
+            pairs.append((o, n))
+        else:
+            arrived[n.id] = n
+
+    while len(pairs) > 0:
+        o, n = pairs.pop()
+        if o is n:
+            continue
+        if not o.sameValues(n):
+            result.changed.append((o, n))
+        if o.children is n.children:
+            continue
+        oldChildren = {c.id: c for c in o.children}
+        if [c.id for c in o.children] != [c.id for c in n.children]:
+            result.reordered.append(n)
+        for c in n.children:
+            oc = oldChildren.pop(c.id, None)
+            if oc != None:
+                pairs.append((oc, c))
+            else:
+                arrive(c)
+        for oc in oldChildren.values():
+            depart(oc)
+
+    if len(departed) == 0 and len(arrived) == 0:
+        return result
+
+    removed = {}
+    stack = list(departed.values())
+    while len(stack) > 0:
+        o = stack.pop()
+        removed[o.id] = o
+        stack.extend(o.children)
+    # Pre-order, so that parents come first
+    stack = list(reversed(list(arrived.values())))
+    while len(stack) > 0:
+        n = stack.pop()
+        o = removed.pop(n.id, None)
+        if o == None:
+            result.added.append(n)
+            if len(n.children) > 0:
+                result.reordered.append(n)
+        else:
+            # Moved out of a removed subtree
+            if not o.sameValues(n):
+                result.changed.append((o, n))
+            if [c.id for c in o.children] != [c.id for c in n.children]:
+                result.reordered.append(n)
+        stack.extend(reversed(n.children))
+    result.removed = list(removed.values())
+    return result
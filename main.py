@@ -1,26 +1,124 @@
-from PySide2.QtWidgets import QApplication, QWidget, QHBoxLayout
+import time
+_START = time.perf_counter()
+
+from PySide2.QtWidgets import QApplication, QWidget, QHBoxLayout, QLabel
+from PySide2.QtCore import Qt, QTimer
+import argparse
+import logging
 import sys
 import importlib
 
 from widgets.hierarchy import Hierarchy
 from widgets.inspector import Inspector
-from widgets.view import View
 from data.database import Database
+from data import tracing
+
+# Timings of the startup phases, as offsets from the start of the process.
+# Phases done on the GUI thread one after the other have a duration, background work (the rest of the scene
+# being streamed in, meshes being loaded) is only marked when it completes. The report is printed once everything is done.
+class StartupProfile:
+    def __init__(self, start, printReport=False):
+        self.start = start
+        self.printReport = printReport
+        self.last = start
+        self.phases = []
+        self.pending = set()
+
+    # Ends the current phase
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last, now - self.start))
+        self.last = now
+
+    # Background work which has to finish before the editor is fully loaded
+    def expect(self, name):
+        self.pending.add(name)
+
+    def complete(self, name):
+        if name not in self.pending:
+            return
+        self.pending.discard(name)
+        self.phases.append((name, None, time.perf_counter() - self.start))
+        if len(self.pending) == 0 and self.printReport:
+            self.report()
+
+    def report(self):
+        print("Startup phases (seconds):")
+        for name, duration, end in self.phases:
+            print("  %-20s %8s  done at %.3f" % (name, "%.3f" % duration if duration != None else "-", end))
 
+# The window comes up with the database, the hierarchy and the inspector. Importing Qt3D and building the 3D view
+# happen right after, once the event loop runs, while the scene itself and its meshes keep loading in the background.
 class Editor(QWidget):
-    def __init__(self):
+    def __init__(self, profile):
         super().__init__()
-        innerLayout = QHBoxLayout(self)
+        self.profile = profile
+        self.innerLayout = QHBoxLayout(self)
 
-        data = Database()
+        # The columnar component store is used whenever NumPy is available
+        data = Database(useComponentStore=importlib.util.find_spec("numpy") != None)
+        self.database = data
+        profile.mark("database")
+        profile.expect("meshes loaded")
+        if data.isLoading():
+            profile.expect("scene streamed")
+            data.onLoadProgressSignal.connect(self._onLoadProgress)
 
         hierarchy = Hierarchy(data)
-        view = View(data)
+        # Stands in for the 3D view until it is ready
+        self.placeholder = QLabel("Loading 3D view...")
+        self.placeholder.setAlignment(Qt.AlignCenter)
+        self.placeholder.setMinimumSize(300, 300)
         inspector = Inspector(data)
 
-        innerLayout.addWidget(hierarchy)
-        innerLayout.addWidget(view)
-        innerLayout.addWidget(inspector)
+        self.innerLayout.addWidget(hierarchy)
+        self.innerLayout.addWidget(self.placeholder, 1)
+        self.innerLayout.addWidget(inspector)
+        self.view = None
+        profile.mark("widgets")
+
+    def initializeView(self):
+        self.profile.mark("window shown")
+        with tracing.span("Editor.importView", "startup"):
+            from widgets.view import View
+        self.profile.mark("3D import")
+
+        with tracing.span("Editor.createView", "startup"):
+            view = View(self.database)
+            self.innerLayout.replaceWidget(self.placeholder, view)
+            self.innerLayout.setStretchFactor(view, 1)
+            self.placeholder.deleteLater()
+            self.placeholder = None
+        self.view = view
+        # Stop the background loading, and the processes simplifying meshes
+        QApplication.instance().aboutToQuit.connect(view.meshCache.close)
+        self.profile.mark("3D view")
+
+        if view.meshCache.isLoading():
+            view.meshCache.onIdleSignal.connect(lambda: self.profile.complete("meshes loaded"))
+        else:
+            self.profile.complete("meshes loaded")
+
+    def _onLoadProgress(self, loaded, total):
+        if loaded == total:
+            self.profile.complete("scene streamed")
+
+# Builds the LOD chains of the meshes among paths (files or directories) ahead of time, one process per core
+def buildMeshLods(paths):
+    from concurrent.futures import ProcessPoolExecutor
+    from data import meshlod
+    from data.meshimport import findMeshes
+    meshes = findMeshes(paths)
+    failed = 0
+    with ProcessPoolExecutor() as executor:
+        for report in executor.map(meshlod.prepare, meshes):
+            if report.isValid():
+                print("%s: %d triangles" % (report.path, report.triangles))
+            else:
+                print("%s: %s" % (report.path, report.error))
+                failed += 1
+    print("Built the LOD chains of %d meshes in %s" % (len(meshes) - failed, meshlod.DEFAULT_DIRECTORY))
+    return failed == 0
 
 if __name__ == "__main__":
     # Check for needed libraries
@@ -28,9 +126,30 @@ if __name__ == "__main__":
         print("This application requires the PySide2 library. Consider installing it with pip")
         exit(1)
 
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log-level", default="WARNING", help="DEBUG logs every edit")
+    parser.add_argument("--trace", metavar="PATH", help="time edits, signals and slots, and save them to PATH as a Chrome trace on exit")
+    parser.add_argument("--profile-startup", action="store_true", help="print how long each startup phase took")
+    parser.add_argument("--build-mesh-lods", nargs="+", metavar="PATH", help="build the LOD chains of the STL files in PATH and exit")
+    # Anything else is left to Qt
+    args, qtArguments = parser.parse_known_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(levelname)s %(name)s: %(message)s")
+    if args.trace != None:
+        tracing.enable()
+    if args.build_mesh_lods != None:
+        sys.exit(0 if buildMeshLods(args.build_mesh_lods) else 1)
+
+    app = QApplication(sys.argv[:1] + qtArguments)
 
-    editor = Editor()
+    profile = StartupProfile(_START, args.profile_startup)
+    profile.mark("imports")
+    editor = Editor(profile)
     editor.show()
+    # Queued behind the events showing the window
+    QTimer.singleShot(0, editor.initializeView)
+    # Make sure the last edits reach the cache
+    app.aboutToQuit.connect(editor.database.flush)
+    if args.trace != None:
+        app.aboutToQuit.connect(lambda: tracing.exportChromeTrace(args.trace))
 
     sys.exit(app.exec_())
@@ -0,0 +1,59 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PySide2.QtCore import QCoreApplication
+from data.autosave import AutosaveWriter
+from data.journal import encodeRecord, readJournal
+
+def setUpModule():
+    global application
+    application = QCoreApplication.instance() or QCoreApplication([])
+
+class AutosaveWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "cache.bin")
+        self.failures = 0
+        self.writer = AutosaveWriter(self.path, self.path + ".journal", lambda: b"scene", self.serialize)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.directory)
+
+    def serialize(self, snapshot, generation):
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError("No space left on device")
+        return snapshot
+
+    # The records queued before a snapshot which couldn't be written stay in the journal of the previous base
+    def testFailedBaseKeepsJournal(self):
+        writer = self.writer
+        writer.append(encodeRecord({"op": "set", "value": 1}))
+        writer.flush()
+        self.failures = 1
+        writer.append(encodeRecord({"op": "set", "value": 2}))
+        writer.append(encodeRecord({"op": "set", "value": 3}))
+        writer.markDirty()
+        writer.flush()
+        self.assertFalse(os.path.exists(self.path))
+        generation, records, _ = readJournal(self.path + ".journal")
+        self.assertEqual(generation, 0)
+        self.assertEqual([r["value"] for r in records], [1, 2, 3])
+        # Another snapshot got scheduled (through a queued signal), and supersedes the journal once written
+        QCoreApplication.processEvents()
+        writer.append(encodeRecord({"op": "set", "value": 4}))
+        writer.flush()
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b"scene")
+        generation, records, _ = readJournal(self.path + ".journal")
+        self.assertEqual(generation, writer.generation)
+        self.assertEqual(records, [])
+
+if __name__ == "__main__":
+    unittest.main()
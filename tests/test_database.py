@@ -0,0 +1,83 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PySide2.QtCore import QCoreApplication
+from data.database import Database
+from data.entity import CubeEntity
+
+# Database timers need an application object, though no event loop runs here
+def setUpModule():
+    global application
+    application = QCoreApplication.instance() or QCoreApplication([])
+
+# Gestures (see Database.gestureEdit) and transactions around undo/redo
+class GestureHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = Database(cachePath=os.path.join(self.directory, "cache.bin"))
+        self.cube = CubeEntity()
+        self.database.entityCreated(self.cube)
+        self.owner = object()
+
+    def tearDown(self):
+        self.database.flush()
+        shutil.rmtree(self.directory)
+
+    # Redo within the gesture window: the gesture becomes a new step, which leaves nothing to redo
+    def testRedoWithOpenGesture(self):
+        database = self.database
+        database.entityMoved(self.cube, (1.0, 0.0, 0.0))
+        database.undo()
+        with database.gestureEdit(self.owner):
+            database.entityMoved(self.cube, (2.0, 0.0, 0.0))
+        database.redo()
+        self.assertFalse(database.inTransaction())
+        self.assertEqual(database.redoBuffer, [])
+        self.assertEqual(self.cube.position, (2.0, 0.0, 0.0))
+        database.undo()
+        self.assertEqual(self.cube.position, (0.0, 0.0, 0.0))
+
+    # A gesture without any edit records nothing, so the step can still be redone
+    def testRedoWithEmptyGesture(self):
+        database = self.database
+        database.entityMoved(self.cube, (1.0, 0.0, 0.0))
+        database.undo()
+        with database.gestureEdit(self.owner):
+            pass
+        database.redo()
+        self.assertFalse(database.inTransaction())
+        self.assertEqual(self.cube.position, (1.0, 0.0, 0.0))
+
+    def testUndoRefusedWithinTransaction(self):
+        database = self.database
+        historyLength = len(database.history)
+        with database.transaction():
+            database.entityMoved(self.cube, (1.0, 0.0, 0.0))
+            with self.assertRaises(RuntimeError):
+                database.undo()
+            with self.assertRaises(RuntimeError):
+                database.redo()
+            self.assertTrue(database.inTransaction())
+            database.entityMoved(self.cube, (2.0, 0.0, 0.0))
+        self.assertFalse(database.inTransaction())
+        self.assertEqual(len(database.history), historyLength + 1)
+        database.undo()
+        self.assertEqual(self.cube.position, (0.0, 0.0, 0.0))
+
+    # A gesture left open within a transaction gets folded into it, and the transaction still closes
+    def testTransactionEndsGestureStartedWithin(self):
+        database = self.database
+        historyLength = len(database.history)
+        with database.transaction():
+            with database.gestureEdit(self.owner):
+                database.entityMoved(self.cube, (1.0, 0.0, 0.0))
+        self.assertFalse(database.inTransaction())
+        self.assertEqual(len(database.history), historyLength + 1)
+
+if __name__ == "__main__":
+    unittest.main()
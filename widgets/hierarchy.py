@@ -1,21 +1,286 @@
-import weakref
-from PySide2.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QLabel, QTreeWidget, QTreeWidgetItem, QSizePolicy, QPushButton, QFileDialog
-from PySide2.QtCore import Qt, Slot
+from PySide2.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QLabel, QTreeView, QSizePolicy, QPushButton, QFileDialog, QProgressBar, QLineEdit, QListWidget, QListWidgetItem
+from PySide2.QtCore import Qt, Slot, QAbstractItemModel, QModelIndex, QTimer, QMimeData, QByteArray
+from PySide2.QtWidgets import QAbstractItemView
 from data.entity import CubeEntity, SphereEntity, MeshEntity
+from data.meshimport import MeshImport
+from data import tracing
 
-# A data type used for drawing the entity tree in the hierarchy
-# Recursively creates all necessary children items given an entity.
-class HierarchyItem(QTreeWidgetItem):
-    def __init__(self, entity):
-        super().__init__()
-        self.entity = weakref.ref(entity)
-        self.setText(0, entity.name)
+# Byte count for display, e.g. "1.5 MiB"
+def _formatBytes(count):
+    for unit in ("B", "KiB", "MiB"):
+        if count < 1024:
+            return "%.0f %s" % (count, unit) if unit == "B" else "%.1f %s" % (count, unit)
+        count /= 1024
+    return "%.1f GiB" % count
 
-        for c in entity.children:
-            child = HierarchyItem(c)
-            self.addChild(child)
+# Item model exposing the entity tree to the hierarchy view.
+# Children are populated lazily - only once their parent gets expanded (and in batches, for very wide nodes) - and
+# the model is kept up to date through fine-grained row insertions, removals and data changes driven by the database signals,
+# so the cost of an edit is proportional to the change and to the rows actually shown, not to the size of the scene.
+# While a scene is being streamed in, expanding an entity whose children weren't loaded yet loads them on the spot.
+# Entities can be dragged onto others (or between them) to move them, see Database.entityReparented.
+class HierarchyModel(QAbstractItemModel):
+    # Number of children populated at a time
+    fetchBatchSize = 256
+    # Dragged entities, as their ids separated by spaces
+    mimeType = "application/x-scene-entity-ids"
+
+    def __init__(self, database, parent=None):
+        super(HierarchyModel, self).__init__(parent)
+        self.database = database
+        # Number of children exposed so far, per entity. Entities missing from it haven't been populated yet.
+        self.fetched = {}
+        # Set between the two halves of an entity removal
+        self.removing = False
+        # How the rows are updated between the two halves of a move: None, "move", "remove" or "insert"
+        self.moving = None
+
+        database.onEntityCreatedSignal.connect(self.onEntityCreated)
+        database.onEntityAboutToBeDestroyedSignal.connect(self.onEntityAboutToBeDestroyed)
+        database.onEntityDestroyedSignal.connect(self.onEntityDestroyed)
+        database.onEntityRenamedSignal.connect(self.onEntityRenamed)
+        database.onEntitiesChangedSignal.connect(self.onEntitiesChanged)
+        database.onEntityChildrenLoadedSignal.connect(self.onEntityChildrenLoaded)
+        database.onEntityAboutToBeReparentedSignal.connect(self.onEntityAboutToBeReparented)
+        database.onEntityReparentedSignal.connect(self.onEntityReparented)
+
+    def entity(self, index):
+        if not index.isValid():
+            return None
+        return index.internalPointer()
+
+    # Index of an entity, or an invalid index if the entity isn't exposed by the model (yet)
+    def indexOf(self, entity):
+        parent = entity.getParent()
+        if parent == None:
+            if entity is self.database.root:
+                return self.createIndex(0, 0, entity)
+            return QModelIndex()
+        row = parent.children.index(entity)
+        if row >= self.fetched.get(parent, 0) or not self.indexOf(parent).isValid():
+            return QModelIndex()
+        return self.createIndex(row, 0, entity)
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column, self.database.root)
+        return self.createIndex(row, column, parent.internalPointer().children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        parent = index.internalPointer().getParent()
+        if parent == None:
+            return QModelIndex()
+        grandparent = parent.getParent()
+        if grandparent == None:
+            return self.createIndex(0, 0, parent)
+        return self.createIndex(grandparent.children.index(parent), 0, parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        if not parent.isValid():
+            return 1
+        return self.fetched.get(parent.internalPointer(), 0)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def hasChildren(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return True
+        entity = parent.internalPointer()
+        return len(entity.children) > 0 or self.database.hasPendingChildren(entity)
+
+    def canFetchMore(self, parent):
+        if not parent.isValid():
+            return False
+        entity = parent.internalPointer()
+        return self.fetched.get(entity, 0) < len(entity.children) or self.database.hasPendingChildren(entity)
+
+    def fetchMore(self, parent):
+        entity = parent.internalPointer()
+        self.database.loadChildren(entity)
+        if len(entity.children) == 0:
+            return
+        first = self.fetched.get(entity, 0)
+        last = min(len(entity.children), first + HierarchyModel.fetchBatchSize) - 1
+        self.beginInsertRows(parent, first, last)
+        self.fetched[entity] = last + 1
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if index.isValid() and role == Qt.DisplayRole:
+            return index.internalPointer().name
+        return None
+
+    def flags(self, index):
+        flags = super(HierarchyModel, self).flags(index) | Qt.ItemIsDropEnabled
+        if index.isValid() and index.internalPointer() is not self.database.root:
+            flags |= Qt.ItemIsDragEnabled
+        return flags
+
+    def supportedDropActions(self):
+        return Qt.MoveAction
+
+    def mimeTypes(self):
+        return [HierarchyModel.mimeType]
+
+    def mimeData(self, indexes):
+        data = QMimeData()
+        ids = " ".join(str(index.internalPointer().id) for index in indexes if index.isValid())
+        data.setData(HierarchyModel.mimeType, QByteArray(ids.encode("ascii")))
+        return data
+
+    # Dropped onto an entity, the dragged ones become its last children. Dropped between rows, they go right there.
+    def dropMimeData(self, data, action, row, column, parent):
+        if action != Qt.MoveAction or not data.hasFormat(HierarchyModel.mimeType):
+            return False
+        target = self.entity(parent)
+        if target == None:
+            return False
+        entities = [self.database.entity(int(id)) for id in bytes(data.data(HierarchyModel.mimeType)).decode("ascii").split()]
+        entities = [e for e in entities if e != None and e.getParent() != None and not self.database._isInSubtree(target, e)]
+        # Entities dragged along with one of their ancestors simply follow it
+        dragged = set(entities)
+        entities = [e for e in entities if not any(self.database._isInSubtree(e.getParent(), d) for d in dragged)]
+        if len(entities) == 0:
+            return False
+        entities.sort(key=self.database._entityPath)
+        with self.database.transaction():
+            for e in entities:
+                index = None
+                if row >= 0:
+                    index = row
+                    # The row was counted with the entity still among the children
+                    if e.getParent() is target and target.children.index(e) < row:
+                        index -= 1
+                    else:
+                        row += 1
+                self.database.entityReparented(e, target, index)
+        return True
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return "Hierarchy"
+        return None
+
+    # Forgets everything populated so far
+    def reset(self):
+        self.beginResetModel()
+        self.fetched = {}
+        self.endResetModel()
+
+    # Forgets what was populated below a removed entity, as to start from scratch should it come back (e.g. with undo)
+    def _forget(self, entity):
+        count = self.fetched.pop(entity, 0)
+        for i in range(count):
+            self._forget(entity.children[i])
+
+    @tracing.traced()
+    def onEntityCreated(self, entity):
+        parent = entity.getParent()
+        parentIndex = self.indexOf(parent)
+        row = parent.children.index(entity)
+        # Rows past the populated ones will show up with the next fetchMore
+        if parentIndex.isValid() and parent in self.fetched and row <= self.fetched[parent]:
+            self.beginInsertRows(parentIndex, row, row)
+            self.fetched[parent] += 1
+            self.endInsertRows()
+        elif parentIndex.isValid():
+            # Lets the view notice the parent may now be expanded
+            self.dataChanged.emit(parentIndex, parentIndex)
+
+    # Loaded children show up with the next fetchMore, like the ones past the populated rows
+    @tracing.traced()
+    def onEntityChildrenLoaded(self, entity):
+        index = self.indexOf(entity)
+        if index.isValid():
+            self.dataChanged.emit(index, index)
+
+    # Rows move along when both ends are populated, otherwise they're removed from one side or inserted on the other.
+    # A moved subtree stays populated (and expanded) as long as it remains visible.
+    @tracing.traced()
+    def onEntityAboutToBeReparented(self, entity, parent, index):
+        oldParent = entity.getParent()
+        source = self.indexOf(entity)
+        destination = self.indexOf(parent)
+        # Rows populated under the new parent once the entity left its old one
+        populated = self.fetched.get(parent, -1)
+        if source.isValid() and parent is oldParent:
+            populated -= 1
+        exposed = destination.isValid() and index <= populated
+        self.moving = None
+        if source.isValid() and exposed:
+            # Rows in the destination are counted with the entity still there
+            row = index + 1 if parent is oldParent and index >= source.row() else index
+            if parent is oldParent and (row == source.row() or row == source.row() + 1):
+                return
+            self.beginMoveRows(source.parent(), source.row(), source.row(), destination, row)
+            self.fetched[oldParent] -= 1
+            self.fetched[parent] += 1
+            self.moving = "move"
+        elif source.isValid():
+            self.beginRemoveRows(source.parent(), source.row(), source.row())
+            self.fetched[oldParent] -= 1
+            self._forget(entity)
+            self.moving = "remove"
+        elif exposed:
+            self.moving = "insert"
+
+    @tracing.traced()
+    def onEntityReparented(self, entity):
+        moving = self.moving
+        self.moving = None
+        if moving == "move":
+            self.endMoveRows()
+            return
+        if moving == "remove":
+            self.endRemoveRows()
+        parent = entity.getParent()
+        parentIndex = self.indexOf(parent)
+        if moving == "insert":
+            row = parent.children.index(entity)
+            self.beginInsertRows(parentIndex, row, row)
+            self.fetched[parent] += 1
+            self.endInsertRows()
+        elif parentIndex.isValid():
+            # Lets the view notice the parent may now be expanded
+            self.dataChanged.emit(parentIndex, parentIndex)
+
+    @tracing.traced()
+    def onEntityAboutToBeDestroyed(self, entity):
+        index = self.indexOf(entity)
+        if index.isValid():
+            self.beginRemoveRows(index.parent(), index.row(), index.row())
+            self.fetched[entity.getParent()] -= 1
+            self._forget(entity)
+            self.removing = True
+
+    @tracing.traced()
+    def onEntityDestroyed(self, entity):
+        if self.removing:
+            self.removing = False
+            self.endRemoveRows()
+
+    @tracing.traced()
+    def onEntityRenamed(self, entity, _):
+        index = self.indexOf(entity)
+        if index.isValid():
+            self.dataChanged.emit(index, index)
+
+    @tracing.traced()
+    def onEntitiesChanged(self, changes):
+        for entity in changes.get("name", []):
+            self.onEntityRenamed(entity, entity.name)
 
 class Hierarchy(QWidget):
+    # Most entities listed when filtering by name
+    filterLimit = 1000
+
     def __init__(self, database, parent=None):
         super(Hierarchy, self).__init__(parent)
         self.setFixedWidth(300)
@@ -34,6 +299,10 @@ class Hierarchy(QWidget):
         redoButton = QPushButton("Redo")
         redoUndoLayout.addWidget(undoButton)
         redoUndoLayout.addWidget(redoButton)
+        # Depth of the history and what it takes once compressed, see data/historystore.py
+        historyLabel = QLabel()
+        redoUndoLayout.addWidget(historyLabel)
+        self.historyLabel = historyLabel
         undoButton.clicked.connect(database.undo)
         redoButton.clicked.connect(database.redo)
         policy = undoButton.sizePolicy()
@@ -62,6 +331,33 @@ class Hierarchy(QWidget):
         newSphereButton.clicked.connect(self.sphereCreated)
         newMeshButton.clicked.connect(self.meshCreated)
 
+        # Bulk import of STL files, parsed in other processes (see data/meshimport.py) while the editor stays usable
+        importFilesButton = QPushButton("Import meshes...")
+        importDirectoryButton = QPushButton("Import folder...")
+        importLayout = QHBoxLayout()
+        importLayout.addWidget(importFilesButton)
+        importLayout.addWidget(importDirectoryButton)
+        importFilesButton.clicked.connect(self.meshesImported)
+        importDirectoryButton.clicked.connect(self.meshDirectoryImported)
+        importProgressBar = QProgressBar()
+        importProgressBar.setFormat("Importing meshes... %v/%m")
+        importProgressBar.hide()
+        cancelImportButton = QPushButton("Cancel")
+        cancelImportButton.clicked.connect(self.cancelImport)
+        cancelImportButton.hide()
+        importProgressLayout = QHBoxLayout()
+        importProgressLayout.addWidget(importProgressBar)
+        importProgressLayout.addWidget(cancelImportButton)
+        importLabel = QLabel()
+        importLabel.hide()
+        importProgressLayout.addWidget(importLabel)
+        self.importFilesButton = importFilesButton
+        self.importDirectoryButton = importDirectoryButton
+        self.importProgressBar = importProgressBar
+        self.cancelImportButton = cancelImportButton
+        self.importLabel = importLabel
+        self.meshImport = None
+
         # Keep the layout unchanged when the remove button isn't visible (which it often won't be as we won't always have an entity selected...)
         policy = removeButton.sizePolicy()
         policy.setRetainSizeWhenHidden(True)
@@ -70,31 +366,66 @@ class Hierarchy(QWidget):
         self.removeButton = removeButton
 
         # The main tree of the view, showing all entities in the rendered scene
-        tree = QTreeWidget()
-        tree.itemClicked.connect(self.itemClicked)
+        model = HierarchyModel(database, self)
+        tree = QTreeView()
+        tree.setModel(model)
+        tree.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        tree.setDragDropMode(QAbstractItemView.DragDrop)
+        tree.setDefaultDropAction(Qt.MoveAction)
+        tree.setDropIndicatorShown(True)
+        tree.clicked.connect(self.itemClicked)
+        self.model = model
         self.tree = tree
         self.refreshHierarchy()
 
+        # Filtering by name replaces the tree with the list of matching entities, see database.findEntities
+        filterEdit = QLineEdit()
+        filterEdit.setPlaceholderText("Filter by name")
+        filterEdit.setClearButtonEnabled(True)
+        filterEdit.textChanged.connect(self.scheduleFilter)
+        results = QListWidget()
+        results.itemClicked.connect(self.resultClicked)
+        results.hide()
+        # Typing a few characters in a row only searches once
+        filterTimer = QTimer(self)
+        filterTimer.setSingleShot(True)
+        filterTimer.setInterval(100)
+        filterTimer.timeout.connect(self.applyFilter)
+        self.filterEdit = filterEdit
+        self.results = results
+        self.filterTimer = filterTimer
+
+        # Progress of a scene being streamed in, hidden once it is complete
+        progressBar = QProgressBar()
+        progressBar.setFormat("Loading scene... %p%")
+        progressBar.setVisible(database.isLoading())
+        self.progressBar = progressBar
+
         # Main layout
         layout = QVBoxLayout(alignment=Qt.AlignTop)
         layout.addWidget(self.cameraToFpsButton)
         layout.addWidget(self.cameraToOrbitButton)
         layout.addLayout(topLayout)
+        layout.addLayout(importLayout)
+        layout.addWidget(filterEdit)
         layout.addWidget(tree)
+        layout.addWidget(results)
+        layout.addWidget(progressBar)
+        layout.addLayout(importProgressLayout)
         layout.addLayout(redoUndoLayout)
         #layout.addWidget(label)
         self.setLayout(layout)
 
         # Connecting signals
+        # The tree itself is kept up to date by the model
         database.onEntitySelectedSignal.connect(self.onEntitySelected)
         database.onEntityDestroyedSignal.connect(self.onEntityDestroyed)
-        database.onEntityCreatedSignal.connect(self.onEntityCreated)
-        database.onEntityRenamedSignal.connect(self.onEntityRenamed)
-
-        database.onUndoSignal.connect(self.refreshHierarchy)
-        database.onRedoSignal.connect(self.refreshHierarchy)
+        # The matches of the filter change along with the scene
+        for signal in (database.onEntityCreatedSignal, database.onEntityDestroyedSignal, database.onEntityRenamedSignal, database.onEntitiesChangedSignal):
+            signal.connect(self.scheduleFilter)
 
         database.onHistoryChange.connect(self._checkRedoUndoButtonVisibility)
+        database.onLoadProgressSignal.connect(self.onLoadProgress)
 
         database.onFpsCameraSignal.connect(self.onFpsCamera)
         database.onOrbitCameraSignal.connect(self.onOrbitCamera)
@@ -107,12 +438,42 @@ class Hierarchy(QWidget):
         self.cameraToFpsButton.show()
         self.cameraToOrbitButton.hide()
 
-    def itemClicked(self, it, _):
-        entity = it.entity()
+    def onLoadProgress(self, loaded, total):
+        self.progressBar.setMaximum(total)
+        self.progressBar.setValue(loaded)
+        self.progressBar.setVisible(loaded < total)
+
+    def scheduleFilter(self, *_):
+        if self.filterEdit.text() != "" or self.results.isVisible():
+            self.filterTimer.start()
+
+    @tracing.traced()
+    def applyFilter(self):
+        text = self.filterEdit.text()
+        self.results.clear()
+        if text == "":
+            self.results.hide()
+            self.tree.show()
+            return
+        for entity in self.database.findEntities(text, Hierarchy.filterLimit):
+            item = QListWidgetItem(entity.name)
+            item.setData(Qt.UserRole, entity.id)
+            self.results.addItem(item)
+        self.tree.hide()
+        self.results.show()
+
+    def resultClicked(self, item):
+        entity = self.database.entity(item.data(Qt.UserRole))
+        if entity != None:
+            self.database.entitySelected(entity)
+
+    def itemClicked(self, index):
+        entity = self.model.entity(index)
         if entity != None:
             #print(entity.name)
             self.database.entitySelected(entity)
 
+    @tracing.traced()
     def _checkRedoUndoButtonVisibility(self):
         if(len(self.database.history) > 0):
             self.undoButton.show()
@@ -122,6 +483,19 @@ class Hierarchy(QWidget):
             self.redoButton.show()
         else:
             self.redoButton.hide()
+        self._updateHistoryLabel()
+
+    def _updateHistoryLabel(self):
+        history = self.database.history
+        live, compressed, spilled = history.counts()
+        text = "History: %d steps" % len(history)
+        if compressed > 0:
+            text += ", %s compressed" % _formatBytes(history.memoryBytes())
+        if spilled > 0:
+            text += ", %s on disk" % _formatBytes(history.diskBytes())
+        self.historyLabel.setText(text)
+        self.historyLabel.setToolTip("%d undo steps as they are, %d compressed in memory, %d in a temporary file\n%d redo steps" %
+            (live, compressed, spilled, len(self.database.redoBuffer)))
 
     def entityDestroyed(self):
         self.database.entityDestroyed(self.database.selectedEntity)
@@ -140,32 +514,74 @@ class Hierarchy(QWidget):
             entity = MeshEntity(fileName[0])
             self.database.entityCreated(entity)
 
+    def meshesImported(self):
+        fileNames = QFileDialog.getOpenFileNames(self, "Import Meshes", "", "Stl files (*.stl)")
+        if len(fileNames[0]) > 0:
+            self.startImport(fileNames[0])
+
+    def meshDirectoryImported(self):
+        directory = QFileDialog.getExistingDirectory(self, "Import Meshes")
+        if directory != "":
+            self.startImport([directory])
+
+    def startImport(self, paths):
+        if self.meshImport != None:
+            return
+        meshImport = MeshImport(self.database, paths, parent=self)
+        meshImport.onProgressSignal.connect(self.onImportProgress)
+        meshImport.onFinishedSignal.connect(self.onImportFinished)
+        self.meshImport = meshImport
+        self.importFilesButton.setEnabled(False)
+        self.importDirectoryButton.setEnabled(False)
+        self.importProgressBar.setValue(0)
+        self.importProgressBar.show()
+        self.importLabel.hide()
+        self.cancelImportButton.show()
+        meshImport.start()
+
+    def cancelImport(self):
+        if self.meshImport != None:
+            self.meshImport.cancel()
+
+    def onImportProgress(self, done, total):
+        self.importProgressBar.setMaximum(total)
+        self.importProgressBar.setValue(done)
+
+    def onImportFinished(self, reports):
+        self.meshImport.deleteLater()
+        self.meshImport = None
+        self.importFilesButton.setEnabled(True)
+        self.importDirectoryButton.setEnabled(True)
+        self.importProgressBar.hide()
+        self.cancelImportButton.hide()
+        # Outcome of the last import, with the files which couldn't be imported in the tooltip
+        failed = [r for r in reports if not r.isValid()]
+        text = "Imported %d meshes" % (len(reports) - len(failed))
+        if len(failed) > 0:
+            text += ", %d failed" % len(failed)
+        self.importLabel.setText(text)
+        self.importLabel.setToolTip("\n".join("%s: %s" % (r.path, r.error) for r in failed))
+        self.importLabel.setVisible(len(reports) > 0)
+
     def handleRemoveButtonHideState(self):
         if self.database.selectedEntity != None and self.database.selectedEntity.getParent() != None:
             self.removeButton.show()
         else:
             self.removeButton.hide()
 
-    # Updates the hierarchy
+    # Rebuilds the hierarchy from scratch, with only the root expanded
+    @tracing.traced()
     def refreshHierarchy(self):
-        self.tree.clear()
-        root = HierarchyItem(self.database.root)
-        self.tree.addTopLevelItem(root)
-        self.tree.expandAll()
-        self.tree.setHeaderLabels(["Hierarchy"])
+        self.model.reset()
+        self.tree.expand(self.model.index(0, 0))
         #self.tree.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         self._checkRedoUndoButtonVisibility()
 
 
+    @tracing.traced()
     def onEntitySelected(self):
         self.handleRemoveButtonHideState()
 
+    @tracing.traced()
     def onEntityDestroyed(self, entity):
-        self.refreshHierarchy()
-        self.handleRemoveButtonHideState()
-
-    def onEntityCreated(self, entity):
-        self.refreshHierarchy()
-
-    def onEntityRenamed(self, _, __):
-        self.refreshHierarchy()
\ No newline at end of file
+        self.handleRemoveButtonHideState()
\ No newline at end of file
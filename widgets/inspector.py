@@ -1,10 +1,10 @@
 import sys
 from PySide2.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QLabel, QLineEdit, QDoubleSpinBox, QColorDialog
-from PySide2.QtGui import QVector3D, QColor, QQuaternion
-from PySide2.QtCore import Qt
+from PySide2.QtCore import Qt, QTimer
 from PySide2.QtGui import QDoubleValidator
-from utilities import indexVector3D, indexQuaternion, writeVector3D, writeQuaternion, copyVector3D, copyColor, copyQuaternion, writeColor
+from utilities import replaced
 from data.entity import CubeEntity, SphereEntity
+from data import tracing
 
 class VectorFieldSpinBox(QDoubleSpinBox):
     def __init__(self, coord=0):
@@ -37,6 +37,7 @@ class Inspector(QWidget):
         self.nameWidgetText = textInput
 
         self.nameWidgetText.textEdited.connect(self.nameEdited)
+        self.nameWidgetText.editingFinished.connect(self.endGesture)
         # Entity position
         (positionWidget, positionWidgetTexts) = self._createVectorEditor("Translation: ", editedCallback=self.positionEdited)
         layout.addWidget(positionWidget)
@@ -66,9 +67,17 @@ class Inspector(QWidget):
 
         self.setLayout(layout)
 
+        # Continuous edits (holding a spinbox arrow, typing a name...) are grouped into a single gesture (see Database.gestureEdit),
+        # ended once the user pauses for a moment or leaves the field
+        self.gestureTimer = QTimer(self)
+        self.gestureTimer.setSingleShot(True)
+        self.gestureTimer.setInterval(500)
+        self.gestureTimer.timeout.connect(self.endGesture)
+
         self.database.onEntitySelectedSignal.connect(self.onEntitySelected)
         self.database.onEntityDestroyedSignal.connect(self.onEntityDestroyed)
         self.database.onEntityRenamedSignal.connect(self.onEntityRenamed)
+        self.database.onEntitiesChangedSignal.connect(self.onEntitiesChanged)
 
         self.database.onUndoSignal.connect(self.refreshInspector)
         self.database.onRedoSignal.connect(self.refreshInspector)
@@ -101,54 +110,76 @@ class Inspector(QWidget):
             lambdas = (lambda v, i=i: editedCallback(i, v) for i in range(size))
             for i, l in zip(inputs, lambdas):
                 i.valueChanged.connect(l)
+                i.editingFinished.connect(self.endGesture)
 
         return (widget, inputs)
 
 
+    # Applies an edit as part of the inspector's current gesture
+    def gestureEdit(self, edit, *args):
+        with self.database.gestureEdit(self):
+            edit(self.database.selectedEntity, *args)
+        self.gestureTimer.start()
+
+    def endGesture(self):
+        self.gestureTimer.stop()
+        self.database.endGesture(self)
+
     def nameEdited(self, text):
-        #print("Edit: ", text)
-        self.database.entityRenamed(self.database.selectedEntity, text)
+        self.gestureEdit(self.database.entityRenamed, text)
+
+    # Whether a spinbox value differs from the current one as far as the spinbox can tell. Stored components are float32,
+    # so e.g. 0.35 reads back as 0.3499999940395355, which the spinbox shows (and gives back) as 0.35.
+    def _differs(self, spinbox, val, current):
+        return round(val, spinbox.decimals()) != round(current, spinbox.decimals())
 
     def positionEdited(self, i, val):
-        newPosition = copyVector3D(self.database.selectedEntity.position)
-        writeVector3D(newPosition, i, val)
-        if newPosition != self.database.selectedEntity.position:
-            self.database.entityMoved(self.database.selectedEntity, newPosition)
+        position = self.database.selectedEntity.position
+        if self._differs(self.positionWidgetTexts[i], val, position[i]):
+            self.gestureEdit(self.database.entityMoved, replaced(position, i, val))
 
     def rotationEdited(self, i, val):
-        newRotation = copyQuaternion(self.database.selectedEntity.rotation)
-        writeQuaternion(newRotation, i, val)
-        if newRotation != self.database.selectedEntity.rotation:
-            self.database.entityRotated(self.database.selectedEntity, newRotation)
+        rotation = self.database.selectedEntity.rotation
+        if self._differs(self.rotationWidgetTexts[i], val, rotation[i]):
+            self.gestureEdit(self.database.entityRotated, replaced(rotation, i, val))
 
     def colorEdited(self, i, val):
-        newColor = copyColor(self.database.selectedEntity.color)
-        writeColor(newColor, i, val)
-        if newColor != self.database.selectedEntity.color:
-            self.database.entityColorChanged(self.database.selectedEntity, newColor)
+        color = self.database.selectedEntity.color
+        if int(val) != color[i]:
+            self.gestureEdit(self.database.entityColorChanged, replaced(color, i, int(val)))
 
     def cubeDimensionsEdited(self, i, val):
-        newDimensions = copyVector3D(self.database.selectedEntity.dimensions)
-        writeVector3D(newDimensions, i, val)
-        if newDimensions != self.database.selectedEntity.dimensions:
-            self.database.entityCubeDimensionsChanged(self.database.selectedEntity, newDimensions)
+        dimensions = self.database.selectedEntity.dimensions
+        if self._differs(self.cubeWidgetTexts[i], val, dimensions[i]):
+            self.gestureEdit(self.database.entityCubeDimensionsChanged, replaced(dimensions, i, val))
 
     def sphereRadiusEdited(self, _, val):
-        #val = float(self.sphereWidgetTexts[0].cleanText())
-        if val != self.database.selectedEntity.radius:
-            self.database.entitySphereRadiusChanged(self.database.selectedEntity, val)
+        if self._differs(self.sphereWidgetTexts[0], val, self.database.selectedEntity.radius):
+            self.gestureEdit(self.database.entitySphereRadiusChanged, val)
 
 
+    @tracing.traced()
     def onEntitySelected(self):
+        # The database ended the gesture already
+        self.gestureTimer.stop()
         self.refreshInspector()
 
+    @tracing.traced()
     def onEntityDestroyed(self, _):
         self.refreshInspector()
 
+    @tracing.traced()
     def onEntityRenamed(self, _, __):
         self.refreshInspector()
 
+    @tracing.traced()
+    def onEntitiesChanged(self, changes):
+        selected = self.database.selectedEntity
+        if selected != None and any(selected in entities for entities in changes.values()):
+            self.refreshInspector()
+
 
+    @tracing.traced()
     def refreshInspector(self):
         if self.database.selectedEntity != None and self.database.selectedEntity.parent != None:
             self.nameWidget.show()
@@ -160,41 +191,32 @@ class Inspector(QWidget):
             self.colorWidget.show()
 
             # Update widget information
-            for i, t in enumerate(self.positionWidgetTexts):
-                t.value = indexVector3D(self.database.selectedEntity.position, i)
-            for i, t in enumerate(self.rotationWidgetTexts):
-                t.value = indexQuaternion(self.database.selectedEntity.rotation, i)
-            for i, t in enumerate(self.colorWidgetTexts):
-                t.value = self.database.selectedEntity.color.getRgb()[i]
+            self._showValues(self.positionWidgetTexts, self.database.selectedEntity.position)
+            self._showValues(self.rotationWidgetTexts, self.database.selectedEntity.rotation)
+            self._showValues(self.colorWidgetTexts, self.database.selectedEntity.color)
 
             if isinstance(self.database.selectedEntity, CubeEntity):
                 self.cubeWidget.show()
-                for i, t in enumerate(self.cubeWidgetTexts):
-                    t.value = indexVector3D(self.database.selectedEntity.dimensions, i)
-                for i, t in enumerate(self.cubeWidgetTexts):
-                    t.setValue(t.value)
+                self._showValues(self.cubeWidgetTexts, self.database.selectedEntity.dimensions)
             else:
                 self.cubeWidget.hide()
             if isinstance(self.database.selectedEntity, SphereEntity):
                 self.sphereWidget.show()
-                for i, t in enumerate(self.sphereWidgetTexts):
-                    t.value = self.database.selectedEntity.radius
-                for t in self.sphereWidgetTexts:
-                    t.setValue(t.value)
+                self._showValues(self.sphereWidgetTexts, (self.database.selectedEntity.radius,))
             else:
                 self.sphereWidget.hide()
-
-            # setValue emits a signal when the new value differs from old. To avoid it here (as to guard against infinite recursion), we call it *after* setting the value manually
-            for t in self.positionWidgetTexts:
-                t.setValue(t.value)
-            for t in self.rotationWidgetTexts:
-                t.setValue(t.value)
-            for t in self.colorWidgetTexts:
-                t.setValue(t.value)
         else:
             self.nameWidget.hide()
             self.positionWidget.hide()
             self.rotationWidget.hide()
             self.colorWidget.hide()
             self.cubeWidget.hide()
-            self.sphereWidget.hide()
\ No newline at end of file
+            self.sphereWidget.hide()
+
+    # Shows values in spinboxes without emitting valueChanged: the spinbox rounds what it's given, and the rounded value
+    # coming back through the edit slots would be taken for an edit (recorded in the history, clearing the redo buffer)
+    def _showValues(self, spinboxes, values):
+        for t, v in zip(spinboxes, values):
+            t.blockSignals(True)
+            t.setValue(v)
+            t.blockSignals(False)
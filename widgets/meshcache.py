@@ -0,0 +1,243 @@
+import collections
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from PySide2 import QtCore
+from PySide2.QtCore import QByteArray
+from PySide2.Qt3DRender import Qt3DRender
+from data import stl
+from data import meshlod
+from data import tracing
+
+logger = logging.getLogger(__name__)
+
+class MeshAsset:
+    def __init__(self, renderer):
+        # Shared by every entity using the asset
+        self.renderer = renderer
+        self.references = 0
+        self.byteSize = 0
+        self.bounds = None
+
+# Cache of STL mesh assets shared between all the MeshEntities referencing the same file.
+# Assets are keyed by the resolved path plus the file's modification time and size, so an edited file gets loaded anew,
+# and by the detail level: level 0 is the mesh itself, the next ones simplified versions of it (see data/meshlod.py)
+# and the last one a box proxy around it for when it is far away.
+# Parsing happens on a worker thread: acquire() immediately returns a geometry renderer, which receives its geometry once
+# the file is loaded. Simplified levels are read from the LOD chains stored in lodDirectory.
+# Chains which aren't there yet get built in another process, as simplifying a big mesh takes a while
+# and would hold the GIL all along.
+# Assets which aren't referenced anymore are kept around (least recently used first out) as long as the total size
+# of the cached geometry stays within memoryBudget bytes.
+class MeshCache(QtCore.QObject):
+    # The mesh, its simplified versions, and the box
+    levels = meshlod.LEVELS + 1
+
+    # Emitted on the GUI thread once an asset finished loading, with its key
+    onAssetLoadedSignal = QtCore.Signal(object)
+    # Emitted when the last of the meshes being loaded is done
+    onIdleSignal = QtCore.Signal()
+    _parsedSignal = QtCore.Signal(object, object)
+
+    def __init__(self, rootNode, memoryBudget=256 * 1024 * 1024, workers=2, lodDirectory=meshlod.DEFAULT_DIRECTORY, parent=None):
+        super(MeshCache, self).__init__(parent)
+        # Shared components must outlive any single entity, so they belong to the scene root
+        self.rootNode = rootNode
+        self.memoryBudget = memoryBudget
+        self.assets = {}
+        # Unreferenced assets, oldest first
+        self.unused = collections.OrderedDict()
+        self.byteSize = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Meshes being loaded
+        self.loading = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self.lodDirectory = lodDirectory
+        # Started on the first chain to build. Chains being built, by path, so that each is only built once.
+        self._builder = None
+        self._builds = {}
+        self._buildsLock = threading.Lock()
+        self._closed = False
+        self._parsedSignal.connect(self._onParsed)
+
+    def key(self, path, level=0):
+        resolved = os.path.realpath(path)
+        try:
+            st = os.stat(resolved)
+            return (resolved, st.st_mtime_ns, st.st_size, level)
+        except OSError:
+            return (resolved, None, None, level)
+
+    # Returns the renderer for a key obtained from key(). Every acquire() has to be matched by a release().
+    def acquire(self, key):
+        asset = self.assets.get(key)
+        if asset != None:
+            self.hits += 1
+            self.unused.pop(key, None)
+        else:
+            self.misses += 1
+            renderer = Qt3DRender.QGeometryRenderer(self.rootNode)
+            renderer.setPrimitiveType(Qt3DRender.QGeometryRenderer.Triangles)
+            asset = MeshAsset(renderer)
+            self.assets[key] = asset
+            self._load(key)
+        asset.references += 1
+        return asset.renderer
+
+    def release(self, key):
+        asset = self.assets.get(key)
+        if asset == None:
+            return
+        asset.references -= 1
+        if asset.references == 0:
+            self.unused[key] = asset
+            self._evict()
+
+    def bounds(self, key):
+        asset = self.assets.get(key)
+        return asset.bounds if asset != None else None
+
+    def stats(self):
+        return {"assets": len(self.assets), "unused": len(self.unused), "bytes": self.byteSize,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def isLoading(self):
+        return self.loading > 0
+
+    def _load(self, key):
+        self.loading += 1
+        if key[3] == 0:
+            # Read as it is rather than from the chain, so that the first load of a mesh doesn't wait for its simplification
+            future = self._executor.submit(stl.load, key[0])
+        elif key[3] < self.levels - 1:
+            # Reading a stored chain is quick, building one happens in another process without holding up a loader thread
+            future = self._executor.submit(meshlod.cachedChain, key[0], self.lodDirectory)
+            future.add_done_callback(lambda f, key=key: self._onChainRead(key, f))
+            return
+        else:
+            # The proxy only needs the bounds, which are already known if the full mesh is loaded
+            base = self.assets.get(key[:3] + (0,))
+            if base != None and base.bounds != None:
+                future = Future()
+                future.set_result(stl.boxMesh(base.bounds))
+                self._onParsed(key, future)
+                return
+            future = self._executor.submit(lambda path: stl.boxMesh(stl.load(path).bounds), key[0])
+        future.add_done_callback(lambda f, key=key: self._parsedSignal.emit(key, f))
+
+    # Runs on a worker thread, with the stored chain of the key's mesh (None if there is none yet)
+    def _onChainRead(self, key, future):
+        if future.exception() == None and future.result() == None:
+            try:
+                future = self._buildChain(key[0])
+            except RuntimeError as e:
+                # Closed in the meantime
+                future = Future()
+                future.set_exception(e)
+        future.add_done_callback(lambda f, key=key: f.cancelled() or self._parsedSignal.emit(key, self._chainLevel(f, key[3])))
+
+    # Future of the chain of the mesh at path, built in the process pool. Each chain is only built once at a time.
+    def _buildChain(self, path):
+        with self._buildsLock:
+            future = self._builds.get(path)
+            if future != None:
+                return future
+            if self._closed:
+                raise RuntimeError("The mesh cache was closed")
+            if self._builder == None:
+                # Forking a process running Qt threads isn't safe, the workers start from a fresh interpreter instead
+                self._builder = ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+            future = self._builder.submit(meshlod.loadChain, path, self.lodDirectory)
+            self._builds[path] = future
+        # Outside of the lock, as a future which is done already runs its callback right away
+        future.add_done_callback(lambda f, path=path: self._buildDone(path, f))
+        return future
+
+    def _buildDone(self, path, future):
+        with self._buildsLock:
+            if self._builds.get(path) is future:
+                del self._builds[path]
+
+    # Future of a level of the chain a future resolves to. Small meshes have shorter chains.
+    def _chainLevel(self, future, level):
+        result = Future()
+        if future.exception() != None:
+            result.set_exception(future.exception())
+        else:
+            chain = future.result()
+            result.set_result(chain[min(level, len(chain) - 1)])
+        return result
+
+    # Stops loading, and the processes building chains
+    def close(self):
+        self._executor.shutdown(wait=False)
+        with self._buildsLock:
+            self._closed = True
+            builds = list(self._builds.values())
+            builder = self._builder
+            self._builder = None
+        for f in builds:
+            f.cancel()
+        if builder != None:
+            builder.shutdown(wait=False)
+
+    def _evict(self):
+        while self.byteSize > self.memoryBudget and len(self.unused) > 0:
+            key, asset = self.unused.popitem(last=False)
+            del self.assets[key]
+            self.byteSize -= asset.byteSize
+            self.evictions += 1
+            asset.renderer.deleteLater()
+
+    # Runs on the GUI thread
+    @tracing.traced()
+    def _onParsed(self, key, future):
+        self.loading -= 1
+        asset = self.assets.get(key)
+        if asset != None:
+            try:
+                data = future.result()
+            # RuntimeError covers a broken process pool, or the cache having been closed
+            except (OSError, ValueError, RuntimeError) as e:
+                logger.warning("Failed to load mesh %s: %s", key[0], e)
+                data = None
+            if data != None:
+                asset.renderer.setGeometry(self._buildGeometry(asset.renderer, data))
+                asset.byteSize = data.byteSize()
+                asset.bounds = data.bounds
+                self.byteSize += asset.byteSize
+                self._evict()
+                self.onAssetLoadedSignal.emit(key)
+        if self.loading == 0:
+            self.onIdleSignal.emit()
+
+    def _buildGeometry(self, renderer, data):
+        geometry = Qt3DRender.QGeometry(renderer)
+        buffer = Qt3DRender.QBuffer(geometry)
+        buffer.setData(QByteArray(data.vertices.tobytes()))
+        attributes = ((Qt3DRender.QAttribute.defaultPositionAttributeName(), 0), (Qt3DRender.QAttribute.defaultNormalAttributeName(), 12))
+        for name, offset in attributes:
+            attribute = Qt3DRender.QAttribute(geometry)
+            attribute.setName(name)
+            attribute.setAttributeType(Qt3DRender.QAttribute.VertexAttribute)
+            attribute.setVertexBaseType(Qt3DRender.QAttribute.Float)
+            attribute.setVertexSize(3)
+            attribute.setBuffer(buffer)
+            attribute.setByteStride(24)
+            attribute.setByteOffset(offset)
+            attribute.setCount(data.vertexCount)
+            geometry.addAttribute(attribute)
+        if isinstance(data, stl.IndexedMeshData):
+            indexBuffer = Qt3DRender.QBuffer(geometry)
+            indexBuffer.setData(QByteArray(data.indices.tobytes()))
+            attribute = Qt3DRender.QAttribute(geometry)
+            attribute.setAttributeType(Qt3DRender.QAttribute.IndexAttribute)
+            attribute.setVertexBaseType(Qt3DRender.QAttribute.UnsignedInt)
+            attribute.setBuffer(indexBuffer)
+            attribute.setCount(len(data.indices))
+            geometry.addAttribute(attribute)
+        return geometry
@@ -0,0 +1,28 @@
+# Reference counted pool of shared Qt3D components (geometries, materials...), interned by a key describing them.
+# Components from the pool must never be mutated - an entity which needs a different one acquires the matching key instead.
+class ResourcePool:
+    def __init__(self, create):
+        # Called with a key, returns a new component for it
+        self.create = create
+        # key -> [component, reference count]
+        self.resources = {}
+
+    def __len__(self):
+        return len(self.resources)
+
+    def acquire(self, key):
+        entry = self.resources.get(key)
+        if entry == None:
+            entry = [self.create(key), 0]
+            self.resources[key] = entry
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, key):
+        entry = self.resources.get(key)
+        if entry == None:
+            return
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.resources[key]
+            entry[0].deleteLater()
@@ -1,19 +1,56 @@
+import math
 from PySide2.QtWidgets import QWidget, QVBoxLayout, QLabel
-from PySide2.QtCore import Qt, QUrl
+from PySide2 import QtCore
+from PySide2.QtCore import Qt, QEvent, QRect, QTimer
 from PySide2.Qt3DCore import Qt3DCore
-from PySide2.Qt3DRender import Qt3DRender
 from PySide2.Qt3DExtras import Qt3DExtras
-from PySide2.QtGui import QVector3D, QColor
+from PySide2.QtGui import QVector3D, QColor, QQuaternion
 from data.entity import CubeEntity, SphereEntity, MeshEntity
+from data import tracing
+from data.spatial import SpatialIndex
+from data.transform import normalize
+from widgets.meshcache import MeshCache
+from widgets.resourcepool import ResourcePool
 
 class Viewable:
-    def __init__(self, transform, mesh, material, entity3D):
+    def __init__(self, transform, entity3D):
         self.transform = transform
-        self.mesh = mesh
-        self.material = material
         self.entity = entity3D
+        # Meshes and materials are shared between entities. They come from a pool (the primitive pool or the mesh cache),
+        # and the key they were acquired with is remembered as to hand them back.
+        self.mesh = None
+        self.meshPool = None
+        self.meshKey = None
+        # Mesh cache keys of the entity's mesh file by detail level, and the path they are for (see View._meshFileKey)
+        self.meshFileKeys = {}
+        self.meshFilePath = None
+        self.material = None
+        self.materialKey = None
+        # Detail level of the mesh, 0 being the most detailed
+        self.level = 0
+
+# Rings and slices of the spheres at each detail level
+SPHERE_DETAIL = ((32, 32), (16, 16), (8, 12), (4, 6))
+# Projected radius in pixels below which an entity switches to the next (coarser) detail level
+SPHERE_LOD_THRESHOLDS = (80, 24, 8)
+# Meshes go through their simplified levels (see data/meshlod.py) before ending up as a box
+MESH_LOD_THRESHOLDS = (120, 40, 12, 6)
+# Relative margin around each threshold, so that an entity right at a threshold doesn't keep switching levels
+LOD_HYSTERESIS = 0.2
+
+# Detail level for a projected size, moving away from the current level only once past the hysteresis margin
+def _selectLevel(size, current, thresholds):
+    level = current
+    while level > 0 and size > thresholds[level - 1] * (1 + LOD_HYSTERESIS):
+        level -= 1
+    while level < len(thresholds) and size < thresholds[level] * (1 - LOD_HYSTERESIS):
+        level += 1
+    return level
 
 class View(QWidget):
+    # Emitted after each culling pass with the statistics of cullingStats
+    onCullingSignal = QtCore.Signal(object)
+
     def __init__(self, database, parent=None):
         super(View, self).__init__(parent)
         self.database = database
@@ -26,18 +63,24 @@ class View(QWidget):
         container.setMinimumSize(300, 300)
         container.setMaximumSize(view.screen().size())
 
-        #Qt3DRender.QPickingSettings.AllPicks
-        #self.picker = Qt3DRender.QObjectPicker(root)
-        #self.picker.clicked.connect(self.clicked)
-        #self.picker.released.connect(self.clicked)
+        # Picking goes through the spatial index rather than Qt3D's object pickers, which test every entity
+        view.installEventFilter(self)
+        self.pressPosition = None
 
         layout = QVBoxLayout(self)
         layout.addWidget(container)
 
         self.view = view # Remember to keep the rendering context alive
         self.root = root
+        # Entities whose node is enabled
+        self.shown = set()
+        # Result of the last culling pass: entity counts, and visible entities per detail level
+        self.cullingStats = {"entities": 0, "visible": 0, "culled": 0, "levels": {}}
+        self.meshCache = MeshCache(root, parent=self)
+        self.primitives = ResourcePool(self._createPrimitive)
+        self.materials = ResourcePool(self._createMaterial)
         self._configureCamera()
-        self._loadEntity(database.root)
+        self.reconcile()
 
         # Setting up the camera controls and stuff
         self.onOrbitCamera()
@@ -49,12 +92,31 @@ class View(QWidget):
         self.database.onEntityColorChangedSignal.connect(self.onEntityColorChanged)
         self.database.onEntityCubeDimensionsChangedSignal.connect(self.onEntityCubeDimensionsChanged)
         self.database.onEntitySphereDimensionsChangedSignal.connect(self.onEntitySphereRadiusChanged)
+        self.database.onEntitiesChangedSignal.connect(self.onEntitiesChanged)
+        self.database.onEntityChildrenLoadedSignal.connect(self.onEntityChildrenLoaded)
+        self.database.onEntityReparentedSignal.connect(self.onEntityReparented)
 
         self.database.onFpsCameraSignal.connect(self.onFpsCamera)
         self.database.onOrbitCameraSignal.connect(self.onOrbitCamera)
 
-        self.database.onUndoSignal.connect(self.onUndoRedo)
-        self.database.onRedoSignal.connect(self.onUndoRedo)
+        # Connected after the view's own handlers, so that the bounds of already loaded meshes are known to the entities
+        self.spatial = SpatialIndex(database, parent=self)
+        self.meshCache.onAssetLoadedSignal.connect(self.onMeshLoaded)
+
+        # Culling and level of detail run once per event loop iteration at most, whenever the camera or the scene changed
+        self.cullingTimer = QTimer(self)
+        self.cullingTimer.setSingleShot(True)
+        self.cullingTimer.setInterval(0)
+        self.cullingTimer.timeout.connect(self.cull)
+        self.view.camera().viewMatrixChanged.connect(self.scheduleCulling)
+        self.view.camera().projectionMatrixChanged.connect(self.scheduleCulling)
+        for signal in (self.database.onEntityCreatedSignal, self.database.onEntityMovedSignal, self.database.onEntityRotatedSignal,
+                self.database.onEntityCubeDimensionsChangedSignal, self.database.onEntitySphereDimensionsChangedSignal,
+                self.database.onEntitiesChangedSignal, self.database.onEntityChildrenLoadedSignal, self.database.onEntityReparentedSignal):
+            signal.connect(self.scheduleCulling)
+        self.scheduleCulling()
+
+        # Undo/redo patch entities in place and emit the same signals as regular edits, so there is nothing to reconcile on them
 
     def onFpsCamera(self):
         self.view.camController = Qt3DExtras.QFirstPersonCameraController(self.root)
@@ -68,22 +130,114 @@ class View(QWidget):
         self.view.camController.setLookSpeed(150)
         self.view.camController.setCamera(self.view.camera())
 
-    #def clicked(self, e):
-    #    print("Picked: ", type(e))
+    # A click (press and release without dragging the camera around) selects the entity under the cursor
+    def eventFilter(self, watched, event):
+        if watched is self.view:
+            if event.type() == QEvent.MouseButtonPress and event.button() == Qt.LeftButton:
+                self.pressPosition = event.pos()
+            elif event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton and self.pressPosition != None:
+                if (event.pos() - self.pressPosition).manhattanLength() < 4:
+                    self.pick(event.pos().x(), event.pos().y())
+                self.pressPosition = None
+            elif event.type() == QEvent.KeyPress and event.key() == Qt.Key_F5:
+                self.reloadMeshes()
+        return super(View, self).eventFilter(watched, event)
 
-    def _loadEntity(self, e):
-        for c in e.children:
-            self.onEntityCreated(c)
-            self._loadEntity(c)
+    # Picks up mesh files edited on disk since they were loaded
+    @tracing.traced()
+    def reloadMeshes(self):
+        for e, viewable in self.entityMap.items():
+            if viewable.meshFilePath != None:
+                viewable.meshFileKeys = {}
+                viewable.meshFilePath = None
+                self._setMesh(viewable, e)
 
-    def _clear(self):
-        self.entityMap = {}
-        pass
+    # Selects the closest entity under a point of the viewport, if any
+    def pick(self, x, y):
+        origin, direction = self._cursorRay(x, y)
+        picked, _ = self.spatial.raycast(origin, direction)
+        if picked != None:
+            self.database.entitySelected(picked)
+
+    # World space ray going through a point of the viewport, as (origin, normalized direction)
+    def _cursorRay(self, x, y):
+        camera = self.view.camera()
+        viewport = QRect(0, 0, self.view.width(), self.view.height())
+        y = self.view.height() - y
+        near = QVector3D(x, y, 0).unproject(camera.viewMatrix(), camera.projectionMatrix(), viewport)
+        far = QVector3D(x, y, 1).unproject(camera.viewMatrix(), camera.projectionMatrix(), viewport)
+        direction = normalize((far.x() - near.x(), far.y() - near.y(), far.z() - near.z()))
+        return ((near.x(), near.y(), near.z()), direction)
+
+    @tracing.traced()
+    def onMeshLoaded(self, key):
+        for e, viewable in self.entityMap.items():
+            if viewable.meshPool is self.meshCache and viewable.meshKey == key:
+                e.setMeshBounds(self.meshCache.bounds(key))
+                self.spatial.refresh(e)
+        self.scheduleCulling()
+
+    def scheduleCulling(self, *_):
+        self.cullingTimer.start()
 
-    def onUndoRedo(self):
-        self._clear()
-        self._loadEntity(self.database.root)
-        pass
+    # Disables the nodes of entities outside of the camera's frustum and picks the detail level of the visible ones.
+    # Only entities found by the spatial index and the ones shown before are visited, not the whole scene.
+    @tracing.traced()
+    def cull(self):
+        camera = self.view.camera()
+        visible = self.spatial.queryFrustum(self._frustumPlanes(camera.projectionMatrix() * camera.viewMatrix()))
+
+        # Disabling a node hides its whole subtree, so the ancestors of visible entities have to stay enabled
+        shown = set()
+        for e in visible:
+            while e != None and e not in shown and e in self.entityMap:
+                shown.add(e)
+                e = e.getParent()
+        for e in self.shown - shown:
+            self.entityMap[e].entity.setEnabled(False)
+        for e in shown - self.shown:
+            self.entityMap[e].entity.setEnabled(True)
+        self.shown = shown
+
+        levels = {}
+        position = camera.position()
+        eye = (position.x(), position.y(), position.z())
+        # Pixels per world unit at a distance of 1
+        scale = self.view.height() / 2 / math.tan(math.radians(camera.lens().fieldOfView()) / 2)
+        for e in visible:
+            viewable = self.entityMap.get(e)
+            thresholds = self._lodThresholds(e)
+            if viewable == None or thresholds == None:
+                continue
+            box = e.worldBounds()
+            center = ((box[0] + box[3]) / 2, (box[1] + box[4]) / 2, (box[2] + box[5]) / 2)
+            radius = math.sqrt((box[3] - box[0]) ** 2 + (box[4] - box[1]) ** 2 + (box[5] - box[2]) ** 2) / 2
+            distance = max(math.sqrt(sum((center[i] - eye[i]) ** 2 for i in range(3))), 1e-6)
+            level = _selectLevel(radius / distance * scale, viewable.level, thresholds)
+            if level != viewable.level:
+                viewable.level = level
+                self._setMesh(viewable, e)
+            levels[level] = levels.get(level, 0) + 1
+
+        self.cullingStats = {"entities": len(self.entityMap), "visible": len(shown), "culled": len(self.entityMap) - len(shown), "levels": levels}
+        self.onCullingSignal.emit(self.cullingStats)
+
+    # Planes (a, b, c, d) of the frustum of a view-projection matrix, with a * x + b * y + c * z + d >= 0 inside
+    def _frustumPlanes(self, m):
+        rows = [m.row(i) for i in range(4)]
+        rows = [(r.x(), r.y(), r.z(), r.w()) for r in rows]
+        planes = []
+        for i in range(3):
+            planes.append(tuple(rows[3][k] + rows[i][k] for k in range(4)))
+            planes.append(tuple(rows[3][k] - rows[i][k] for k in range(4)))
+        return planes
+
+    def _lodThresholds(self, e):
+        if isinstance(e, SphereEntity):
+            return SPHERE_LOD_THRESHOLDS
+        elif isinstance(e, MeshEntity):
+            return MESH_LOD_THRESHOLDS
+        return None
 
     def _configureCamera(self):
         self.view.camera().lens().setPerspectiveProjection(45, 16 / 9, 0.1, 1000)
@@ -91,68 +245,219 @@ class View(QWidget):
         self.view.camera().setViewCenter(QVector3D(0, 0, 0))
 
 
+    # Created entities may come with a whole subtree (e.g. when a removal gets undone)
+    @tracing.traced()
     def onEntityCreated(self, newEntity):
-        parent = self.root
-        if newEntity.parent != None and newEntity.parent() in self.entityMap:
-            parent = self.entityMap[newEntity.parent()].entity
+        self.reconcile(newEntity)
+
+    # Children streamed in from the scene file (their own children come later, if any)
+    @tracing.traced()
+    def onEntityChildrenLoaded(self, parent):
+        for e in parent.children:
+            if e not in self.entityMap:
+                self._createViewable(e)
+
+    # The node of a moved entity is moved along with it, its subtree and resources stay as they are
+    @tracing.traced()
+    def onEntityReparented(self, entity):
+        viewable = self.entityMap.get(entity)
+        if viewable == None:
+            self.reconcile(entity)
+        else:
+            viewable.entity.setParent(self._parentNode(entity))
+
+    # Brings the 3D nodes of a subtree (the whole scene by default) in line with the entities, matching them by identity.
+    # Nodes of new entities are created, and the transforms, materials and meshes of known ones are only touched where they differ.
+    # A full pass also frees the nodes of entities which aren't part of the scene anymore.
+    @tracing.traced()
+    def reconcile(self, subtreeRoot=None):
+        full = subtreeRoot == None or subtreeRoot is self.database.root
+        stack = list(self.database.root.children) if full else [subtreeRoot]
+        seen = set()
+        while len(stack) > 0:
+            e = stack.pop()
+            seen.add(e)
+            viewable = self.entityMap.get(e)
+            if viewable == None:
+                self._createViewable(e)
+            else:
+                self._syncViewable(e, viewable)
+            # Parents come first, so children can be attached to their node
+            stack.extend(reversed(e.children))
+
+        if full:
+            self._freeViewables([e for e in self.entityMap if e not in seen])
+
+    def _parentNode(self, e):
+        parent = e.getParent()
+        if parent != None and parent in self.entityMap:
+            return self.entityMap[parent].entity
+        return self.root
+
+    def _createViewable(self, newEntity):
+        parent = self._parentNode(newEntity)
 
         #print(parent)
         entity = Qt3DCore.QEntity(parent)
-        material = Qt3DExtras.QPhongMaterial()
-        material.setDiffuse(newEntity.color)
-        material.setAmbient(QColor(0.5, 0.5, 0.5))
         transform = Qt3DCore.QTransform()
-        transform.setTranslation(newEntity.position)
-        transform.setRotation(newEntity.rotation)
-        mesh = None
-
-        if isinstance(newEntity, SphereEntity):
-            #print("Sphere")
-            mesh = Qt3DExtras.QSphereMesh()
-            mesh.setRadius(newEntity.radius)
-        elif isinstance(newEntity, CubeEntity):
-            #print("Cube")
-            mesh = Qt3DExtras.QCuboidMesh()
-            mesh.setXExtent(newEntity.dimensions.x())
-            mesh.setYExtent(newEntity.dimensions.y())
-            mesh.setZExtent(newEntity.dimensions.z())
-        elif isinstance(newEntity, MeshEntity):
-            mesh = Qt3DRender.QMesh()
-            mesh.setSource(QUrl("file:" + newEntity.meshPath))
+        transform.setTranslation(QVector3D(*newEntity.position))
+        transform.setRotation(QQuaternion(*newEntity.rotation))
+        entity.addComponent(transform)
+        viewable = Viewable(transform, entity)
+        self._setMesh(viewable, newEntity)
+        self._setMaterial(viewable, newEntity.color)
+        self.entityMap[newEntity] = viewable
+        self.shown.add(newEntity)
+
+    def _syncViewable(self, e, viewable):
+        parent = self._parentNode(e)
+        if viewable.entity.parentEntity() != parent:
+            viewable.entity.setParent(parent)
+        position = QVector3D(*e.position)
+        if viewable.transform.translation() != position:
+            viewable.transform.setTranslation(position)
+        rotation = QQuaternion(*e.rotation)
+        if viewable.transform.rotation() != rotation:
+            viewable.transform.setRotation(rotation)
+        self._setMesh(viewable, e)
+        self._setMaterial(viewable, e.color)
+
+    # The pool providing an entity's mesh at the viewable's detail level, and the key of the mesh within it
+    def _meshSource(self, e, viewable):
+        level = viewable.level
+        if isinstance(e, SphereEntity):
+            return (self.primitives, ("sphere", float(e.radius), level))
+        elif isinstance(e, CubeEntity):
+            d = e.dimensions
+            return (self.primitives, ("cube", d[0], d[1], d[2]))
+        elif isinstance(e, MeshEntity):
+            return (self.meshCache, self._meshFileKey(viewable, e.meshPath, min(level, MeshCache.levels - 1)))
         else:
-            #print("Entity")
-            pass
+            return (None, None)
 
-        entity.addComponent(mesh)
-        entity.addComponent(transform)
-        entity.addComponent(material)
-        #entity.addComponent(self.picker)
-        self.entityMap[newEntity] = Viewable(transform, mesh, material, entity)
+    # Resolving the key of a mesh file stats the file, so the keys are kept on the viewable
+    # until its mesh path changes or the meshes get reloaded
+    def _meshFileKey(self, viewable, path, level):
+        if viewable.meshFilePath != path:
+            viewable.meshFileKeys = {}
+            viewable.meshFilePath = path
+        key = viewable.meshFileKeys.get(level)
+        if key == None:
+            key = self.meshCache.key(path, level)
+            viewable.meshFileKeys[level] = key
+        return key
+
+    # Switches the entity's node to the shared mesh matching its current shape, if it isn't using it already
+    def _setMesh(self, viewable, e):
+        pool, key = self._meshSource(e, viewable)
+        if pool is viewable.meshPool and key == viewable.meshKey:
+            return
+        self._releaseMesh(viewable)
+        if pool != None:
+            viewable.mesh = pool.acquire(key)
+            viewable.entity.addComponent(viewable.mesh)
+        if pool is self.meshCache and self.meshCache.bounds(key) != None:
+            e.setMeshBounds(self.meshCache.bounds(key))
+        viewable.meshPool = pool
+        viewable.meshKey = key
 
+    def _releaseMesh(self, viewable):
+        if viewable.mesh != None:
+            viewable.entity.removeComponent(viewable.mesh)
+            viewable.meshPool.release(viewable.meshKey)
+            viewable.mesh = None
+
+    def _setMaterial(self, viewable, color):
+        key = tuple(color)
+        if key == viewable.materialKey:
+            return
+        self._releaseMaterial(viewable)
+        viewable.material = self.materials.acquire(key)
+        viewable.materialKey = key
+        viewable.entity.addComponent(viewable.material)
+
+    def _releaseMaterial(self, viewable):
+        if viewable.material != None:
+            viewable.entity.removeComponent(viewable.material)
+            self.materials.release(viewable.materialKey)
+            viewable.material = None
+            viewable.materialKey = None
+
+    def _createPrimitive(self, key):
+        if key[0] == "sphere":
+            mesh = Qt3DExtras.QSphereMesh(self.root)
+            mesh.setRadius(key[1])
+            mesh.setRings(SPHERE_DETAIL[key[2]][0])
+            mesh.setSlices(SPHERE_DETAIL[key[2]][1])
+        else:
+            mesh = Qt3DExtras.QCuboidMesh(self.root)
+            mesh.setXExtent(key[1])
+            mesh.setYExtent(key[2])
+            mesh.setZExtent(key[3])
+        return mesh
+
+    def _createMaterial(self, key):
+        material = Qt3DExtras.QPhongMaterial(self.root)
+        material.setDiffuse(QColor(key[0], key[1], key[2]))
+        material.setAmbient(QColor(0.5, 0.5, 0.5))
+        return material
+
+    # Deletes the 3D nodes (and with them their components) of the given entities
+    def _freeViewables(self, entities):
+        viewables = [self.entityMap.pop(e) for e in entities]
+        self.shown.difference_update(entities)
+        for v in viewables:
+            # Shared components aren't owned by the node, they go back to their pools
+            self._releaseMesh(v)
+            self._releaseMaterial(v)
+        # Detach all of them first, so that no node gets deleted together with a parent which is deleted as well
+        for v in viewables:
+            v.entity.setParent(None)
+        for v in viewables:
+            v.entity.deleteLater()
+
+    @tracing.traced()
     def onEntityDestroyed(self, destroyedEntity):
-        for c in destroyedEntity.children:
-            self.onEntityDestroyed(c)
-        for comp in self.entityMap[destroyedEntity].entity.components():
-            self.entityMap[destroyedEntity].entity.removeComponent(comp)
-        self.entityMap.pop(destroyedEntity, None)
+        removed = []
+        stack = [destroyedEntity]
+        while len(stack) > 0:
+            e = stack.pop()
+            if e in self.entityMap:
+                removed.append(e)
+            stack.extend(e.children)
+        self._freeViewables(removed)
 
+    @tracing.traced()
     def onEntityMoved(self, movedEntity, newPosition):
         transform = self.entityMap[movedEntity].transform
-        transform.setTranslation(newPosition)
+        transform.setTranslation(QVector3D(*newPosition))
 
+    @tracing.traced()
     def onEntityRotated(self, rotatedEntity, newRotation):
         transform = self.entityMap[rotatedEntity].transform
-        transform.setRotation(newRotation)
+        transform.setRotation(QQuaternion(*newRotation))
+
+    # Bulk changes: every touched entity gets synced once, whatever the number of attributes changed
+    @tracing.traced()
+    def onEntitiesChanged(self, changes):
+        synced = set()
+        for attribute, entities in changes.items():
+            if attribute == "name":
+                continue
+            for e in entities:
+                if e not in synced and e in self.entityMap:
+                    synced.add(e)
+                    self._syncViewable(e, self.entityMap[e])
 
+    # Shared meshes and materials are never mutated, the entity moves to the one matching its new values instead
+    @tracing.traced()
     def onEntityColorChanged(self, changedEntity, newColor):
-        self.entityMap[changedEntity].material.setDiffuse(newColor)
+        self._setMaterial(self.entityMap[changedEntity], newColor)
 
+    @tracing.traced()
     def onEntityCubeDimensionsChanged(self, changedEntity, newDimensions):
-        mesh = self.entityMap[changedEntity].mesh
-        mesh.setXExtent(newDimensions.x())
-        mesh.setYExtent(newDimensions.y())
-        mesh.setZExtent(newDimensions.z())
+        self._setMesh(self.entityMap[changedEntity], changedEntity)
 
+    @tracing.traced()
     def onEntitySphereRadiusChanged(self, changedEntity, newRadius):
-        mesh = self.entityMap[changedEntity].mesh
-        mesh.setRadius(newRadius)
\ No newline at end of file
+        self._setMesh(self.entityMap[changedEntity], changedEntity)